@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+集群模式基准测试：房间迁移比例与多节点投递吞吐
+
+第一部分只计算哈希环：节点数从 N 增加到 N+1 时换拥有者的房间比例（理想值
+为 1/(N+1)），以及各节点拥有的房间数相对平均值的最大偏差。
+
+第二部分在本机启动若干个集群节点子进程，客户端按序号轮流连接各节点，
+加入若干个房间后同时发送消息，统计所有客户端收到消息的总速率。负载由
+本进程中的线程产生，结果只适合在相同机器上横向比较。
+
+用法:
+    python -m benchmarks.bench_cluster --nodes 1 2 3 --clients 24 --rooms 8
+"""
+
+import argparse
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List
+
+import grpc
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+import chat_pb2  # type: ignore
+import chat_pb2_grpc  # type: ignore
+from grpc_chat.cluster import HashRing
+
+# 客户端连接的端口从 base_port 开始，节点之间的内部通信端口再加上该偏移
+PEER_PORT_OFFSET = 1000
+
+
+def bench_ring(max_nodes: int, keys: int) -> None:
+    room_ids = [f"room-{i}" for i in range(keys)]
+    print(f"{'节点数':>6} | {'迁移比例':>8} | {'理想值':>6} | {'最大偏差':>8}")
+    before = [HashRing(["n0"]).owner(room_id) for room_id in room_ids]
+    for count in range(2, max_nodes + 1):
+        ring = HashRing([f"n{i}" for i in range(count)])
+        after = [ring.owner(room_id) for room_id in room_ids]
+        moved = sum(1 for old, new in zip(before, after) if old != new) / keys
+        load = Counter(after)
+        skew = max(load.values()) / (keys / count) - 1
+        print(f"{count:>6} | {moved:>8.1%} | {1 / count:>6.1%} | {skew:>8.1%}")
+        before = after
+
+
+class _BenchClient:
+    """一个聊天流，统计收到的聊天消息数"""
+
+    def __init__(self, port: int, user_name: str, room_id: str, expected: int):
+        self.expected = expected
+        self.received = 0
+        self.joined = threading.Event()
+        self.done = threading.Event()
+        self._channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+        stub = chat_pb2_grpc.ChatServiceStub(self._channel)
+        stub.CheckUsername(chat_pb2.CheckUsernameRequest(user_name=user_name))
+        self._outgoing: "queue.Queue" = queue.Queue()
+        join = chat_pb2.JoinRequest(user_name=user_name, room_id=room_id)
+        self._outgoing.put(chat_pb2.ClientMessage(join_request=join))
+        self._stream = stub.Chat(iter(self._outgoing.get, None))
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        try:
+            for message in self._stream:
+                if message.HasField("join_response"):
+                    self.joined.set()
+                elif message.HasField("broadcast"):
+                    self.received += 1
+                    if self.received >= self.expected:
+                        self.done.set()
+        except grpc.RpcError:
+            pass
+
+    def send(self, count: int, text: str):
+        chat = chat_pb2.ClientMessage(chat_message=chat_pb2.ChatMessage(text=text))
+        for _ in range(count):
+            self._outgoing.put(chat)
+
+    def close(self):
+        self._outgoing.put(None)
+        self._channel.close()
+
+
+def _start_nodes(count: int, base_port: int, mode: str) -> List[subprocess.Popen]:
+    spec = ",".join(
+        f"n{i}=127.0.0.1:{base_port + PEER_PORT_OFFSET + i}" for i in range(count)
+    )
+    return [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "grpc_chat.server",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(base_port + i),
+                "--mode",
+                mode,
+                "--node-id",
+                f"n{i}",
+                "--cluster",
+                spec,
+                "--queue-size",
+                "65536",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for i in range(count)
+    ]
+
+
+def _wait_ready(port: int, timeout: float = 10.0) -> None:
+    channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+    grpc.channel_ready_future(channel).result(timeout=timeout)
+    channel.close()
+
+
+def bench_throughput(
+    nodes: int, base_port: int, mode: str, clients: int, rooms: int, messages: int
+) -> None:
+    processes = _start_nodes(nodes, base_port, mode)
+    bench_clients: List[_BenchClient] = []
+    try:
+        for i in range(nodes):
+            _wait_ready(base_port + i)
+        # 等待节点之间的内部连接建立、哈希环稳定
+        time.sleep(2)
+        stub = chat_pb2_grpc.ChatServiceStub(
+            grpc.insecure_channel(f"127.0.0.1:{base_port}")
+        )
+        per_room = -(-clients // rooms)
+        room_ids = [f"bench-{j}" for j in range(rooms)]
+        for room_id in room_ids:
+            stub.CreateRoom(
+                chat_pb2.CreateRoomRequest(room_id=room_id, max_capacity=per_room)
+            )
+        members = Counter(i % rooms for i in range(clients))
+        for i in range(clients):
+            room = i % rooms
+            bench_clients.append(
+                _BenchClient(
+                    base_port + i % nodes,
+                    f"bench{i}",
+                    room_ids[room],
+                    messages * members[room],
+                )
+            )
+        for client in bench_clients:
+            client.joined.wait(10)
+        # 等待加入通知广播完毕
+        time.sleep(0.5)
+
+        start = time.perf_counter()
+        for client in bench_clients:
+            client.send(messages, "x" * 100)
+        deadline = start + 60
+        for client in bench_clients:
+            client.done.wait(max(0.0, deadline - time.perf_counter()))
+        elapsed = time.perf_counter() - start
+        delivered = sum(client.received for client in bench_clients)
+        expected = sum(client.expected for client in bench_clients)
+        print(
+            f"{nodes:>6} | {clients * messages / elapsed:>10,.0f} | "
+            f"{delivered / elapsed:>10,.0f} | {delivered / expected:>6.1%}"
+        )
+    finally:
+        for client in bench_clients:
+            client.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="集群模式基准测试")
+    parser.add_argument(
+        "--nodes", type=int, nargs="+", default=[1, 2, 3], help="要测试的节点数"
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=("thread", "asyncio"),
+        default="asyncio",
+        help="节点的服务器模式 (默认: asyncio)",
+    )
+    parser.add_argument("--clients", type=int, default=24, help="客户端总数")
+    parser.add_argument("--rooms", type=int, default=8, help="房间数")
+    parser.add_argument(
+        "--messages", type=int, default=200, help="每个客户端发送的消息数"
+    )
+    parser.add_argument(
+        "--keys", type=int, default=10000, help="计算迁移比例时使用的房间数"
+    )
+    parser.add_argument(
+        "--base-port", type=int, default=56000, help="第一个节点的客户端端口"
+    )
+    args = parser.parse_args()
+
+    bench_ring(max(args.nodes + [4]), args.keys)
+    print()
+    print(f"{'节点数':>6} | {'发送 条/秒':>10} | {'投递 条/秒':>10} | {'送达率':>6}")
+    for nodes in args.nodes:
+        bench_throughput(
+            nodes, args.base_port, args.mode, args.clients, args.rooms, args.messages
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+广播扇出基准测试：逐连接序列化 vs 预编码一次
+
+模拟一条聊天消息在房间内的完整扇出过程：构造 ServerMessage、编码后入队到
+每个成员的 StreamHandler、再由 gRPC 的响应序列化器逐条取出。发送队列只保存
+字节，旧路径因此在入队时为每个连接各编码一次。
+
+聊天消息很小，编码一次只需约 1µs；两条路径都要为每个连接加锁入队，人数
+多时这部分占大头，所以预编码只带来 1.3~1.5 倍的加速。发送方忙于发送时
+入队不再 notify，是另一项逐连接开销的削减，两条路径同样受益。
+
+用法:
+    python -m benchmarks.bench_fanout --sizes 2 20 200 --messages 2000
+"""
+
+import argparse
+import time
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+import chat_pb2  # type: ignore
+from grpc_chat.rooms import Room
+from grpc_chat.server import StreamHandler
+from grpc_chat.wire import encode_server_message, serialize_server_message
+
+TEXT = "你好，这是一条用于基准测试的聊天消息 hello benchmark " * 2
+
+
+def _make_room(size: int) -> Room:
+    room = Room("bench", max_capacity=size)
+    for i in range(size):
+        user_name = f"user{i}"
+        room.add(user_name, StreamHandler(user_name, "bench"))
+    return room
+
+
+def _drain(room: Room, serializer) -> int:
+    """模拟 gRPC 发送：取出每个连接的消息并调用响应序列化器"""
+    total = 0
+    for handler in room.subscribers:
+        for message in handler.message_queue:
+            total += len(serializer(message))
+        handler.message_queue.clear()
+        handler.message_meta.clear()
+        handler.queued_bytes = 0
+    return total
+
+
+def _message(i: int):
+    broadcast = chat_pb2.BroadcastMessage(
+        sender_name="user0", text=TEXT, timestamp=1700000000 + i
+    )
+    return chat_pb2.ServerMessage(broadcast=broadcast)
+
+
+def bench_per_stream(room: Room, messages: int) -> float:
+    """旧路径：每个连接各自序列化一次消息对象"""
+    start = time.perf_counter()
+    for i in range(messages):
+        message = _message(i)
+        with room.publish_lock:
+            for handler in room.subscribers:
+                handler.send_message(message.SerializeToString())
+        _drain(room, serialize_server_message)
+    return time.perf_counter() - start
+
+
+def bench_encode_once(room: Room, messages: int) -> float:
+    """新路径：编码一次，所有连接共享同一份字节"""
+    start = time.perf_counter()
+    for i in range(messages):
+        room.broadcast(encode_server_message(_message(i)))
+        _drain(room, serialize_server_message)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="广播扇出序列化基准测试")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[2, 20, 200], help="房间人数"
+    )
+    parser.add_argument(
+        "--messages", type=int, default=2000, help="每轮广播的消息数 (默认: 2000)"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'人数':>6} | {'逐连接序列化 µs/条':>18} | {'预编码一次 µs/条':>16} | 加速比"
+    )
+    for size in args.sizes:
+        room = _make_room(size)
+        # 预热
+        bench_per_stream(room, 50)
+        bench_encode_once(room, 50)
+        old = bench_per_stream(room, args.messages)
+        new = bench_encode_once(room, args.messages)
+        print(
+            f"{size:>6} | {old / args.messages * 1e6:>18.1f} | "
+            f"{new / args.messages * 1e6:>16.1f} | {old / new:>5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
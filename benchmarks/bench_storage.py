@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+持久化消息日志写入吞吐基准测试
+
+向若干房间追加消息，统计从第一条追加到全部写入并落盘的吞吐量，
+以及广播路径上单次 append 调用的平均耗时。
+
+用法:
+    python -m benchmarks.bench_storage --messages 200000 --rooms 4
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+import chat_pb2  # type: ignore
+from grpc_chat.storage import FSYNC_POLICIES, MessageLog
+
+
+def bench(policy: str, messages: int, rooms: int, size: int) -> None:
+    data_dir = tempfile.mkdtemp(prefix="grpc-chat-bench-")
+    try:
+        log = MessageLog(data_dir, fsync_policy=policy)
+        room_ids = [f"room{i}" for i in range(rooms)]
+        payloads = [
+            chat_pb2.ServerMessage(
+                broadcast=chat_pb2.BroadcastMessage(
+                    sender_name="bench", text="x" * size, sequence=i
+                )
+            ).SerializeToString()
+            for i in range(1, 257)
+        ]
+        sequences = [0] * rooms
+
+        start = time.perf_counter()
+        for i in range(messages):
+            room = i % rooms
+            sequences[room] += 1
+            log.append(room_ids[room], sequences[room], payloads[i & 0xFF])
+        enqueued = time.perf_counter()
+        log.close()
+        durable = time.perf_counter()
+
+        print(
+            f"{policy:>8} | {messages / (durable - start):>12,.0f} | "
+            f"{(enqueued - start) / messages * 1e6:>10.2f}"
+        )
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="持久化消息日志写入基准测试")
+    parser.add_argument("--messages", type=int, default=200000, help="消息总数")
+    parser.add_argument("--rooms", type=int, default=4, help="房间数")
+    parser.add_argument("--size", type=int, default=100, help="每条消息的文本长度")
+    parser.add_argument(
+        "--fsync",
+        type=str,
+        nargs="+",
+        choices=FSYNC_POLICIES,
+        default=list(FSYNC_POLICIES),
+        help="要测试的 fsync 策略",
+    )
+    args = parser.parse_args()
+
+    print(f"{'fsync':>8} | {'落盘 条/秒':>10} | {'append µs':>10}")
+    for policy in args.fsync:
+        bench(policy, args.messages, args.rooms, args.size)
+
+
+if __name__ == "__main__":
+    main()
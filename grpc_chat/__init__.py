@@ -18,5 +18,14 @@ __email__ = "liuke3090@gmail.com"
 
 # 只导入服务端相关模块（无GUI依赖）
 from .server import ChatServer, serve
+from .sdk import AsyncChatClient, ChatClient, ChatHandlers, JoinError, JoinTimeout
 
-__all__ = ["ChatServer", "serve"]
+__all__ = [
+    "ChatServer",
+    "serve",
+    "ChatClient",
+    "AsyncChatClient",
+    "ChatHandlers",
+    "JoinError",
+    "JoinTimeout",
+]
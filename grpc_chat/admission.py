@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天流的准入控制
+
+超出容量时新的聊天流立即以 RESOURCE_EXHAUSTED 结束，并在 trailing metadata
+中给出建议的重试间隔，而不是排队等待或拖慢已有的连接。依次检查：
+
+- 所有发送队列中等待发送的字节数：已有连接来不及接收时不再接纳新连接
+- 同时打开的聊天流数
+- 每秒新加入的聊天流数（令牌桶），重启后大量客户端同时重连时分批接纳
+
+房间列表订阅（WatchRooms）同样是长期占用的流，单独计数。各项为 0 时不检查。
+通过检查的聊天流和订阅结束时必须调用 release 和 release_watcher。
+"""
+
+import threading
+import time
+from typing import Callable, Tuple
+
+from grpc_chat.ratelimit import TokenBucket
+
+# 拒绝原因，同时用作指标的 reason 标签
+REJECT_QUEUE_BYTES = "queue_bytes"
+REJECT_STREAMS = "streams"
+REJECT_JOIN_RATE = "join_rate"
+REJECT_WATCHERS = "watchers"
+REJECT_DRAINING = "draining"
+
+# 因队列字节数或聊天流数被拒绝时建议的重试间隔（秒）
+DEFAULT_RETRY_AFTER = 1.0
+
+# gRPC 约定的重试间隔 trailing metadata
+RETRY_PUSHBACK_KEY = "grpc-retry-pushback-ms"
+
+
+class AdmissionControl:
+    """聊天流数、加入速率和发送队列字节数的上限
+
+    Args:
+        max_streams: 同时打开的聊天流数上限
+        join_rate: 每秒最多接纳的新聊天流数
+        join_burst: 最多连续接纳的新聊天流数，0 时取 max(1, join_rate)
+        max_queue_bytes: 所有发送队列中等待发送的字节数上限
+        max_watchers: 同时打开的房间列表订阅数上限
+    """
+
+    def __init__(
+        self,
+        max_streams: int = 0,
+        join_rate: float = 0.0,
+        join_burst: float = 0.0,
+        max_queue_bytes: int = 0,
+        max_watchers: int = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        limits = (max_streams, join_rate, join_burst, max_queue_bytes, max_watchers)
+        if min(limits) < 0:
+            raise ValueError("准入上限不能为负数")
+        self.max_streams = max_streams
+        self.max_queue_bytes = max_queue_bytes
+        self.max_watchers = max_watchers
+        self._clock = clock
+        self._joins = None
+        if join_rate > 0:
+            self._joins = TokenBucket(
+                join_rate, join_burst or max(1.0, join_rate), clock()
+            )
+        # 已通过检查、尚未结束的聊天流数和房间列表订阅数
+        self.streams = 0
+        self.watchers = 0
+        self._lock = threading.Lock()
+
+    def admit(self, queued_bytes: Callable[[], int]) -> Tuple[str, float]:
+        """检查能否接纳一个新的聊天流，通过时计入聊天流数
+
+        Args:
+            queued_bytes: 返回当前所有发送队列中的字节数，只在设置了上限时调用
+
+        Returns:
+            (拒绝原因, 建议的重试秒数)，通过时拒绝原因为空字符串
+        """
+        if self.max_queue_bytes and queued_bytes() > self.max_queue_bytes:
+            return REJECT_QUEUE_BYTES, DEFAULT_RETRY_AFTER
+        with self._lock:
+            if self.max_streams and self.streams >= self.max_streams:
+                return REJECT_STREAMS, DEFAULT_RETRY_AFTER
+            if self._joins is not None:
+                wait = self._joins.wait_time(self._clock())
+                if wait > 0:
+                    return REJECT_JOIN_RATE, wait
+                self._joins.tokens -= 1
+            self.streams += 1
+        return "", 0.0
+
+    def release(self):
+        """通过检查的聊天流结束"""
+        with self._lock:
+            self.streams -= 1
+
+    def admit_watcher(self) -> bool:
+        """检查能否接纳一个新的房间列表订阅，通过时计入订阅数"""
+        with self._lock:
+            if self.max_watchers and self.watchers >= self.max_watchers:
+                return False
+            self.watchers += 1
+            return True
+
+    def release_watcher(self):
+        with self._lock:
+            self.watchers -= 1
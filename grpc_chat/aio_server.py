@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于 grpc.aio 的异步聊天服务器
+
+所有 RPC 都以协程的形式运行在同一个事件循环上，每个聊天流只占用一个
+asyncio 队列和一个读取任务，而不是两个操作系统线程。房间与广播逻辑
+复用 ChatServer 中的实现。
+"""
+
+import asyncio
+import signal
+from typing import List
+
+import grpc
+
+from grpc_chat import log
+from grpc_chat.server import (
+    ChatServer,
+    StreamHandler,
+    _print_banner,
+    grpc_server_options,
+)
+from grpc_chat.wire import add_chat_service_to_server, encode_batch
+
+
+class AsyncStreamHandler(StreamHandler):
+    """处理单个用户的异步流连接
+
+    入队和溢出策略与 StreamHandler 相同，发送方通过 asyncio.Event 等待新消息。
+    send_message 必须在事件循环线程中调用。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._event = asyncio.Event()
+
+    def _notify(self):
+        """唤醒发送协程"""
+        self._event.set()
+
+    async def get_messages(self):
+        """获取待发送的消息异步生成器，只在有消息时被唤醒"""
+        while True:
+            with self._lock:
+                if self.overflowed:
+                    break
+                if self.message_queue:
+                    message = self._pop()
+                elif not self.active:
+                    break
+                else:
+                    message = None
+                    self._event.clear()
+            if message is None:
+                await self._event.wait()
+                continue
+            yield message
+
+    async def get_batches(self, max_delay: float, max_bytes: int):
+        """获取待发送消息的批次异步生成器，规则同 StreamHandler.get_batches"""
+        loop = asyncio.get_running_loop()
+        batch: List = []
+        size = 0
+        deadline = 0.0
+        while True:
+            with self._lock:
+                if self.overflowed:
+                    break
+                while self.message_queue and size < max_bytes:
+                    message = self._pop()
+                    if not batch:
+                        deadline = loop.time() + max_delay
+                    batch.append(message)
+                    size += len(message)
+                done = not self.active and not self.message_queue
+                if not done and size < max_bytes:
+                    self._event.clear()
+            if batch and (done or size >= max_bytes or loop.time() >= deadline):
+                yield batch
+                batch = []
+                size = 0
+                continue
+            if done:
+                break
+            try:
+                timeout = deadline - loop.time() if batch else None
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class AsyncChatServer(ChatServer):
+    """ChatServer 的 asyncio 版本
+
+    广播与房间管理方法都是非阻塞的同步方法，且只会在事件循环线程中被调用，
+    因此父类中的房间锁永远不会发生竞争，可以直接复用。需要等待总线应答或
+    读取持久化日志的请求在线程池中执行，不阻塞事件循环。
+    """
+
+    handler_class = AsyncStreamHandler
+
+    def __init__(self, *args, **kwargs):
+        # 总线事件在读取线程中到达，需要转交给事件循环处理
+        self._loop = asyncio.get_event_loop()
+        super().__init__(*args, **kwargs)
+
+    def _call_soon(self, callback, *args):
+        """在事件循环线程中调用 callback"""
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # 事件循环已关闭，服务正在退出
+            pass
+
+    async def ListRooms(self, request, context):
+        """获取房间列表 (一元RPC)"""
+        return super().ListRooms(request, context)
+
+    async def CheckUsername(self, request, context):
+        """校验用户名唯一性"""
+        return await self._run_blocking(super().CheckUsername, request, context)
+
+    async def CreateRoom(self, request, context):
+        """运行时创建房间"""
+        return await self._run_blocking(super().CreateRoom, request, context)
+
+    async def DeleteRoom(self, request, context):
+        """删除没有成员的房间"""
+        return await self._run_blocking(super().DeleteRoom, request, context)
+
+    async def _run_blocking(self, func, *args):
+        """需要等待总线应答或读取持久化日志时在线程池中执行 func，否则直接调用
+
+        房间与用户名都由锁保护，加入流程在线程池中执行不会向事件循环中的
+        处理器发出通知，与线程模式下的并发方式相同。
+        """
+        if self.bus is None and self.message_log is None:
+            return func(*args)
+        return await self._loop.run_in_executor(None, func, *args)
+
+    def _call_later(self, delay: float, callback):
+        """在 delay 秒后于事件循环中调用 callback（可在任意线程中调用）"""
+        self._call_soon(self._loop.call_later, delay, callback)
+
+    async def WatchRooms(self, request, context):
+        """订阅房间列表变化 (服务端流RPC)，规则同 ChatServer.WatchRooms"""
+        if not self._admit_watcher(context):
+            return
+        watcher = self._create_watcher(context)
+        try:
+            count = self.room_watch.subscribe(watcher, request.name_prefix)
+            log.info(
+                "rooms.watch",
+                "{peer} 订阅房间列表，快照 {rooms} 个房间，当前订阅者 {watchers}",
+                peer=watcher.user_name,
+                rooms=count,
+                watchers=self.room_watch.watcher_count,
+            )
+            async for frame in watcher.get_messages():
+                yield frame
+            if watcher.overflowed:
+                self._abort_slow_consumer(watcher, context)
+        finally:
+            self.room_watch.unsubscribe(watcher)
+            self.admission.release_watcher()
+
+    async def Chat(self, request_iterator, context):
+        """聊天双向流RPC"""
+        handler = None
+        user_name = None
+        reader_task = None
+        admitted = False
+        try:
+            # 必须第一个消息是 join_request
+            try:
+                first_message = await request_iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            if not first_message.HasField("join_request"):
+                # 非法连接，直接关闭
+                return
+            admitted = self._admit(context)
+            if not admitted:
+                return
+            join_req = first_message.join_request
+            user_name = join_req.user_name
+            room_id = join_req.room_id
+
+            # 恢复断开前的会话，或校验房间和容量后原子地加入房间
+            handler, success, message, replay, resumed = await self._run_blocking(
+                self._open_session, join_req
+            )
+            yield self._join_response(handler, success, message, resumed)
+            if not success:
+                log.warning(
+                    "user.join_failed",
+                    "用户 {user} 加入房间 {room} 失败: {reason}",
+                    user=user_name,
+                    room=room_id,
+                    reason=message,
+                )
+                return
+            # 历史消息紧跟在加入响应之后、实时消息之前发送
+            for frame in self._replay_frames(replay, join_req.accept_batches):
+                yield frame
+            self._announce_join(handler, len(replay), resumed)
+
+            # 后续消息处理
+            async def process_client_messages():
+                try:
+                    async for client_message in request_iterator:
+                        delay = self._throttle(handler, client_message)
+                        if delay is None:
+                            continue
+                        if delay > 0:
+                            # 暂停读取，HTTP/2 流控会让发送过快的客户端等待
+                            await asyncio.sleep(delay)
+                        if (
+                            client_message.HasField("join_request")
+                            and self.bus is not None
+                        ):
+                            # 多进程和集群模式下加入房间需要等待总线应答；
+                            # 单进程时只回放内存中的历史，且会直接通知房间内的处理器，
+                            # 必须留在事件循环中
+                            keep_reading = await self._run_blocking(
+                                self._handle_client_message, handler, client_message
+                            )
+                        else:
+                            keep_reading = self._handle_client_message(
+                                handler, client_message
+                            )
+                        if not keep_reading:
+                            return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.error(
+                        "chat.read_error", "处理客户端消息时出错: {error}", error=e
+                    )
+
+            reader_task = asyncio.ensure_future(process_client_messages())
+            if join_req.accept_batches and self.batch_delay > 0:
+                async for batch in handler.get_batches(
+                    self.batch_delay, self.batch_max_bytes
+                ):
+                    yield encode_batch(batch)
+            else:
+                async for message in handler.get_messages():
+                    yield message
+            self._finish_stream(handler, context)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error("chat.error", "聊天流异常: {error}", error=e)
+        finally:
+            if reader_task is not None and not reader_task.done():
+                reader_task.cancel()
+            if admitted:
+                self.admission.release()
+            self._handle_stream_closed(handler, user_name)
+
+
+async def serve_async(host: str = "[::]", port: int = 50051, **server_options):
+    """启动 asyncio 模式的聊天服务器
+
+    Args:
+        host: 监听地址，默认为 '[::]'（所有IPv4和IPv6地址）
+        port: 监听端口，默认为 50051
+        **server_options: 传给 AsyncChatServer 的参数
+    """
+    server = grpc.aio.server(options=grpc_server_options(server_options))
+
+    chat_service = AsyncChatServer(**server_options)
+    add_chat_service_to_server(chat_service, server)
+
+    listen_addr = f"{host}:{port}"
+    server.add_insecure_port(listen_addr)
+
+    await server.start()
+    _print_banner(listen_addr, "asyncio")
+
+    # Ctrl+C 和 SIGTERM（滚动重启）都先优雅关闭；不支持信号处理函数的平台上
+    # Ctrl+C 仍以取消本协程的方式立即关闭
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stopping.wait()
+        print("\n⏹️  正在关闭服务器...")
+        chat_service.drain()
+        await server.stop(chat_service.drain_timeout)
+    except asyncio.CancelledError:
+        print("\n⏹️  正在关闭服务器...")
+        await server.stop(0)
+        raise
+    finally:
+        chat_service.close()
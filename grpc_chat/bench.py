@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+无界面的压测工具：模拟大量用户加入房间并按目标速率发送消息
+
+每个模拟用户依次调用 CheckUsername、以 JoinRequest 打开 Chat 流，然后按
+--rate 发送聊天消息。消息正文以发送时刻（time.time_ns）开头，收到后即可
+算出端到端延迟，因此压测工具与服务器之间不需要额外的协议。所有用户共用
+一个事件循环和 --channels 条 HTTP/2 连接。
+
+结果包括发送和投递吞吐、端到端延迟、CheckUsername/加入/离开延迟的分位数，
+以及服务器进程（含子进程）的内存增长；--json 输出机器可读的结果，便于在
+版本之间比较。端到端延迟依赖同一台机器上的时钟，跨机器压测时只有相对
+变化有参考意义。
+
+用法:
+    python -m grpc_chat.bench --users 500 --rooms 10 --rate 2 --duration 30
+    python -m grpc_chat.bench --spawn-server --mode asyncio --json result.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shlex
+import subprocess
+import sys
+import time
+import uuid
+from array import array
+from typing import Any, Dict, List, Optional
+
+import grpc
+
+# 这里IDE可能会因为对chat_pb2和chat_pb2_grpc的import报错，忽略即可
+import chat_pb2  # type: ignore
+import grpc_chat
+from grpc_chat.sdk import AsyncChatClient, AsyncChatSession, JoinError
+from grpc_chat.server import MAX_ROOM_CAPACITY
+
+# 每种延迟最多保留的样本数，超过后按蓄水池抽样替换
+DEFAULT_MAX_SAMPLES = 1_000_000
+
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+
+class LatencyRecorder:
+    """延迟样本（秒），超过上限后按蓄水池抽样保留"""
+
+    def __init__(self, max_samples: int = DEFAULT_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.samples = array("d")
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.max_samples:
+                self.samples[index] = value
+
+    def merge(self, other: "LatencyRecorder"):
+        """并入另一个进程的样本，按各自的总数加权抽样"""
+        count = self.count + other.count
+        if len(self.samples) + len(other.samples) > self.max_samples and count:
+            keep = int(self.max_samples * self.count / count)
+            mine = random.sample(list(self.samples), min(keep, len(self.samples)))
+            theirs = random.sample(
+                list(other.samples),
+                min(self.max_samples - len(mine), len(other.samples)),
+            )
+            self.samples = array("d", mine + theirs)
+        else:
+            self.samples.extend(other.samples)
+        self.count = count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def summary(self) -> Dict[str, Any]:
+        """以毫秒为单位的分位数"""
+        result: Dict[str, Any] = {"count": self.count}
+        if not self.count:
+            return result
+        ordered = sorted(self.samples)
+        for name, quantile in PERCENTILES:
+            index = min(len(ordered) - 1, int(quantile * len(ordered)))
+            result[name] = round(ordered[index] * 1000, 3)
+        result["mean"] = round(self.total / self.count * 1000, 3)
+        result["max"] = round(self.max * 1000, 3)
+        return result
+
+
+def _read_rss(pid: int) -> Optional[int]:
+    """进程的常驻内存字节数，无法读取时返回 None（只支持 Linux）"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _descendants(pid: int) -> List[int]:
+    parents: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # 进程名可能含空格，从最后一个右括号之后解析
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+    result = []
+    pending = [pid]
+    while pending:
+        children = parents.get(pending.pop(), [])
+        result.extend(children)
+        pending.extend(children)
+    return result
+
+
+def server_rss(pid: int) -> Optional[int]:
+    """服务器进程及其所有子进程（多进程模式的工作进程）的常驻内存之和"""
+    total = _read_rss(pid)
+    if total is None:
+        return None
+    for child in _descendants(pid):
+        total += _read_rss(child) or 0
+    return total
+
+
+class SimulatedUser:
+    """一个模拟用户：一个聊天会话、一个读取任务和一个发送任务"""
+
+    def __init__(
+        self,
+        worker: "LoadWorker",
+        client: AsyncChatClient,
+        user_name: str,
+        room_id: str,
+    ):
+        self.worker = worker
+        self.client = client
+        self.user_name = user_name
+        self.room_id = room_id
+        self.session: Optional[AsyncChatSession] = None
+        self.sent = 0
+        self._reader: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def joined(self) -> bool:
+        return self.session is not None
+
+    async def join(self, timeout: float) -> bool:
+        worker = self.worker
+        started = time.perf_counter()
+        response = await self.client.check_username(self.user_name, timeout)
+        worker.check_latency.record(time.perf_counter() - started)
+        if not response.available:
+            return False
+        started = time.perf_counter()
+        try:
+            self.session = await self.client.join(
+                self.user_name,
+                self.room_id,
+                accept_batches=worker.accept_batches,
+                timeout=timeout,
+            )
+        except JoinError:
+            return False
+        worker.join_latency.record(time.perf_counter() - started)
+        self._reader = asyncio.ensure_future(self._read())
+        return True
+
+    async def _read(self):
+        worker = self.worker
+        try:
+            async for event in self.session:
+                if isinstance(event, chat_pb2.BroadcastMessage):
+                    sent_ns, _, _ = event.text.partition(" ")
+                    if sent_ns.isdigit():
+                        worker.record_delivery(time.time_ns() - int(sent_ns))
+                elif isinstance(event, chat_pb2.MessagesDropped):
+                    worker.dropped += event.count
+        except grpc.aio.AioRpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                worker.errors += 1
+
+    async def send(self, rate: float, until: float, padding: str):
+        """按 rate 条/秒发送消息直到 until（loop.time），起始时刻随机错开"""
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / rate
+        next_time = loop.time() + random.random() * interval
+        while next_time < until:
+            delay = next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.session.send(f"{time.time_ns()} {padding}")
+            except (grpc.aio.AioRpcError, asyncio.InvalidStateError):
+                self.worker.errors += 1
+                return
+            self.sent += 1
+            next_time += interval
+
+    async def leave(self, timeout: float):
+        """发送 LeaveRequest，服务器结束该流后记录离开延迟"""
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.session.leave(), timeout)
+        except (grpc.aio.AioRpcError, asyncio.InvalidStateError, asyncio.TimeoutError):
+            self.worker.errors += 1
+            return
+        self.worker.leave_latency.record(time.perf_counter() - started)
+
+    def close(self):
+        if self.session is not None:
+            self.session.cancel()
+
+
+class LoadWorker:
+    """在一个进程中运行部分模拟用户，并统计它们的结果
+
+    多进程压测时各进程通过 barrier 同步：全部加入后同时开始发送，全部
+    收完后再一起离开，避免一个进程的离开通知混入另一个进程的统计。
+    """
+
+    def __init__(self, args: argparse.Namespace, run_id: str, index: int):
+        self.args = args
+        self.run_id = run_id
+        self.index = index
+        self.target = f"{args.host}:{args.port}"
+        self.accept_batches = args.accept_batches
+        samples = max(1, args.max_samples // args.processes)
+        self.e2e_latency = LatencyRecorder(samples)
+        self.check_latency = LatencyRecorder(samples)
+        self.join_latency = LatencyRecorder(samples)
+        self.leave_latency = LatencyRecorder(samples)
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_delivery = 0.0
+
+    def record_delivery(self, latency_ns: int):
+        self.delivered += 1
+        self.last_delivery = time.perf_counter()
+        self.e2e_latency.record(latency_ns / 1e9)
+
+    async def _wait_quiet(self, quiet: float, timeout: float):
+        """等到 quiet 秒内没有新消息到达，或总共等待 timeout 秒"""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if time.perf_counter() - self.last_delivery >= quiet:
+                return
+            await asyncio.sleep(0.1)
+
+    async def run(self, barrier: Any = None) -> Dict[str, Any]:
+        args = self.args
+        loop = asyncio.get_running_loop()
+
+        async def sync():
+            if barrier is not None:
+                await loop.run_in_executor(None, barrier.wait)
+
+        clients = [AsyncChatClient(self.target) for _ in range(args.channels)]
+        # 先建立连接，避免把建连时间计入第一批请求的延迟
+        await asyncio.gather(*(client.wait_ready(args.timeout) for client in clients))
+        users = [
+            SimulatedUser(
+                self,
+                clients[i % len(clients)],
+                f"bench-{self.run_id}-{i}",
+                f"{args.room_prefix}{i % args.rooms}",
+            )
+            for i in range(self.index, args.users, args.processes)
+        ]
+        limit = asyncio.Semaphore(args.join_concurrency)
+
+        async def join(user: SimulatedUser):
+            async with limit:
+                try:
+                    await user.join(args.timeout)
+                except grpc.aio.AioRpcError:
+                    self.errors += 1
+
+        join_started = time.perf_counter()
+        await asyncio.gather(*(join(user) for user in users))
+        join_elapsed = time.perf_counter() - join_started
+        joined = [user for user in users if user.joined]
+        await sync()
+        # 等待加入通知广播完毕，避免与第一批聊天消息混在一起
+        await asyncio.sleep(0.5)
+
+        padding = "x" * max(0, args.message_size - 20)
+        started = time.perf_counter()
+        until = loop.time() + args.duration
+        await asyncio.gather(*(user.send(args.rate, until, padding) for user in joined))
+        send_elapsed = time.perf_counter() - started
+        await self._wait_quiet(1.0, args.drain)
+        deliver_elapsed = max(self.last_delivery - started, send_elapsed)
+        await sync()
+        rss_after = server_rss(args.server_pid) if args.server_pid else None
+
+        limit = asyncio.Semaphore(args.join_concurrency)
+
+        async def leave(user: SimulatedUser):
+            async with limit:
+                await user.leave(args.timeout)
+
+        await asyncio.gather(*(leave(user) for user in joined))
+        for user in users:
+            user.close()
+        for client in clients:
+            await client.close()
+
+        members: Dict[str, int] = {}
+        sent: Dict[str, int] = {}
+        for user in joined:
+            members[user.room_id] = members.get(user.room_id, 0) + 1
+            sent[user.room_id] = sent.get(user.room_id, 0) + user.sent
+        return {
+            "joined": len(joined),
+            "members": members,
+            "sent": sent,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "join_elapsed": join_elapsed,
+            "send_elapsed": send_elapsed,
+            "deliver_elapsed": deliver_elapsed,
+            "rss_after": rss_after,
+            "latency": {
+                "end_to_end": self.e2e_latency,
+                "check_username": self.check_latency,
+                "join": self.join_latency,
+                "leave": self.leave_latency,
+            },
+        }
+
+
+def _merge_counts(parts: List[Dict[str, int]]) -> Dict[str, int]:
+    total: Dict[str, int] = {}
+    for part in parts:
+        for key, value in part.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def merge_results(
+    args: argparse.Namespace, workers: List[Dict[str, Any]], rss_before: Optional[int]
+) -> Dict[str, Any]:
+    """把各进程的统计合并为最终结果"""
+    members = _merge_counts([worker["members"] for worker in workers])
+    sent_by_room = _merge_counts([worker["sent"] for worker in workers])
+    sent = sum(sent_by_room.values())
+    # 服务器把消息发给房间内的所有成员，包括发送者自己
+    expected = sum(count * members[room] for room, count in sent_by_room.items())
+    delivered = sum(worker["delivered"] for worker in workers)
+    send_elapsed = max(worker["send_elapsed"] for worker in workers)
+    deliver_elapsed = max(worker["deliver_elapsed"] for worker in workers)
+    latency = {}
+    for name in workers[0]["latency"]:
+        merged = LatencyRecorder(args.max_samples)
+        for worker in workers:
+            merged.merge(worker["latency"][name])
+        latency[name] = merged.summary()
+    memory = None
+    rss_after = workers[0]["rss_after"]
+    if rss_before is not None and rss_after is not None:
+        memory = {
+            "pid": args.server_pid,
+            "rss_before": rss_before,
+            "rss_after": rss_after,
+            "growth": rss_after - rss_before,
+        }
+    return {
+        "version": grpc_chat.__version__,
+        "timestamp": time.time(),
+        "target": f"{args.host}:{args.port}",
+        "config": {
+            "users": args.users,
+            "rooms": args.rooms,
+            "rate": args.rate,
+            "duration": args.duration,
+            "message_size": args.message_size,
+            "channels": args.channels,
+            "processes": args.processes,
+            "accept_batches": args.accept_batches,
+            "server_mode": args.mode if args.spawn_server else None,
+        },
+        "users": {
+            "requested": args.users,
+            "joined": sum(worker["joined"] for worker in workers),
+            "join_seconds": round(max(w["join_elapsed"] for w in workers), 3),
+        },
+        "messages": {
+            "sent": sent,
+            "expected": expected,
+            "delivered": delivered,
+            "delivery_ratio": round(delivered / expected, 6) if expected else None,
+            "dropped_notified": sum(worker["dropped"] for worker in workers),
+        },
+        "throughput": {
+            "sent_per_sec": round(sent / send_elapsed, 1),
+            "delivered_per_sec": round(delivered / deliver_elapsed, 1),
+        },
+        "latency_ms": latency,
+        "server_memory": memory,
+        "errors": sum(worker["errors"] for worker in workers),
+    }
+
+
+def _format_latency(summary: Dict[str, Any]) -> str:
+    if not summary["count"]:
+        return "无样本"
+    return (
+        f"p50 {summary['p50']:.2f} / p99 {summary['p99']:.2f} / "
+        f"p999 {summary['p999']:.2f} / max {summary['max']:.2f} ms "
+        f"({summary['count']} 个样本)"
+    )
+
+
+def print_report(result: Dict[str, Any]):
+    """打印便于阅读的结果摘要"""
+    users = result["users"]
+    messages = result["messages"]
+    throughput = result["throughput"]
+    latency = result["latency_ms"]
+    print(f"目标服务器: {result['target']}")
+    print(
+        f"用户: {users['joined']}/{users['requested']} 加入成功，"
+        f"耗时 {users['join_seconds']:.2f} 秒"
+    )
+    ratio = messages["delivery_ratio"]
+    print(
+        f"消息: 发送 {messages['sent']} 条，投递 {messages['delivered']}/"
+        f"{messages['expected']} 条"
+        + (f" ({ratio:.2%})" if ratio is not None else "")
+        + f"，收到丢弃通知 {messages['dropped_notified']} 条"
+    )
+    print(
+        f"吞吐: 发送 {throughput['sent_per_sec']:,.0f} 条/秒，"
+        f"投递 {throughput['delivered_per_sec']:,.0f} 条/秒"
+    )
+    print(f"端到端延迟: {_format_latency(latency['end_to_end'])}")
+    print(f"用户名校验: {_format_latency(latency['check_username'])}")
+    print(f"加入房间:   {_format_latency(latency['join'])}")
+    print(f"离开房间:   {_format_latency(latency['leave'])}")
+    memory = result["server_memory"]
+    if memory is not None:
+        print(
+            f"服务器内存: {memory['rss_before'] / 2**20:.1f} MiB -> "
+            f"{memory['rss_after'] / 2**20:.1f} MiB "
+            f"({memory['growth'] / 2**20:+.1f} MiB)"
+        )
+    if result["errors"]:
+        print(f"错误: {result['errors']} 次")
+
+
+def _spawn_server(args: argparse.Namespace) -> subprocess.Popen:
+    command = [
+        sys.executable,
+        "-m",
+        "grpc_chat.start_server",
+        "--host",
+        args.host,
+        "--port",
+        str(args.port),
+        "--mode",
+        args.mode,
+        "--log-level",
+        "warning",
+    ] + shlex.split(args.server_args)
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+
+async def _prepare_rooms(args: argparse.Namespace):
+    """等待服务器就绪并创建压测房间"""
+    async with AsyncChatClient(f"{args.host}:{args.port}") as client:
+        await client.wait_ready(args.timeout)
+        capacity = -(-args.users // args.rooms)
+        for i in range(args.rooms):
+            await client.create_room(
+                f"{args.room_prefix}{i}", capacity, timeout=args.timeout
+            )
+
+
+async def _delete_rooms(args: argparse.Namespace):
+    async with AsyncChatClient(f"{args.host}:{args.port}") as client:
+        for i in range(args.rooms):
+            try:
+                await client.delete_room(f"{args.room_prefix}{i}", args.timeout)
+            except grpc.aio.AioRpcError:
+                pass
+
+
+def _worker_main(args, run_id: str, index: int, barrier, results):
+    results.put(asyncio.run(LoadWorker(args, run_id, index).run(barrier)))
+
+
+def _run_processes(args: argparse.Namespace, run_id: str) -> List[Dict[str, Any]]:
+    """在 args.processes 个子进程中运行模拟用户，任一进程异常退出时终止全部"""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.processes)
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=_worker_main,
+            args=(args, run_id, index, barrier, results),
+            name=f"chat-bench-{index}",
+        )
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    workers: List[Dict[str, Any]] = []
+    try:
+        while len(workers) < len(processes):
+            try:
+                workers.append(results.get(timeout=1.0))
+            except queue.Empty:
+                if any(process.exitcode for process in processes):
+                    raise RuntimeError("压测子进程异常退出")
+    finally:
+        for process in processes:
+            if process.is_alive() and len(workers) < len(processes):
+                process.terminate()
+            process.join()
+    return workers
+
+
+def run_bench(args: argparse.Namespace) -> Dict[str, Any]:
+    """运行一次压测并返回结果，--spawn-server 时负责启动和停止服务器"""
+    server = _spawn_server(args) if args.spawn_server else None
+    if server is not None:
+        args.server_pid = server.pid
+    try:
+        asyncio.run(_prepare_rooms(args))
+        rss_before = server_rss(args.server_pid) if args.server_pid else None
+        run_id = uuid.uuid4().hex[:8]
+        if args.processes == 1:
+            workers = [asyncio.run(LoadWorker(args, run_id, 0).run())]
+        else:
+            workers = _run_processes(args, run_id)
+        asyncio.run(_delete_rooms(args))
+        return merge_results(args, workers, rss_before)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天服务器压测工具")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="服务器地址")
+    parser.add_argument("--port", type=int, default=50051, help="服务器端口")
+    parser.add_argument("--users", type=int, default=100, help="模拟用户数")
+    parser.add_argument("--rooms", type=int, default=10, help="房间数")
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="每个用户每秒发送的消息数"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="发送阶段持续的秒数"
+    )
+    parser.add_argument(
+        "--message-size", type=int, default=100, help="每条消息正文的字节数"
+    )
+    parser.add_argument(
+        "--channels", type=int, default=8, help="模拟用户共用的 gRPC 连接数"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="运行模拟用户的进程数，单个进程的接收能力不足时增加",
+    )
+    parser.add_argument(
+        "--join-concurrency",
+        type=int,
+        default=100,
+        help="每个进程中同时进行的加入和离开数",
+    )
+    parser.add_argument(
+        "--accept-batches",
+        action="store_true",
+        help="在加入请求中声明支持批量消息",
+    )
+    parser.add_argument(
+        "--room-prefix", type=str, default="bench-", help="压测创建的房间ID前缀"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10.0, help="单次请求的超时秒数"
+    )
+    parser.add_argument(
+        "--drain",
+        type=float,
+        default=10.0,
+        help="发送结束后最多等待未到达消息的秒数",
+    )
+    parser.add_argument(
+        "--max-samples",
+        type=int,
+        default=DEFAULT_MAX_SAMPLES,
+        help="每种延迟最多保留的样本数",
+    )
+    parser.add_argument(
+        "--server-pid",
+        type=int,
+        default=None,
+        help="服务器进程号，用于统计内存增长（只支持 Linux）",
+    )
+    parser.add_argument(
+        "--spawn-server",
+        action="store_true",
+        help="由压测工具在 --host/--port 上启动服务器，结束后停止",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=("thread", "asyncio"),
+        default="asyncio",
+        help="--spawn-server 时的服务器模式 (默认: asyncio)",
+    )
+    parser.add_argument(
+        "--server-args",
+        type=str,
+        default="",
+        help="--spawn-server 时传给服务器的其他参数，如 '--workers 4'",
+    )
+    parser.add_argument(
+        "--json", type=str, default=None, help="把结果写入该 JSON 文件，'-' 为标准输出"
+    )
+    args = parser.parse_args()
+    if min(args.users, args.rooms, args.channels, args.processes) < 1:
+        parser.error("--users、--rooms、--channels、--processes 至少为 1")
+    if args.rate <= 0:
+        parser.error("--rate 必须大于 0")
+    if -(-args.users // args.rooms) > MAX_ROOM_CAPACITY:
+        parser.error(f"每个房间最多 {MAX_ROOM_CAPACITY} 人，请增加 --rooms")
+
+    result = run_bench(args)
+    if args.json == "-":
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,781 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+房间总线：多进程和集群模式下的全局状态协调
+
+RoomAuthority 是一组房间的唯一权威：用户名、房间成员、房间的增删、
+每个房间的消息序号和回放历史都由它决定，再按同一顺序发给各个连接方；
+连接方（工作进程或集群节点）只负责把收到的事件分发给本地的连接。
+广播所需的编码在权威方只做一次，真正耗时的逐连接发送分散在各个连接方。
+聊天消息只发给在该房间中有成员的连接方，房间状态则发给所有连接方。
+套接字两端的发送都先放入有界队列，由专门的线程合并后写出，权威方不会在
+持有锁时、工作进程也不会在事件循环中阻塞于 sendall。
+
+多进程模式下权威方是启动器进程中的 BusHub，工作进程通过 Unix 域套接字
+连接；集群模式下每个节点是自己所拥有房间的权威方，见 cluster.py。
+
+帧格式：4 字节正文长度 + 1 字节类型，正文由若干个（4 字节长度 + 内容）
+字段组成。整数和布尔值以十进制文本表示。
+"""
+
+import itertools
+import os
+import queue
+import socket
+import struct
+import threading
+from collections import deque
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from grpc_chat import log
+from grpc_chat.leases import DEFAULT_LEASE_TTL, LeaseTable
+from grpc_chat.rooms import DEFAULT_HISTORY_SIZE, select_history
+from grpc_chat.wire import encode_chat_message, encode_user_joined, encode_user_left
+
+# 连接方 -> 权威方
+BUS_CLAIM_USER = 1  # 请求号, 用户名
+BUS_RELEASE_USER = 2  # 用户名, 是否是已加入房间的聊天流结束
+BUS_JOIN = 3  # 请求号, 房间, 用户名, 回放最近 N 条, 回放起点序号（-1 表示不用）
+BUS_LEAVE = 4  # 房间, 用户名
+BUS_PUBLISH = 5  # 房间, 发送者, 内容, 时间戳
+BUS_CREATE_ROOM = 6  # 请求号, 房间, 容量
+BUS_DELETE_ROOM = 7  # 请求号, 房间
+BUS_REJOIN = 8  # 房间, 用户名, 容量, 最后序号（房间换了权威方后重新登记成员）
+BUS_CONFIRM_USER = 9  # 用户名, 新加入房间的聊天流数
+
+# 权威方 -> 连接方
+BUS_REPLY = 20  # 请求号, 是否成功, 附加值, 回放消息...
+BUS_DELIVER = 21  # 房间, 序号（0 表示不计入历史的通知）, 预编码消息, 排除的用户名
+BUS_ROOM_STATE = 22  # 房间, 容量, 在线人数, 最后序号
+BUS_ROOM_DELETED = 23  # 房间
+
+# 失败应答的附加值
+REASON_MISSING = "missing"
+REASON_FULL = "full"
+REASON_EXISTS = "exists"
+
+# 等待总线应答的最长秒数
+REQUEST_TIMEOUT = 5.0
+
+# 每个套接字连接的发送队列最多缓存的帧数，超过时断开该连接
+SEND_QUEUE_SIZE = 65536
+
+# 一次写出的合并帧的大致上限（字节）
+SEND_BATCH_MAX_BYTES = 64 * 1024
+
+_FRAME_HEADER = struct.Struct("!IB")
+_FIELD_HEADER = struct.Struct("!I")
+
+Field = Union[bytes, str, int]
+
+
+def encode_frame(kind: int, *fields: Field) -> bytes:
+    """编码一帧"""
+    parts = []
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode("utf-8")
+        elif isinstance(field, int):
+            field = str(int(field)).encode("ascii")
+        parts.append(_FIELD_HEADER.pack(len(field)))
+        parts.append(field)
+    body = b"".join(parts)
+    return _FRAME_HEADER.pack(len(body), kind) + body
+
+
+def _decode_fields(body: bytes) -> List[bytes]:
+    fields = []
+    offset = 0
+    while offset < len(body):
+        (size,) = _FIELD_HEADER.unpack_from(body, offset)
+        offset += _FIELD_HEADER.size
+        fields.append(body[offset : offset + size])
+        offset += size
+    return fields
+
+
+def decode_frame(frame: bytes) -> Tuple[int, List[bytes]]:
+    """解码一个完整的帧"""
+    length, kind = _FRAME_HEADER.unpack_from(frame)
+    body = frame[_FRAME_HEADER.size : _FRAME_HEADER.size + length]
+    return kind, _decode_fields(body)
+
+
+def decode_frames(data: bytes) -> Iterator[Tuple[int, List[bytes]]]:
+    """依次解码首尾相接的若干个完整的帧"""
+    offset = 0
+    while offset < len(data):
+        length, kind = _FRAME_HEADER.unpack_from(data, offset)
+        offset += _FRAME_HEADER.size
+        yield kind, _decode_fields(data[offset : offset + length])
+        offset += length
+
+
+def read_frame(stream: BinaryIO) -> Optional[Tuple[int, List[bytes]]]:
+    """读取一帧，连接关闭时返回 None"""
+    header = stream.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        return None
+    length, kind = _FRAME_HEADER.unpack(header)
+    body = stream.read(length)
+    if len(body) < length:
+        return None
+    return kind, _decode_fields(body)
+
+
+def coalesce_frames(
+    outgoing: "queue.Queue[Optional[bytes]]", max_bytes: int = SEND_BATCH_MAX_BYTES
+) -> Iterator[bytes]:
+    """把队列中已有的帧合并为一段数据，直到取到 None 为止"""
+    while True:
+        frame = outgoing.get()
+        if frame is None:
+            return
+        frames = [frame]
+        size = len(frame)
+        while size < max_bytes:
+            try:
+                frame = outgoing.get_nowait()
+            except queue.Empty:
+                break
+            if frame is None:
+                yield b"".join(frames)
+                return
+            frames.append(frame)
+            size += len(frame)
+        yield b"".join(frames)
+
+
+class _FrameWriter:
+    """套接字的发送队列，由一个线程合并已排队的帧后写出
+
+    put 不会阻塞；队列满说明对端长时间不读，此时关闭套接字，由读取方
+    按连接断开处理。
+    """
+
+    def __init__(self, sock: socket.socket, name: str):
+        self._sock = sock
+        self._outgoing: "queue.Queue[Optional[bytes]]" = queue.Queue(SEND_QUEUE_SIZE)
+        self.overflowed = False
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def put(self, frame: bytes):
+        try:
+            self._outgoing.put_nowait(frame)
+        except queue.Full:
+            if not self.overflowed:
+                self.overflowed = True
+                log.error(
+                    "bus.overflow",
+                    "房间总线的发送队列已满（{size} 帧），断开连接",
+                    size=SEND_QUEUE_SIZE,
+                )
+                self.shutdown()
+
+    def shutdown(self):
+        """关闭套接字的读写，唤醒阻塞中的读取和发送"""
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self._outgoing.put_nowait(None)
+        except queue.Full:
+            # 发送线程会因套接字已关闭而退出
+            pass
+
+    def _run(self):
+        try:
+            for data in coalesce_frames(self._outgoing):
+                self._sock.sendall(data)
+        except OSError:
+            # 读取方会发现连接已断开并负责清理
+            pass
+
+
+class BusConnection:
+    """权威方一侧的一个连接方，由具体的传输方式实现 send"""
+
+    def __init__(self):
+        # 该连接方占用的用户名和房间成员，连接断开时统一释放
+        self.users: Set[str] = set()
+        self.memberships: Set[Tuple[str, str]] = set()
+
+    def send(self, frame: bytes):
+        raise NotImplementedError
+
+
+class _AuthorityRoom:
+    def __init__(self, max_capacity: int, history_size: int, last_sequence: int = 0):
+        self.max_capacity = max_capacity
+        # 用户名 -> 该成员所在的连接方
+        self.members: Dict[str, BusConnection] = {}
+        # 连接方 -> 它在该房间中的成员数，聊天消息只发给这些连接方
+        self.connections: Dict[BusConnection, int] = {}
+        self.last_sequence = last_sequence
+        # 最近消息 [(序号, 预编码消息)]，加入时由权威方回放
+        self.history: Deque[Tuple[int, bytes]] = deque(maxlen=history_size)
+
+    def add_member(self, user_name: str, conn: BusConnection):
+        self.remove_member(user_name)
+        self.members[user_name] = conn
+        self.connections[conn] = self.connections.get(conn, 0) + 1
+
+    def remove_member(self, user_name: str) -> Optional[BusConnection]:
+        conn = self.members.pop(user_name, None)
+        if conn is not None:
+            remaining = self.connections[conn] - 1
+            if remaining:
+                self.connections[conn] = remaining
+            else:
+                del self.connections[conn]
+        return conn
+
+
+class RoomAuthority:
+    """一组房间的权威状态，与传输方式无关
+
+    所有状态修改和发送都在同一把锁内完成，因此每个连接方看到的事件顺序
+    与权威方处理的顺序完全一致；send 只能入队，不能阻塞。
+    """
+
+    def __init__(
+        self,
+        rooms: Dict[str, int],
+        history_size: int = DEFAULT_HISTORY_SIZE,
+        username_ttl: float = DEFAULT_LEASE_TTL,
+    ):
+        """
+        Args:
+            rooms: 初始房间 {房间ID: 容量}
+            history_size: 每个房间保留的历史消息条数
+            username_ttl: 用户名预留在确认前的有效期（秒）
+        """
+        self.history_size = history_size
+        self._rooms = {
+            room_id: _AuthorityRoom(capacity, history_size)
+            for room_id, capacity in rooms.items()
+        }
+        # 用户名租约，owner 为占用它的连接方
+        self._users = LeaseTable(username_ttl)
+        self._connections: List[BusConnection] = []
+        self._lock = threading.Lock()
+
+    def room_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._rooms)
+
+    def has_room(self, room_id: str) -> bool:
+        return room_id in self._rooms
+
+    def connect(self, conn: BusConnection):
+        """登记新的连接方：先同步当前所有房间的状态，再开始接收事件"""
+        with self._lock:
+            for room_id, room in self._rooms.items():
+                conn.send(self._room_state_frame(room_id, room))
+            self._connections.append(conn)
+
+    def disconnect(self, conn: BusConnection):
+        """连接方断开：释放它占用的用户名和房间成员"""
+        with self._lock:
+            if conn not in self._connections:
+                return
+            self._connections.remove(conn)
+            for room_id, user_name in list(conn.memberships):
+                self._leave(conn, room_id, user_name)
+            for user_name in conn.users:
+                self._users.drop(user_name)
+            conn.users.clear()
+
+    def connection_count(self) -> int:
+        return len(self._connections)
+
+    def adopt_room(self, room_id: str, max_capacity: int, last_sequence: int):
+        """接管房间，序号从 last_sequence 继续（房间已存在时只会推进序号）"""
+        with self._lock:
+            self._adopt(room_id, max_capacity, last_sequence)
+
+    def drop_room(self, room_id: str):
+        """交出房间的权威，不通知连接方，由新的权威方接管"""
+        with self._lock:
+            room = self._rooms.pop(room_id, None)
+            if room is None:
+                return
+            for user_name, conn in room.members.items():
+                conn.memberships.discard((room_id, user_name))
+
+    def drop_user(self, user_name: str):
+        """交出用户名的权威"""
+        with self._lock:
+            self._forget_user(user_name, self._users.drop(user_name))
+
+    def user_names(self) -> List[str]:
+        with self._lock:
+            return self._users.names()
+
+    def handle(self, conn: BusConnection, kind: int, fields: List[str]):
+        """处理连接方发来的一帧"""
+        with self._lock:
+            self._handle(conn, kind, fields)
+
+    def _handle(self, conn: BusConnection, kind: int, fields: List[str]):
+        """调用时已持有锁"""
+        if kind == BUS_PUBLISH:
+            room_id, sender, text, timestamp = fields
+            room = self._rooms.get(room_id)
+            if room is not None:
+                room.last_sequence += 1
+                sequence = room.last_sequence
+                payload = encode_chat_message(
+                    room_id, sender, text, int(timestamp), sequence
+                )
+                room.history.append((sequence, payload))
+                self._deliver(
+                    room, encode_frame(BUS_DELIVER, room_id, sequence, payload, "")
+                )
+        elif kind == BUS_JOIN:
+            request_id, room_id, user_name, replay_last, replay_since = fields
+            room = self._rooms.get(room_id)
+            if room is None:
+                self._reply(conn, request_id, False, REASON_MISSING)
+            elif (
+                user_name not in room.members and len(room.members) >= room.max_capacity
+            ):
+                self._reply(conn, request_id, False, REASON_FULL)
+            else:
+                room.add_member(user_name, conn)
+                conn.memberships.add((room_id, user_name))
+                count = len(room.members)
+                self._broadcast(self._room_state_frame(room_id, room))
+                self._deliver(
+                    room,
+                    encode_frame(
+                        BUS_DELIVER,
+                        room_id,
+                        0,
+                        encode_user_joined(room_id, user_name, count),
+                        user_name,
+                    ),
+                )
+                since = int(replay_since)
+                replay = select_history(
+                    room.history, int(replay_last), since if since >= 0 else None
+                )
+                self._reply(conn, request_id, True, count, *replay)
+        elif kind == BUS_LEAVE:
+            room_id, user_name = fields
+            if (room_id, user_name) in conn.memberships:
+                self._leave(conn, room_id, user_name)
+        elif kind == BUS_CLAIM_USER:
+            request_id, user_name = fields
+            for name, owner in self._users.expire():
+                self._forget_user(name, owner)
+            available = self._users.reserve(user_name, conn)
+            if available:
+                conn.users.add(user_name)
+            self._reply(conn, request_id, available)
+        elif kind == BUS_CONFIRM_USER:
+            user_name, count = fields
+            if user_name not in self._users:
+                conn.users.add(user_name)
+            self._users.confirm(user_name, conn, int(count))
+        elif kind == BUS_RELEASE_USER:
+            # 同一客户端的不同 RPC 可能落在不同的连接方上，按用户名释放
+            user_name, joined = fields
+            if joined == "1":
+                owner = self._users.release(user_name)
+            else:
+                owner = self._users.discard(user_name)
+            self._forget_user(user_name, owner)
+        elif kind == BUS_CREATE_ROOM:
+            request_id, room_id, max_capacity = fields
+            if room_id in self._rooms:
+                self._reply(conn, request_id, False, REASON_EXISTS)
+            else:
+                self._adopt(room_id, int(max_capacity), 0)
+                self._reply(conn, request_id, True)
+        elif kind == BUS_DELETE_ROOM:
+            request_id, room_id = fields
+            room = self._rooms.get(room_id)
+            if room is None:
+                self._reply(conn, request_id, False, REASON_MISSING)
+            elif room.members:
+                self._reply(conn, request_id, False, len(room.members))
+            else:
+                del self._rooms[room_id]
+                self._broadcast(encode_frame(BUS_ROOM_DELETED, room_id))
+                self._reply(conn, request_id, True)
+        elif kind == BUS_REJOIN:
+            room_id, user_name, max_capacity, last_sequence = fields
+            room = self._adopt(room_id, int(max_capacity), int(last_sequence))
+            room.add_member(user_name, conn)
+            conn.memberships.add((room_id, user_name))
+            self._broadcast(self._room_state_frame(room_id, room))
+        else:
+            log.warning(
+                "bus.unknown_frame", "房间总线收到未知类型的帧: {kind}", kind=kind
+            )
+
+    def _forget_user(self, user_name: str, owner: Optional[BusConnection]):
+        """用户名租约被移除后，从原连接方的记录中去掉"""
+        if owner is not None:
+            owner.users.discard(user_name)
+
+    def _adopt(
+        self, room_id: str, max_capacity: int, last_sequence: int
+    ) -> _AuthorityRoom:
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = _AuthorityRoom(max_capacity, self.history_size, last_sequence)
+            self._rooms[room_id] = room
+            self._broadcast(self._room_state_frame(room_id, room))
+        elif last_sequence > room.last_sequence:
+            # 交接期间各方记录的序号可能不同，以最大的为准，保证序号不回退
+            room.last_sequence = last_sequence
+        return room
+
+    def _leave(self, conn: BusConnection, room_id: str, user_name: str):
+        conn.memberships.discard((room_id, user_name))
+        room = self._rooms.get(room_id)
+        if room is None or room.members.get(user_name) is not conn:
+            return
+        room.remove_member(user_name)
+        count = len(room.members)
+        self._broadcast(self._room_state_frame(room_id, room))
+        self._deliver(
+            room,
+            encode_frame(
+                BUS_DELIVER,
+                room_id,
+                0,
+                encode_user_left(room_id, user_name, count),
+                "",
+            ),
+        )
+
+    def _room_state_frame(self, room_id: str, room: _AuthorityRoom) -> bytes:
+        return encode_frame(
+            BUS_ROOM_STATE,
+            room_id,
+            room.max_capacity,
+            len(room.members),
+            room.last_sequence,
+        )
+
+    def _reply(
+        self, conn: BusConnection, request_id: str, success: bool, *values: Field
+    ):
+        conn.send(encode_frame(BUS_REPLY, request_id, success, *(values or ("",))))
+
+    def _deliver(self, room: _AuthorityRoom, frame: bytes):
+        """发给在该房间中有成员的连接方"""
+        for conn in room.connections:
+            conn.send(frame)
+
+    def _broadcast(self, frame: bytes):
+        """发给所有连接方"""
+        for conn in self._connections:
+            conn.send(frame)
+
+
+class _SocketConnection(BusConnection):
+    """总线上的一个工作进程连接"""
+
+    def __init__(self, sock: socket.socket):
+        super().__init__()
+        self.sock = sock
+        self.writer = _FrameWriter(sock, "chat-bus-send")
+
+    def send(self, frame: bytes):
+        self.writer.put(frame)
+
+
+class BusHub(RoomAuthority):
+    """多进程模式的房间总线，运行在启动器进程中
+
+    每个工作进程连接由一个线程读取。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        rooms: Dict[str, int],
+        history_size: int = DEFAULT_HISTORY_SIZE,
+        username_ttl: float = DEFAULT_LEASE_TTL,
+    ):
+        """
+        Args:
+            path: Unix 域套接字路径
+            rooms: 初始房间 {房间ID: 容量}
+            history_size: 每个房间保留的历史消息条数
+            username_ttl: 用户名预留在确认前的有效期（秒）
+        """
+        super().__init__(rooms, history_size, username_ttl)
+        self.path = path
+        self._listener: Optional[socket.socket] = None
+
+    def start(self):
+        """开始监听工作进程连接"""
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        listener.listen()
+        self._listener = listener
+        threading.Thread(
+            target=self._accept_loop, name="chat-bus-accept", daemon=True
+        ).start()
+        log.info("bus.start", "房间总线已启动: {path}", path=self.path)
+
+    def close(self):
+        """停止监听"""
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            conn = _SocketConnection(sock)
+            self.connect(conn)
+            threading.Thread(
+                target=self._serve_connection,
+                args=(conn,),
+                name="chat-bus-conn",
+                daemon=True,
+            ).start()
+
+    def _serve_connection(self, conn: _SocketConnection):
+        stream = conn.sock.makefile("rb")
+        try:
+            while True:
+                frame = read_frame(stream)
+                if frame is None:
+                    break
+                kind, fields = frame
+                self.handle(conn, kind, [field.decode("utf-8") for field in fields])
+        except ConnectionError:
+            # 工作进程退出
+            pass
+        except OSError as e:
+            log.error("bus.connection_error", "房间总线连接异常: {error}", error=e)
+        finally:
+            self.disconnect(conn)
+            conn.writer.shutdown()
+            conn.sock.close()
+            log.warning(
+                "bus.disconnect",
+                "工作进程与房间总线断开，剩余 {remaining} 个",
+                remaining=self.connection_count(),
+            )
+
+
+class BusEndpoint:
+    """连接方一侧的总线接口，由具体的传输方式实现 _send_frame
+
+    请求类操作（占用用户名、加入、建删房间）同步等待应答，其余操作只发送
+    不等待。收到的事件通过 dispatch(on_event, kind, fields) 交给使用方，由
+    dispatch 决定事件在哪个线程中处理，同一连接上的事件保持到达顺序。
+    """
+
+    def __init__(
+        self,
+        dispatch: Callable[..., Any],
+        on_event: Callable[[int, List[bytes]], Any],
+    ):
+        self._dispatch = dispatch
+        self._on_event = on_event
+        # 请求号 -> (唤醒事件, 应答字段, 成功后以应答的值和其余字段调用的回调)
+        self._pending: Dict[
+            int,
+            Tuple[
+                threading.Event,
+                List[bytes],
+                Optional[Callable[[str, List[bytes]], Any]],
+            ],
+        ] = {}
+        self._request_ids = itertools.count(1)
+
+    def claim_user(self, user_name: str) -> bool:
+        """预留全局唯一的用户名，确认前有有效期"""
+        success, _, _ = self._request(BUS_CLAIM_USER, user_name)
+        return success
+
+    def confirm_user(self, user_name: str, count: int = 1):
+        """count 个聊天流加入了房间，用户名不再过期；不等待应答
+
+        用户名换了权威方后也用它重新登记仍在使用的用户名。
+        """
+        self._send(BUS_CONFIRM_USER, user_name, count)
+
+    def release_user(self, user_name: str, joined: bool = False):
+        self._send(BUS_RELEASE_USER, user_name, joined)
+
+    def join(
+        self,
+        room_id: str,
+        user_name: str,
+        replay_last: int = 0,
+        replay_since: Optional[int] = None,
+        on_joined: Optional[Callable[[str, List[bytes]], Any]] = None,
+    ) -> Tuple[bool, str, List[bytes]]:
+        """加入房间
+
+        Args:
+            on_joined: 加入成功时以 (加入后的人数, 需要回放的预编码消息) 调用，
+                与该房间的事件按同一顺序执行，用于在本地登记连接，保证回放与
+                实时消息之间既不重复也不遗漏
+
+        Returns:
+            (是否成功, 成功时为加入后的人数、失败时为原因, 需要回放的预编码消息)
+        """
+        since = -1 if replay_since is None else replay_since
+        return self._request(
+            BUS_JOIN, room_id, user_name, replay_last, since, on_success=on_joined
+        )
+
+    def rejoin(
+        self, room_id: str, user_name: str, max_capacity: int, last_sequence: int
+    ):
+        """房间换了权威方后重新登记成员"""
+        self._send(BUS_REJOIN, room_id, user_name, max_capacity, last_sequence)
+
+    def leave(self, room_id: str, user_name: str):
+        self._send(BUS_LEAVE, room_id, user_name)
+
+    def publish(self, room_id: str, sender: str, text: str, timestamp: int):
+        self._send(BUS_PUBLISH, room_id, sender, text, timestamp)
+
+    def create_room(self, room_id: str, max_capacity: int) -> Tuple[bool, str]:
+        success, value, _ = self._request(BUS_CREATE_ROOM, room_id, max_capacity)
+        return success, value
+
+    def delete_room(self, room_id: str) -> Tuple[bool, str]:
+        """
+        Returns:
+            (是否成功, 失败时为原因或房间中剩余的人数)
+        """
+        success, value, _ = self._request(BUS_DELETE_ROOM, room_id)
+        return success, value
+
+    def close(self):
+        pass
+
+    def _send(self, kind: int, *fields: Field):
+        self._send_frame(encode_frame(kind, *fields))
+
+    def _send_frame(self, frame: bytes):
+        raise NotImplementedError
+
+    def _request(
+        self,
+        kind: int,
+        *fields: Field,
+        on_success: Optional[Callable[[str, List[bytes]], Any]] = None,
+    ) -> Tuple[bool, str, List[bytes]]:
+        request_id = next(self._request_ids)
+        done = threading.Event()
+        reply: List[bytes] = []
+        self._pending[request_id] = (done, reply, on_success)
+        try:
+            self._send(kind, request_id, *fields)
+            if not done.wait(REQUEST_TIMEOUT):
+                raise ConnectionError("房间总线无应答")
+        finally:
+            self._pending.pop(request_id, None)
+        if not reply:
+            raise ConnectionError("与房间总线的连接已断开")
+        success, value, *extra = reply
+        return success == b"1", value.decode("utf-8"), extra
+
+    def _handle_frame(self, kind: int, fields: List[bytes]):
+        """处理收到的一帧（在读取线程中调用）"""
+        if kind != BUS_REPLY:
+            self._dispatch(self._on_event, kind, fields)
+            return
+        pending = self._pending.get(int(fields[0]))
+        if pending is None:
+            return
+        done, reply, on_success = pending
+        reply.extend(fields[1:])
+        if on_success is not None and fields[1] == b"1":
+            # 与之前的事件按同一顺序执行，执行完才唤醒等待方
+            self._dispatch(self._complete, done, on_success, fields[2:])
+        else:
+            done.set()
+
+    def _complete(
+        self,
+        done: threading.Event,
+        on_success: Callable[[str, List[bytes]], Any],
+        fields: List[bytes],
+    ):
+        try:
+            on_success(fields[0].decode("utf-8"), fields[1:])
+        finally:
+            done.set()
+
+    def _fail_pending(self):
+        """连接断开时让所有等待中的请求立即失败"""
+        for done, _, _ in list(self._pending.values()):
+            done.set()
+
+
+class BusClient(BusEndpoint):
+    """工作进程一侧的总线连接（Unix 域套接字）
+
+    发送只入队，可以在 asyncio 事件循环中直接调用不等待应答的操作。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dispatch: Callable[..., Any],
+        on_event: Callable[[int, List[bytes]], Any],
+    ):
+        super().__init__(dispatch, on_event)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._writer = _FrameWriter(self._sock, "chat-bus-send")
+        self._closed = False
+        self._reader = threading.Thread(
+            target=self._read_loop, name="chat-bus", daemon=True
+        )
+        self._reader.start()
+
+    def close(self):
+        self._closed = True
+        self._writer.shutdown()
+        self._sock.close()
+
+    def _send_frame(self, frame: bytes):
+        self._writer.put(frame)
+
+    def _read_loop(self):
+        stream = self._sock.makefile("rb")
+        try:
+            while True:
+                frame = read_frame(stream)
+                if frame is None:
+                    break
+                self._handle_frame(*frame)
+        except OSError:
+            pass
+        self._writer.shutdown()
+        self._fail_pending()
+        if not self._closed:
+            log.error("bus.lost", "与房间总线的连接已断开")
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+客户端本地消息缓存
+
+把收到的 BroadcastMessage 按 (服务器, 房间, 序号) 存入 SQLite。再次进入
+房间时先从缓存显示最近的消息，加入请求只需 replay_since 最后一条缓存的
+序号，服务器只补发离开期间的新消息。
+
+数据库使用 WAL 模式，读取不会被写入阻塞：收到消息时只放入队列，由后台
+线程一次取出所有待写消息，在一个事务中写入（组提交），再按总字节数淘汰
+最早写入的消息。缓存只是加速，任何 SQLite 错误都只记录日志，不影响聊天。
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from typing import Any, List, Tuple
+
+# 这里IDE可能会因为对chat_pb2和chat_pb2_grpc的import报错，忽略即可
+import chat_pb2  # type: ignore
+
+from grpc_chat import log
+
+# 缓存中消息的总字节数上限，超出后淘汰最早写入的消息，直到低于上限的 90%
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+# 写线程一次事务最多写入的消息数
+MAX_BATCH = 1024
+
+_ADD = 0
+_FORGET = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    server TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    sequence INTEGER NOT NULL,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (server, room_id, sequence)
+)
+"""
+
+
+def default_cache_path() -> str:
+    """按 XDG 约定放在用户缓存目录下"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "grpc-chat", "messages.sqlite3")
+
+
+class MessageCache:
+    """按服务器和房间缓存聊天消息
+
+    Args:
+        path: 数据库文件路径
+        max_bytes: 消息总字节数上限
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 读取连接可能在 GUI 线程和加入房间的线程中使用，由锁串行化
+        self._reader = self._connect()
+        self._reader_lock = threading.Lock()
+        self._queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._writer = threading.Thread(
+            target=self._run, name="message-cache-writer", daemon=True
+        )
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 只在检查点时 fsync，断电最多丢失最近的缓存
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(_SCHEMA)
+        connection.commit()
+        return connection
+
+    def add(self, server: str, room_id: str, message: "chat_pb2.BroadcastMessage"):
+        """缓存一条消息，只入队不等待写入，可在会话的读取线程中调用"""
+        # 写线程因无法打开数据库退出后不再积压
+        if message.sequence > 0 and self._writer.is_alive():
+            payload = message.SerializeToString()
+            self._queue.put((_ADD, (server, room_id, message.sequence, payload)))
+
+    def recent(
+        self, server: str, room_id: str, count: int
+    ) -> List["chat_pb2.BroadcastMessage"]:
+        """房间最近的 count 条缓存消息，按序号升序"""
+        try:
+            with self._reader_lock:
+                rows = self._reader.execute(
+                    "SELECT payload FROM messages WHERE server = ? AND room_id = ? "
+                    "ORDER BY sequence DESC LIMIT ?",
+                    (server, room_id, count),
+                ).fetchall()
+        except sqlite3.Error as e:
+            log.error("cache.read_error", "读取消息缓存失败: {error}", error=e)
+            return []
+        return [chat_pb2.BroadcastMessage.FromString(row[0]) for row in reversed(rows)]
+
+    def forget_room(self, server: str, room_id: str):
+        """删除房间的缓存，如服务器的消息序号已经重新开始"""
+        self._queue.put((_FORGET, (server, room_id)))
+
+    def _run(self):
+        """写线程：组提交 + 按总字节数淘汰"""
+        connection = self._connect()
+        try:
+            total = _total_bytes(connection)
+        except sqlite3.Error as e:
+            log.error("cache.open_error", "打开消息缓存失败: {error}", error=e)
+            return
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            try:
+                total = self._write(connection, batch, total)
+            except sqlite3.Error as e:
+                connection.rollback()
+                log.error("cache.write_error", "写入消息缓存失败: {error}", error=e)
+        connection.close()
+
+    def _write(self, connection: sqlite3.Connection, batch: List[Tuple], total: int):
+        """在一个事务中写入一批消息，返回写入和淘汰后的总字节数"""
+        forgotten = False
+        for kind, values in batch:
+            if kind == _FORGET:
+                connection.execute(
+                    "DELETE FROM messages WHERE server = ? AND room_id = ?", values
+                )
+                forgotten = True
+                continue
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?)", values
+            )
+            total += len(values[3]) * cursor.rowcount
+        if forgotten:
+            total = _total_bytes(connection)
+        if total > self.max_bytes:
+            total = self._evict(connection, total, int(self.max_bytes * 0.9))
+        connection.commit()
+        return total
+
+    def _evict(self, connection: sqlite3.Connection, total: int, target: int) -> int:
+        """按写入顺序（rowid）删除最早的消息，直到总字节数不超过 target"""
+        rows = connection.execute(
+            "SELECT rowid, LENGTH(payload) FROM messages ORDER BY rowid"
+        )
+        last_rowid = None
+        for rowid, size in rows:
+            if total <= target:
+                break
+            total -= size
+            last_rowid = rowid
+        rows.close()
+        if last_rowid is not None:
+            connection.execute("DELETE FROM messages WHERE rowid <= ?", (last_rowid,))
+        return total
+
+    def close(self):
+        """写完队列中剩余的消息后关闭"""
+        self._queue.put(None)
+        self._writer.join()
+        with self._reader_lock:
+            self._reader.close()
+
+
+def _total_bytes(connection: sqlite3.Connection) -> int:
+    (total,) = connection.execute(
+        "SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM messages"
+    ).fetchone()
+    return total
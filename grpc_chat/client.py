@@ -3,7 +3,7 @@
 
 try:
     import tkinter as tk
-    from tkinter import ttk, scrolledtext, messagebox
+    from tkinter import ttk, scrolledtext, messagebox, simpledialog
 except ImportError:
     raise ImportError(
         "tkinter模块未找到。请确保您的Python安装包含tkinter。\n"
@@ -12,33 +12,138 @@ except ImportError:
         "在macOS上，请重新安装Python并确保包含tkinter。"
     )
 
-import grpc
 import threading
-import time
 import queue
 import argparse
+import sqlite3
 from datetime import datetime
-from typing import Optional
-# 这里IDE可能会对chat_pb2和chat_pb2_grpc的import报错，忽略即可
-import chat_pb2  # type: ignore
-import chat_pb2_grpc  # type: ignore
+from typing import List, Optional, Tuple
+from grpc_chat.cache import MessageCache, default_cache_path
+from grpc_chat.sdk import (
+    ChatClient,
+    ChatHandlers,
+    ChatSession,
+    JoinError,
+    is_retryable,
+)
+
+# 加入房间时显示的历史消息条数（本地缓存为空时由服务器回放）
+HISTORY_REPLAY_COUNT = 50
+
+# 大厅每页显示的房间数
+LOBBY_PAGE_SIZE = 50
+
+# 大厅处理房间列表推送的间隔（毫秒）
+LOBBY_UPDATE_INTERVAL_MS = 100
+
+# 房间列表订阅断开后重新订阅的间隔（毫秒）
+LOBBY_RESUBSCRIBE_MS = 2000
+
+# 聊天窗口最多保留的行数，超出后删除最早的行
+TRANSCRIPT_MAX_LINES = 2000
+
+# 聊天窗口每次最多处理的事件数，其余留到下一次，期间界面可以响应输入
+GUI_BATCH_SIZE = 500
+
+# 聊天窗口处理事件的间隔（毫秒）：有事件时为最小值，空闲时逐次加倍到最大值
+GUI_POLL_MIN_MS = 20
+GUI_POLL_MAX_MS = 200
+
+
+class GuiChatHandlers(ChatHandlers):
+    """把聊天会话的事件转交给 GUI 消息队列，由主线程处理"""
+
+    def __init__(
+        self,
+        gui_message_queue: queue.Queue,
+        message_cache: Optional[MessageCache] = None,
+        server: str = "",
+        room_id: str = "",
+        replay_since: int = 0,
+    ):
+        self.gui_message_queue = gui_message_queue
+        # 收到的聊天消息同时写入本地缓存（只入队，不阻塞读取线程）
+        self.message_cache = message_cache
+        self.server = server
+        self.room_id = room_id
+        # 从缓存的最后一条之后回放时，第一条消息据此判断中间是否有缺口
+        self.replay_since = replay_since
+
+    def on_joined(self, message):
+        self.gui_message_queue.put(("join_success", message))
+
+    def on_message(self, message):
+        if self.replay_since:
+            # 缓存之后的消息已超出服务器保留的历史，服务器不会补发
+            missing = message.sequence - self.replay_since - 1
+            if missing > 0:
+                self.gui_message_queue.put(("gap", missing))
+            self.replay_since = 0
+        if self.message_cache is not None:
+            self.message_cache.add(self.server, self.room_id, message)
+        self.gui_message_queue.put(("message", message))
+
+    def on_user_joined(self, event):
+        self.gui_message_queue.put(("user_joined", event))
+
+    def on_user_left(self, event):
+        self.gui_message_queue.put(("user_left", event))
+
+    def on_messages_dropped(self, event):
+        self.gui_message_queue.put(("dropped", event))
+
+    def on_rate_limited(self, event):
+        self.gui_message_queue.put(("rate_limited", event))
+
+    def on_draining(self, event):
+        self.gui_message_queue.put(("draining", event))
+
+    def on_closed(self, error):
+        if error is None:
+            return
+        if is_retryable(error):
+            # 连接问题，在后台重连并恢复会话，不打断用户
+            self.gui_message_queue.put(("disconnected", error))
+        else:
+            self.gui_message_queue.put(("error", str(error)))
 
 
 class ChatClientGUI:
-    def __init__(self, server_address: str = "localhost", server_port: int = 50051):
-        # gRPC 相关
+    def __init__(
+        self,
+        server_address: str = "localhost",
+        server_port: int = 50051,
+        cache_path: Optional[str] = None,
+    ):
+        # gRPC 相关：整个应用共用一个客户端（一条连接）
         self.server_address = f"{server_address}:{server_port}"
-        self.channel = None
-        self.stub = None
+        self.client: Optional[ChatClient] = None
+        self.chat_session: Optional[ChatSession] = None
         self.user_name = None
         self.current_room = None
         self.connected = False
-        self.message_queue = queue.Queue()
         self.chat_active = False
 
         # GUI 消息处理
         self.gui_message_queue = queue.Queue()
         self.message_handler_started = False  # 新增：消息处理线程启动标志
+        self.gui_poll_ms = GUI_POLL_MIN_MS
+        # 聊天流断开后正在后台重连；期间输入的消息暂存，重连后按顺序发出
+        self.reconnecting = False
+        self.pending_messages = []
+
+        # 本地消息缓存，进入房间时先显示缓存的消息；打不开时不使用缓存
+        self.message_cache: Optional[MessageCache] = None
+        if cache_path:
+            try:
+                self.message_cache = MessageCache(cache_path)
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️ 无法打开消息缓存 {cache_path}: {e}")
+
+        # 大厅：当前页显示的房间ID（与列表行一一对应）和房间列表订阅
+        self.lobby_room_ids = []
+        self.room_watch = None
+        self.lobby_update_queue = queue.Queue()
 
     def center_window(self, window, width, height):
         """居中显示窗口"""
@@ -113,17 +218,11 @@ class ChatClientGUI:
             return
 
         try:
-            # 每次都新建 channel 和 stub，避免复用旧连接
-            if self.channel:
-                self.channel.close()
-            self.channel = grpc.insecure_channel(self.server_address)
-            self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+            if self.client is None:
+                self.client = ChatClient(self.server_address)
 
             # 先校验用户名唯一性
-            check_req = chat_pb2.CheckUsernameRequest(user_name=username)
-            print(f"check_req: {check_req}")
-            check_resp = self.stub.CheckUsername(check_req)
-            print(f"check_resp: {check_resp}")
+            check_resp = self.client.check_username(username)
             if not check_resp.available:
                 messagebox.showerror("错误", check_resp.message)
                 return
@@ -144,7 +243,7 @@ class ChatClientGUI:
 
         # 设置窗口大小和位置
         window_width = 600
-        window_height = 400
+        window_height = 480
         self.center_window(self.lobby_window, window_width, window_height)
 
         # 创建主框架
@@ -159,22 +258,59 @@ class ChatClientGUI:
         )
         title_label.grid(row=0, column=0, columnspan=2, pady=(0, 20))
 
+        # 筛选框架：按房间名前缀过滤，可选按人数排序
+        filter_frame = ttk.Frame(main_frame)
+        filter_frame.grid(row=1, column=0, columnspan=2, pady=(0, 10))
+        ttk.Label(filter_frame, text="房间名前缀:").pack(side=tk.LEFT)
+        self.room_prefix_var = tk.StringVar()
+        prefix_entry = ttk.Entry(
+            filter_frame, textvariable=self.room_prefix_var, width=16
+        )
+        prefix_entry.pack(side=tk.LEFT, padx=5)
+        prefix_entry.bind("<Return>", lambda e: self.refresh_rooms())
+        self.sort_by_participants_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            filter_frame,
+            text="按人数排序",
+            variable=self.sort_by_participants_var,
+            command=self.refresh_rooms,
+        ).pack(side=tk.LEFT, padx=5)
+
         # 房间列表
         self.room_listbox = tk.Listbox(
-            main_frame, width=40, height=15, font=("Arial", 11)
+            main_frame, width=40, height=12, font=("Arial", 11)
         )
-        self.room_listbox.grid(row=1, column=0, columnspan=2, pady=(0, 10))
+        self.room_listbox.grid(row=2, column=0, columnspan=2, pady=(0, 5))
         self.room_listbox.bind("<Double-Button-1>", lambda e: self.join_selected_room())
 
+        # 翻页框架
+        page_frame = ttk.Frame(main_frame)
+        page_frame.grid(row=3, column=0, columnspan=2, pady=(0, 10))
+        self.prev_page_button = ttk.Button(
+            page_frame, text="上一页", command=self.show_prev_room_page
+        )
+        self.prev_page_button.pack(side=tk.LEFT, padx=5)
+        self.page_label = ttk.Label(page_frame, text="第 1 页")
+        self.page_label.pack(side=tk.LEFT, padx=5)
+        self.next_page_button = ttk.Button(
+            page_frame, text="下一页", command=self.show_next_room_page
+        )
+        self.next_page_button.pack(side=tk.LEFT, padx=5)
+
         # 按钮框架
         button_frame = ttk.Frame(main_frame)
-        button_frame.grid(row=2, column=0, columnspan=2, pady=(0, 10))
+        button_frame.grid(row=4, column=0, columnspan=2, pady=(0, 10))
 
         # 刷新按钮
         ttk.Button(button_frame, text="刷新列表", command=self.refresh_rooms).pack(
             side=tk.LEFT, padx=5
         )
 
+        # 创建房间按钮
+        ttk.Button(button_frame, text="创建房间", command=self.create_room).pack(
+            side=tk.LEFT, padx=5
+        )
+
         # 加入按钮
         ttk.Button(button_frame, text="加入房间", command=self.join_selected_room).pack(
             side=tk.LEFT, padx=5
@@ -189,13 +325,21 @@ class ChatClientGUI:
         self.lobby_status_label = ttk.Label(
             main_frame, text="请选择房间并加入", foreground="blue"
         )
-        self.lobby_status_label.grid(row=3, column=0, columnspan=2, pady=(10, 0))
+        self.lobby_status_label.grid(row=5, column=0, columnspan=2, pady=(10, 0))
 
         # 关闭窗口事件
         self.lobby_window.protocol("WM_DELETE_WINDOW", self.handle_logout)
+        # 大厅关闭（加入房间、退出登录）时取消房间列表订阅
+        self.lobby_window.bind("<Destroy>", self.on_lobby_destroyed)
 
-        # 初始刷新房间列表
+        # 初始刷新房间列表，并开始处理实时推送
         self.refresh_rooms()
+        self.lobby_window.after(LOBBY_UPDATE_INTERVAL_MS, self.process_lobby_updates)
+
+    def on_lobby_destroyed(self, event):
+        """大厅窗口销毁时停止订阅（子控件的销毁事件忽略）"""
+        if event.widget is event.widget.winfo_toplevel():
+            self.stop_room_watch()
 
     def handle_logout(self):
         """处理退出登录"""
@@ -213,9 +357,6 @@ class ChatClientGUI:
             self.user_name = None
             self.current_room = None
             self.connected = False
-            if self.channel:
-                self.channel.close()
-                self.channel = None
 
             # 显示登录窗口
             if self.login_window:
@@ -223,27 +364,170 @@ class ChatClientGUI:
                 self.username_var.set("")  # 清空用户名输入框
 
     def refresh_rooms(self):
-        """刷新房间列表"""
+        """刷新房间列表，回到第一页，并按当前前缀重新订阅房间变化"""
+        # 每一页的页码标记，第一页为空
+        self.room_page_tokens = [""]
+        self.next_room_page_token = ""
+        self.load_room_page()
+        self.start_room_watch()
+
+    def start_room_watch(self):
+        """订阅房间列表变化，推送在后台线程中接收，由 process_lobby_updates 应用"""
+        self.stop_room_watch()
+        updates = self.lobby_update_queue
+        self.room_watch = self.client.watch_rooms(
+            lambda update: updates.put(("update", update)),
+            name_prefix=self.room_prefix_var.get().strip(),
+            on_error=lambda e: updates.put(("error", e)),
+        )
+
+    def stop_room_watch(self):
+        """取消房间列表订阅"""
+        if self.room_watch is not None:
+            self.room_watch.cancel()
+            self.room_watch = None
+        # 丢弃旧订阅尚未处理的推送
+        self.lobby_update_queue = queue.Queue()
+
+    def process_lobby_updates(self):
+        """把房间列表推送应用到当前页，只改动发生变化的行"""
+        if not self.lobby_window or not self.lobby_window.winfo_exists():
+            return
+        try:
+            while True:
+                msg_type, data = self.lobby_update_queue.get_nowait()
+                if msg_type == "update":
+                    self.apply_rooms_update(data)
+                elif msg_type == "error" and is_retryable(data):
+                    # 连接中断，稍后在同一条连接上重新订阅，快照会更新当前页
+                    self.lobby_status_label.config(
+                        text="与服务器的连接中断，正在重新连接…", foreground="red"
+                    )
+                    self.lobby_window.after(
+                        LOBBY_RESUBSCRIBE_MS, self.start_room_watch
+                    )
+                elif msg_type == "error":
+                    self.lobby_status_label.config(
+                        text=f"实时更新已断开: {data.details() or data}，"
+                        "点击刷新列表重新订阅",
+                        foreground="red",
+                    )
+        except queue.Empty:
+            pass
+        self.lobby_window.after(LOBBY_UPDATE_INTERVAL_MS, self.process_lobby_updates)
+
+    def apply_rooms_update(self, update):
+        """更新当前页中人数变化的房间，移除已删除的房间
+
+        新建的房间不会插入当前页，以免打乱翻页位置，只提示用户刷新。
+        """
+        removed = set(update.removed_room_ids)
+        if update.snapshot:
+            present = {room.room_id for room in update.rooms}
+            removed.update(
+                room_id for room_id in self.lobby_room_ids if room_id not in present
+            )
+        new_rooms = 0
+        for room in update.rooms:
+            if room.room_id not in self.lobby_room_ids:
+                new_rooms += 1
+                continue
+            index = self.lobby_room_ids.index(room.room_id)
+            selected = index in self.room_listbox.curselection()
+            self.room_listbox.delete(index)
+            self.room_listbox.insert(index, self.format_room_row(room))
+            if selected:
+                self.room_listbox.selection_set(index)
+        for room_id in removed:
+            if room_id in self.lobby_room_ids:
+                index = self.lobby_room_ids.index(room_id)
+                del self.lobby_room_ids[index]
+                self.room_listbox.delete(index)
+        if new_rooms and not update.snapshot:
+            self.lobby_status_label.config(
+                text=f"有 {new_rooms} 个新房间，点击刷新列表查看", foreground="blue"
+            )
+
+    def format_room_row(self, room) -> str:
+        """房间列表中一行的显示文本"""
+        return (
+            f"🏠 {room.room_id:<12} | "
+            f"👥 {room.participant_count}/{room.max_capacity}"
+        )
+
+    def show_next_room_page(self):
+        """显示下一页"""
+        if self.next_room_page_token:
+            self.room_page_tokens.append(self.next_room_page_token)
+            self.load_room_page()
+
+    def show_prev_room_page(self):
+        """显示上一页"""
+        if len(self.room_page_tokens) > 1:
+            self.room_page_tokens.pop()
+            self.load_room_page()
+
+    def load_room_page(self):
+        """按当前筛选条件加载一页房间"""
         try:
-            request = chat_pb2.ListRoomsRequest()
-            response = self.stub.ListRooms(request)
+            response = self.client.list_rooms(
+                name_prefix=self.room_prefix_var.get().strip(),
+                page_size=LOBBY_PAGE_SIZE,
+                page_token=self.room_page_tokens[-1],
+                sort_by_participants=self.sort_by_participants_var.get(),
+            )
+            self.next_room_page_token = response.next_page_token
 
             # 清空列表
             self.room_listbox.delete(0, tk.END)
 
             # 添加房间信息
+            self.lobby_room_ids = [room.room_id for room in response.rooms]
             for room in response.rooms:
-                room_info = f"🏠 {room.room_id:<12} | 👥 {room.participant_count}/20"
-                self.room_listbox.insert(tk.END, room_info)
+                self.room_listbox.insert(tk.END, self.format_room_row(room))
 
+            page = len(self.room_page_tokens)
+            self.page_label.config(text=f"第 {page} 页")
+            self.prev_page_button.config(state=tk.NORMAL if page > 1 else tk.DISABLED)
+            self.next_page_button.config(
+                state=tk.NORMAL if self.next_room_page_token else tk.DISABLED
+            )
             self.lobby_status_label.config(
-                text=f"已加载 {len(response.rooms)} 个房间", foreground="green"
+                text=f"已加载 {len(response.rooms)}/{response.total_count} 个房间",
+                foreground="green",
             )
 
         except Exception as e:
             messagebox.showerror("网络错误", f"获取房间列表失败: {e}")
             self.lobby_status_label.config(text=f"刷新失败: {e}", foreground="red")
 
+    def create_room(self):
+        """创建新房间"""
+        room_id = simpledialog.askstring(
+            "创建房间", "房间名（字母、数字、下划线、连字符）:", parent=self.lobby_window
+        )
+        if not room_id:
+            return
+        max_capacity = simpledialog.askinteger(
+            "创建房间",
+            "房间容量:",
+            initialvalue=20,
+            minvalue=1,
+            parent=self.lobby_window,
+        )
+        if max_capacity is None:
+            return
+        try:
+            response = self.client.create_room(room_id.strip(), max_capacity)
+        except Exception as e:
+            messagebox.showerror("网络错误", f"创建房间失败: {e}")
+            return
+        if response.success:
+            self.lobby_status_label.config(text=response.message, foreground="green")
+            self.refresh_rooms()
+        else:
+            messagebox.showwarning("创建失败", response.message)
+
     def join_selected_room(self):
         """加入选中的房间"""
         selection = self.room_listbox.curselection()
@@ -251,9 +535,7 @@ class ChatClientGUI:
             messagebox.showwarning("选择错误", "请先选择一个房间")
             return
 
-        # 解析房间ID
-        room_text = self.room_listbox.get(selection[0])
-        room_id = room_text.split("|")[0].split("🏠")[1].strip()
+        room_id = self.lobby_room_ids[selection[0]]
 
         self.current_room = room_id
         self.chat_active = True
@@ -267,82 +549,85 @@ class ChatClientGUI:
     def start_chat_session(self):
         """开始聊天会话"""
 
-        def client_message_generator():
-            """生成客户端消息的生成器"""
-            # 首先发送加入请求
-            join_request = chat_pb2.JoinRequest(
-                user_name=self.user_name, room_id=self.current_room
+        def show_login_again(message):
+            # 新增：用户名被占用等失败时，弹窗提示并返回登录界面
+            def show():
+                messagebox.showerror("登录失败", message)
+                if self.lobby_window:
+                    self.lobby_window.destroy()
+                    self.lobby_window = None
+                if self.chat_window:
+                    self.chat_window.destroy()
+                    self.chat_window = None
+                if self.login_window:
+                    self.login_window.deiconify()
+                    self.username_var.set("")
+
+            return show
+
+        room_id = self.current_room
+
+        def join_thread():
+            """读取缓存并等待加入应答，结果经 GUI 消息队列交给主线程
+
+            之后的事件由会话的读取线程交给 GUI 消息队列。
+            """
+            # 先显示本地缓存的最近消息，服务器只需补发最后一条缓存之后的消息
+            cached = []
+            if self.message_cache is not None:
+                cached = self.message_cache.recent(
+                    self.server_address, room_id, HISTORY_REPLAY_COUNT
+                )
+            for message in cached:
+                self.gui_message_queue.put(("message", message))
+            if cached:
+                self.gui_message_queue.put(("cached", len(cached)))
+            cached_sequence = cached[-1].sequence if cached else 0
+
+            handlers = GuiChatHandlers(
+                self.gui_message_queue,
+                self.message_cache,
+                self.server_address,
+                room_id,
+                cached_sequence,
             )
-            client_message = chat_pb2.ClientMessage(join_request=join_request)
-            yield client_message
-
-            # 然后持续发送聊天消息
-            while self.chat_active:
-                try:
-                    message = self.message_queue.get(timeout=0.5)
-                    if message is None:  # 停止信号
-                        break
-                    yield message
-                except queue.Empty:
-                    continue
-
-        def chat_thread():
-            """聊天线程"""
             try:
-                response_stream = self.stub.Chat(client_message_generator())
-                join_success = False
-
-                for server_message in response_stream:
-                    if server_message.HasField("join_response"):
-                        join_resp = server_message.join_response
-                        if join_resp.success:
-                            join_success = True
-                            self.gui_message_queue.put(
-                                ("join_success", join_resp.message)
-                            )
-                        else:
-                            # 新增：用户名被占用等失败时，弹窗提示并返回登录界面
-                            def show_login_again():
-                                messagebox.showerror("登录失败", join_resp.message)
-                                if self.lobby_window:
-                                    self.lobby_window.destroy()
-                                    self.lobby_window = None
-                                if self.chat_window:
-                                    self.chat_window.destroy()
-                                    self.chat_window = None
-                                if self.login_window:
-                                    self.login_window.deiconify()
-                                    self.username_var.set("")
-
-                            self.gui_message_queue.put(
-                                ("login_failed", show_login_again)
-                            )
-                            self.chat_active = False
-                            break
-
-                    elif server_message.HasField("broadcast"):
-                        if join_success:
-                            broadcast = server_message.broadcast
-                            self.gui_message_queue.put(("message", broadcast))
-
-                    elif server_message.HasField("user_joined"):
-                        if join_success:
-                            user_joined = server_message.user_joined
-                            self.gui_message_queue.put(("user_joined", user_joined))
-
-                    elif server_message.HasField("user_left"):
-                        if join_success:
-                            user_left = server_message.user_left
-                            self.gui_message_queue.put(("user_left", user_left))
-
+                if cached_sequence:
+                    session = self.client.join(
+                        self.user_name,
+                        room_id,
+                        handlers,
+                        replay_since=cached_sequence,
+                        resumable=True,
+                    )
+                else:
+                    session = self.client.join(
+                        self.user_name,
+                        room_id,
+                        handlers,
+                        replay_last=HISTORY_REPLAY_COUNT,
+                        resumable=True,
+                    )
+            except JoinError as e:
+                self.gui_message_queue.put(("login_failed", show_login_again(str(e))))
+                self.chat_active = False
+                return
             except Exception as e:
                 self.gui_message_queue.put(("error", str(e)))
                 self.chat_active = False
+                return
+            if session.last_sequence < cached_sequence:
+                # 服务器的消息序号重新开始了（如重启且未持久化），缓存已过时
+                self.message_cache.forget_room(self.server_address, room_id)
+            if self.current_room != room_id:
+                # 等待应答期间用户已经离开了聊天窗口
+                session.leave()
+                return
+            self.gui_message_queue.put(("session", (room_id, session)))
 
-        # 启动聊天线程
-        chat_thread_obj = threading.Thread(target=chat_thread)
-        chat_thread_obj.daemon = True
-        chat_thread_obj.start()
+        # 缓存读取和加入请求都在后台线程中进行，不阻塞界面
+        self.chat_session = None
+        threading.Thread(target=join_thread, daemon=True).start()
 
         # 创建聊天窗口并启动消息处理
         self.show_chat_window()
@@ -384,6 +669,7 @@ class ChatClientGUI:
             chat_frame, wrap=tk.WORD, font=("Arial", 10), state=tk.DISABLED
         )
         self.chat_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.chat_text.tag_configure("system", foreground="blue")
 
         # 消息输入框架
         input_frame = ttk.LabelFrame(main_frame, text="💭 发送消息", padding="5")
@@ -425,67 +711,180 @@ class ChatClientGUI:
         self.chat_window.mainloop()
 
     def process_gui_messages(self):
-        """处理GUI消息队列"""
+        """处理GUI消息队列
+
+        每次最多取出 GUI_BATCH_SIZE 个事件，合并成一次插入和一次滚动；
+        队列还有积压时尽快再次处理，空闲时逐步拉长间隔。
+        """
         if not self.chat_active or not self.chat_window:
             return
 
+        lines: List[Tuple[str, str]] = []
         try:
-            while True:
+            for _ in range(GUI_BATCH_SIZE):
                 msg_type, data = self.gui_message_queue.get_nowait()
+                if msg_type == "disconnected" and not (
+                    self.chat_session or self.reconnecting
+                ):
+                    # 会话尚未建立就断开了，没有可以恢复的会话
+                    msg_type, data = "error", str(data)
 
-                if msg_type == "join_success":
-                    self.add_system_message(f"✅ {data}")
-                elif msg_type == "login_failed":
+                if msg_type == "login_failed":
                     data()  # 执行 show_login_again
                     return
-                elif msg_type == "message":
-                    timestamp = datetime.fromtimestamp(data.timestamp).strftime(
-                        "%H:%M:%S"
-                    )
-                    self.add_chat_message(
-                        f"[{timestamp}] {data.sender_name}: {data.text}"
-                    )
-                elif msg_type == "user_joined":
-                    self.add_system_message(
-                        f"🟢 欢迎 {data.user_name} 加入房间！当前在线人数：{data.current_count} 人"
-                    )
-                elif msg_type == "user_left":
-                    self.add_system_message(
-                        f"🔴 {data.user_name} 离开了房间，当前在线人数：{data.current_count} 人"
-                    )
-                    # 如果是自己离开，则停止聊天活动
-                    if data.user_name == self.user_name:
-                        self.chat_active = False
-                        self.message_queue.put(None)  # 发送停止信号
-                        return
                 elif msg_type == "error":
+                    self.append_lines(lines)
                     messagebox.showerror("通信错误", f"聊天过程中出错: {data}")
                     self.leave_room()
                     return
+                elif msg_type == "disconnected":
+                    lines.append(("⚠️ 与服务器的连接中断，正在重新连接…", "system"))
+                    self.start_reconnect()
+                    continue
+                elif msg_type == "reconnected":
+                    self.finish_reconnect(data)
+                    lines.append(("🔄 已重新连接", "system"))
+                    continue
+                elif msg_type == "session":
+                    self.finish_join(*data)
+                    continue
 
+                line = self.format_gui_message(msg_type, data)
+                if line is not None:
+                    lines.append(line)
+                # 如果是自己离开，则停止聊天活动
+                if msg_type == "user_left" and data.user_name == self.user_name:
+                    self.append_lines(lines)
+                    self.chat_active = False
+                    if self.chat_session is not None:
+                        self.chat_session.close()
+                    return
+            # 取满一批说明还有积压，让出一次事件循环后继续
+            delay = 1
         except queue.Empty:
-            pass
+            if lines:
+                delay = GUI_POLL_MIN_MS
+            else:
+                delay = min(self.gui_poll_ms * 2, GUI_POLL_MAX_MS)
+        self.append_lines(lines)
+        self.gui_poll_ms = max(delay, GUI_POLL_MIN_MS)
 
         # 继续处理消息
         if self.chat_active and self.chat_window:
-            self.chat_window.after(100, self.process_gui_messages)
+            self.chat_window.after(delay, self.process_gui_messages)
+
+    def start_reconnect(self):
+        """在后台线程中恢复断开的聊天会话"""
+        session = self.chat_session
+        if session is None:
+            # 已经在重连，新会话随后会再次检查
+            return
+        self.chat_session = None
+        self.reconnecting = True
+        room_id = self.current_room
+
+        def reconnect_thread():
+            try:
+                resumed = self.client.reconnect(session)
+            except Exception as e:
+                self.gui_message_queue.put(("error", f"重新连接失败: {e}"))
+                return
+            if self.current_room != room_id:
+                # 重连期间用户已经离开了聊天窗口
+                resumed.leave()
+                return
+            self.gui_message_queue.put(("reconnected", resumed))
+
+        threading.Thread(target=reconnect_thread, daemon=True).start()
+
+    def finish_join(self, room_id: str, session: ChatSession):
+        """在主线程中开始使用加入成功的会话"""
+        if self.current_room != room_id or self.chat_session is not None:
+            # 结果到达前用户已经离开或换了房间
+            session.leave()
+            return
+        self.chat_session = session
+
+    def finish_reconnect(self, session: ChatSession):
+        """使用恢复后的会话，发出重连期间输入的消息"""
+        self.reconnecting = False
+        self.chat_session = session
+        if not session.active:
+            # 恢复后又立即断开，它的断开通知可能先于本次重连结果被处理
+            self.start_reconnect()
+            return
+        for text in self.pending_messages:
+            session.send(text)
+        self.pending_messages = []
+
+    def format_gui_message(self, msg_type, data) -> Optional[Tuple[str, str]]:
+        """把会话事件转换为聊天记录中的一行 (文本, 标签)"""
+        if msg_type == "join_success":
+            return f"✅ {data}", "system"
+        elif msg_type == "message":
+            timestamp = datetime.fromtimestamp(data.timestamp).strftime("%H:%M:%S")
+            return f"[{timestamp}] {data.sender_name}: {data.text}", ""
+        elif msg_type == "user_joined":
+            return (
+                f"🟢 欢迎 {data.user_name} 加入房间！当前在线人数：{data.current_count} 人",
+                "system",
+            )
+        elif msg_type == "user_left":
+            return (
+                f"🔴 {data.user_name} 离开了房间，当前在线人数：{data.current_count} 人",
+                "system",
+            )
+        elif msg_type == "cached":
+            return f"📜 以上 {data} 条消息来自本地缓存", "system"
+        elif msg_type == "gap":
+            return f"⚠️ 此处有 {data} 条消息已超出服务器保留的历史，无法显示", "system"
+        elif msg_type == "dropped":
+            return f"⚠️ 网络较慢，服务器跳过了 {data.count} 条消息", "system"
+        elif msg_type == "rate_limited":
+            return (
+                f"⏳ 发送过快，消息未送达，请 {data.retry_after_ms / 1000:.1f} 秒后再试",
+                "system",
+            )
+        elif msg_type == "draining":
+            return (
+                f"🔧 {data.reason}，约 {data.reconnect_after_ms / 1000:.0f} 秒后自动重新连接",
+                "system",
+            )
+        return None
+
+    def append_lines(self, lines: List[Tuple[str, str]]):
+        """一次插入多行，删除超出 TRANSCRIPT_MAX_LINES 的最早的行
+
+        只有原本停在底部时才滚动到末尾，向上翻看历史时不被新消息打断。
+        """
+        if not lines or not self.chat_text:
+            return
+        # 相邻的同类行合并为一段，Text.insert 一次接受多组 (文本, 标签)
+        chunks: List[str] = []
+        for text, tag in lines[-TRANSCRIPT_MAX_LINES:]:
+            if chunks and chunks[-1] == tag:
+                chunks[-2] += f"{text}\n"
+            else:
+                chunks += [f"{text}\n", tag]
+        at_bottom = self.chat_text.yview()[1] >= 1.0
+        self.chat_text.config(state=tk.NORMAL)
+        self.chat_text.insert(tk.END, *chunks)
+        # 末尾总有一个空行，实际行数比 end 的行号少 1
+        excess = int(self.chat_text.index(tk.END).split(".")[0]) - 1
+        excess -= TRANSCRIPT_MAX_LINES
+        if excess > 0:
+            self.chat_text.delete("1.0", f"{excess + 1}.0")
+        self.chat_text.config(state=tk.DISABLED)
+        if at_bottom:
+            self.chat_text.see(tk.END)
 
     def add_chat_message(self, message):
         """添加聊天消息"""
-        if self.chat_text:
-            self.chat_text.config(state=tk.NORMAL)
-            self.chat_text.insert(tk.END, f"{message}\n")
-            self.chat_text.config(state=tk.DISABLED)
-            self.chat_text.see(tk.END)
+        self.append_lines([(message, "")])
 
     def add_system_message(self, message):
         """添加系统消息"""
-        if self.chat_text:
-            self.chat_text.config(state=tk.NORMAL)
-            self.chat_text.insert(tk.END, f"{message}\n", "system")
-            self.chat_text.tag_configure("system", foreground="blue")
-            self.chat_text.config(state=tk.DISABLED)
-            self.chat_text.see(tk.END)
+        self.append_lines([(message, "system")])
 
     def send_message(self, event=None):
         """发送消息"""
@@ -499,10 +898,11 @@ class ChatClientGUI:
         # 清空输入框
         self.message_entry.delete(0, tk.END)
 
-        # 发送消息
-        chat_message = chat_pb2.ChatMessage(text=message_text)
-        client_message = chat_pb2.ClientMessage(chat_message=chat_message)
-        self.message_queue.put(client_message)
+        # 发送消息（加入应答到达之前会话尚未建立）
+        if self.chat_session is not None:
+            self.chat_session.send(message_text)
+        elif self.reconnecting:
+            self.pending_messages.append(message_text)
 
     def clear_chat(self):
         """清空聊天记录"""
@@ -514,24 +914,18 @@ class ChatClientGUI:
     def leave_room(self):
         """离开房间"""
         if self.chat_active and self.current_room:
-            # 发送离开请求
-            leave_request = chat_pb2.LeaveRequest(
-                user_name=self.user_name, room_id=self.current_room
-            )
-            client_message = chat_pb2.ClientMessage(leave_request=leave_request)
-            self.message_queue.put(client_message)
-
-            # 等待一小段时间确保消息发送
-            time.sleep(0.1)
-
-            # 不再立即停止聊天活动，而是等待服务器的离开通知
-            # 在 process_gui_messages 中处理完离开通知后再停止
+            # 发送离开请求，服务器处理后结束聊天流
+            if self.chat_session is not None:
+                self.chat_session.leave()
+                self.chat_session = None
 
             if self.chat_window:
                 self.chat_window.destroy()
                 self.chat_window = None
 
             self.current_room = None
+            self.reconnecting = False
+            self.pending_messages = []
 
             # 返回大厅
             self.show_lobby()
@@ -539,8 +933,15 @@ class ChatClientGUI:
     def disconnect_from_server(self):
         """断开与服务器的连接"""
         self.chat_active = False
-        if self.channel:
-            self.channel.close()
+        if self.chat_session is not None:
+            # 先正常离开，否则服务器会把断开当作网络中断，保留会话等待重连
+            self.chat_session.leave()
+            self.chat_session.wait_closed(1.0)
+            self.chat_session.close()
+            self.chat_session = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
         self.connected = False
 
     def quit_application(self):
@@ -549,6 +950,10 @@ class ChatClientGUI:
             # 首先停止聊天活动
             self.chat_active = False
             self.disconnect_from_server()
+            # 写完尚未写入缓存的消息
+            if self.message_cache is not None:
+                self.message_cache.close()
+                self.message_cache = None
 
             # 销毁所有窗口
             windows_to_destroy = []
@@ -592,6 +997,19 @@ class ChatClientGUI:
         self.login_window.mainloop()
 
 
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    """向命令行解析器添加本地消息缓存的参数"""
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default=default_cache_path(),
+        help=f"本地消息缓存的数据库文件 (默认: {default_cache_path()})",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="不使用本地消息缓存"
+    )
+
+
 def main():
     import argparse
 
@@ -602,8 +1020,13 @@ def main():
     parser.add_argument(
         "--port", type=int, default=50051, help="服务器端口 (默认: 50051)"
     )
+    add_cache_arguments(parser)
     args = parser.parse_args()
-    gui = ChatClientGUI(server_address=args.host, server_port=args.port)
+    gui = ChatClientGUI(
+        server_address=args.host,
+        server_port=args.port,
+        cache_path=None if args.no_cache else args.cache_path,
+    )
     gui.run()
 
 
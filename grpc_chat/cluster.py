@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+集群模式：按一致性哈希把房间分配给多个节点
+
+每个节点都是一个完整的聊天服务器，同时是一部分房间的权威方（RoomAuthority）：
+房间ID 在一致性哈希环上落到哪个节点，该房间的成员、序号和历史就由哪个节点
+维护；用户名按 "user:" + 用户名 同样分配。任何节点都可以接受聊天流，加入、
+发言等操作经内部的 gRPC 对等连接转发给房间的拥有者，拥有者再把编码好的
+消息发回所有有该房间成员的节点，由各节点分发给本地连接。
+
+节点之间的连接断开或恢复时，各节点按在线节点重建哈希环。每个节点在环上
+有多个虚拟节点，增减一个节点时只有约 1/N 的房间换拥有者；换了拥有者的
+房间由新拥有者接管序号，各节点把本地成员重新登记过去。节点列表是静态的，
+交接期间发出的消息可能丢失。
+"""
+
+import hashlib
+import queue
+import threading
+from bisect import bisect_right
+from concurrent import futures
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import grpc
+
+from grpc_chat import log
+from grpc_chat.bus import (
+    BUS_ROOM_DELETED,
+    BUS_ROOM_STATE,
+    BusConnection,
+    BusEndpoint,
+    RoomAuthority,
+    coalesce_frames,
+    decode_frame,
+    decode_frames,
+    encode_frame,
+)
+from grpc_chat.leases import DEFAULT_LEASE_TTL
+from grpc_chat.rooms import RoomRegistry
+from grpc_chat.server import OVERFLOW_DISCONNECT, StreamHandler
+
+# 每个节点在哈希环上的虚拟节点数，越多分布越均匀
+DEFAULT_VIRTUAL_NODES = 64
+
+# 用户名在哈希环上的键前缀，与房间ID区分开
+USER_KEY_PREFIX = "user:"
+
+# 节点之间的内部 RPC，请求和响应都是总线帧的原始字节
+PEER_SERVICE = "chat.ChatPeer"
+PEER_LINK_METHOD = f"/{PEER_SERVICE}/Link"
+
+# 对等连接建立后服务端发送的第一帧：节点ID
+PEER_HELLO = 30
+
+# 对等连接断开后重连的间隔（秒）
+RECONNECT_INTERVAL = 1.0
+
+# 对等连接的发送队列容量，超过时断开连接，由对方重连后重新同步
+PEER_QUEUE_SIZE = 65536
+
+# 对等连接上排队的帧首尾相接合并为一条 gRPC 消息发送，每条消息的字节上限
+PEER_BATCH_MAX_BYTES = 64 * 1024
+
+_CHANNEL_OPTIONS = [
+    ("grpc.initial_reconnect_backoff_ms", 500),
+    ("grpc.min_reconnect_backoff_ms", 500),
+    ("grpc.max_reconnect_backoff_ms", 2000),
+]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """一致性哈希环，每个节点在环上占 virtual_nodes 个位置"""
+
+    def __init__(
+        self, nodes: Iterable[str], virtual_nodes: int = DEFAULT_VIRTUAL_NODES
+    ):
+        self.nodes = tuple(sorted(nodes))
+        points = sorted(
+            (_hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key: str) -> str:
+        """顺时针方向第一个虚拟节点所属的节点"""
+        index = bisect_right(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class _PeerConnection(BusConnection):
+    """权威方一侧的一个节点连接"""
+
+    def __init__(self, send: Callable[[bytes], Any]):
+        super().__init__()
+        self.send = send  # type: ignore
+
+
+class _LocalLink(BusEndpoint):
+    """到本节点权威方的连接
+
+    请求直接在调用线程中交给权威方处理，权威方发回的帧经队列由分发线程
+    处理，与对等连接的行为一致，且不会在持有权威方锁时操作本地连接。
+    """
+
+    def __init__(
+        self,
+        node_id: str,
+        authority: RoomAuthority,
+        dispatch: Callable[..., Any],
+        on_event: Callable[[int, List[bytes]], Any],
+    ):
+        super().__init__(dispatch, on_event)
+        self.node_id = node_id
+        self.up = True
+        self._authority = authority
+        self._inbox: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._conn = _PeerConnection(self._inbox.put)
+        authority.connect(self._conn)
+        threading.Thread(
+            target=self._run, name="chat-cluster-local", daemon=True
+        ).start()
+
+    def close(self):
+        self._authority.disconnect(self._conn)
+        self._inbox.put(None)
+
+    def _send_frame(self, frame: bytes):
+        kind, fields = decode_frame(frame)
+        self._authority.handle(
+            self._conn, kind, [field.decode("utf-8") for field in fields]
+        )
+
+    def _run(self):
+        for frame in iter(self._inbox.get, None):
+            self._handle_frame(*decode_frame(frame))
+
+
+class _PeerLink(BusEndpoint):
+    """到另一个节点权威方的连接，断开后自动重连
+
+    连接状态的变化通过 on_state(link, up) 通知，在读取线程中调用。
+    """
+
+    def __init__(
+        self,
+        node_id: str,
+        address: str,
+        dispatch: Callable[..., Any],
+        on_event: Callable[[int, List[bytes]], Any],
+        on_state: Callable[["_PeerLink", bool], Any],
+    ):
+        super().__init__(dispatch, on_event)
+        self.node_id = node_id
+        self.address = address
+        self.up = False
+        self._on_state = on_state
+        # 当前连接的发送队列，未连接时为 None
+        self._outgoing: "Optional[queue.Queue[Optional[bytes]]]" = None
+        self._closed = threading.Event()
+        self._channel = grpc.insecure_channel(address, options=_CHANNEL_OPTIONS)
+        self._link = self._channel.stream_stream(PEER_LINK_METHOD)
+        threading.Thread(
+            target=self._run, name=f"chat-peer-{node_id}", daemon=True
+        ).start()
+
+    def close(self):
+        self._closed.set()
+        outgoing = self._outgoing
+        if outgoing is not None:
+            outgoing.put(None)
+        self._channel.close()
+
+    def _send_frame(self, frame: bytes):
+        # 未连接时直接丢弃，重连后由哈希环的重建重新同步状态
+        outgoing = self._outgoing
+        if outgoing is not None:
+            outgoing.put(frame)
+
+    def _request(self, kind: int, *fields, on_success=None):
+        if not self.up:
+            raise ConnectionError(f"集群节点 {self.node_id} 不可用")
+        return super()._request(kind, *fields, on_success=on_success)
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                grpc.channel_ready_future(self._channel).result(
+                    timeout=RECONNECT_INTERVAL
+                )
+            except (grpc.FutureTimeoutError, grpc.FutureCancelledError):
+                continue
+            except ValueError:
+                # 通道已关闭
+                return
+            outgoing: "queue.Queue[Optional[bytes]]" = queue.Queue()
+            self._outgoing = outgoing
+            try:
+                self._serve(self._link(coalesce_frames(outgoing, PEER_BATCH_MAX_BYTES)))
+            except grpc.RpcError:
+                pass
+            self._outgoing = None
+            outgoing.put(None)
+            self._fail_pending()
+            if self.up:
+                self.up = False
+                self._on_state(self, False)
+            self._closed.wait(RECONNECT_INTERVAL)
+
+    def _serve(self, responses: Iterator[bytes]):
+        for data in responses:
+            for kind, fields in decode_frames(data):
+                if kind != PEER_HELLO:
+                    self._handle_frame(kind, fields)
+                    continue
+                node_id = fields[0].decode("utf-8")
+                if node_id != self.node_id:
+                    log.error(
+                        "cluster.node_mismatch",
+                        "集群节点 {address} 的ID为 {actual}，与配置的 {node} 不符",
+                        address=self.address,
+                        actual=node_id,
+                        node=self.node_id,
+                    )
+                    responses.cancel()
+                    return
+                self.up = True
+                self._on_state(self, True)
+
+
+class _PeerService:
+    """节点之间的内部 RPC：把对方发来的帧交给本节点的权威方"""
+
+    def __init__(self, node_id: str, authority: RoomAuthority):
+        self.node_id = node_id
+        self.authority = authority
+
+    def Link(self, request_iterator, context):
+        handler = StreamHandler(
+            context.peer(), "", PEER_QUEUE_SIZE, OVERFLOW_DISCONNECT
+        )
+        if not context.add_callback(handler.stop):
+            return
+        conn = _PeerConnection(handler.send_message)
+        handler.send_message(encode_frame(PEER_HELLO, self.node_id))
+        self.authority.connect(conn)
+        threading.Thread(
+            target=self._read_frames,
+            args=(request_iterator, conn, handler),
+            name="chat-peer-reader",
+            daemon=True,
+        ).start()
+        try:
+            for batch in handler.get_batches(0, PEER_BATCH_MAX_BYTES):
+                yield b"".join(batch)
+            if handler.overflowed:
+                log.warning(
+                    "cluster.slow_peer",
+                    "集群节点 {peer} 接收过慢，断开连接",
+                    peer=handler.user_name,
+                )
+        finally:
+            self.authority.disconnect(conn)
+
+    def _read_frames(self, request_iterator, conn: _PeerConnection, handler):
+        try:
+            for data in request_iterator:
+                for kind, fields in decode_frames(data):
+                    self.authority.handle(
+                        conn, kind, [field.decode("utf-8") for field in fields]
+                    )
+        except grpc.RpcError:
+            pass
+        finally:
+            handler.stop()
+
+
+class ClusterBus:
+    """集群模式下的总线，接口与 BusClient 相同
+
+    按哈希环把每个操作路由到房间或用户名的拥有者；收到的房间状态只采信
+    当前拥有者发来的，避免交接期间旧拥有者的状态覆盖新的。
+    """
+
+    def __init__(
+        self,
+        node_id: str,
+        nodes: Dict[str, str],
+        rooms: RoomRegistry,
+        history_size: int,
+        dispatch: Callable[..., Any],
+        on_event: Callable[[int, List[bytes]], Any],
+        virtual_nodes: int = DEFAULT_VIRTUAL_NODES,
+        username_ttl: float = DEFAULT_LEASE_TTL,
+    ):
+        """
+        Args:
+            node_id: 本节点ID
+            nodes: 所有节点 {节点ID: 内部通信地址}
+            rooms: 本节点的房间注册表，重建哈希环时据此接管房间和重新登记成员
+            history_size: 每个房间保留的历史消息条数
+            dispatch: 决定总线事件在哪个线程中处理，同 BusEndpoint
+            on_event: 处理总线事件
+            username_ttl: 本节点拥有的用户名预留在确认前的有效期（秒）
+        """
+        self.node_id = node_id
+        self.nodes = dict(nodes)
+        self.rooms = rooms
+        self.virtual_nodes = virtual_nodes
+        self.authority = RoomAuthority({}, history_size, username_ttl)
+        self.ring = HashRing([node_id], virtual_nodes)
+        self._on_event = on_event
+        # 本节点上已加入房间的聊天流使用的用户名 -> 聊天流数，用户名换了
+        # 拥有者时重新登记；尚未确认的预留不迁移，交给原拥有者过期
+        self._claimed: Dict[str, int] = {}
+        self._claimed_lock = threading.Lock()
+        self._rebalance_lock = threading.Lock()
+
+        self._peer_server = grpc.server(
+            futures.ThreadPoolExecutor(
+                max_workers=len(nodes) + 2, thread_name_prefix="chat-peer"
+            )
+        )
+        service = _PeerService(node_id, self.authority)
+        self._peer_server.add_generic_rpc_handlers(
+            (
+                grpc.method_handlers_generic_handler(
+                    PEER_SERVICE,
+                    {"Link": grpc.stream_stream_rpc_method_handler(service.Link)},
+                ),
+            )
+        )
+        self._peer_server.add_insecure_port(nodes[node_id])
+        self._peer_server.start()
+
+        self._links: Dict[str, BusEndpoint] = {
+            node_id: _LocalLink(
+                node_id, self.authority, dispatch, partial(self._on_link_event, node_id)
+            )
+        }
+        with self._rebalance_lock:
+            self._rebalance()
+        for peer_id, address in nodes.items():
+            if peer_id != node_id:
+                self._links[peer_id] = _PeerLink(
+                    peer_id,
+                    address,
+                    dispatch,
+                    partial(self._on_link_event, peer_id),
+                    self._on_link_state,
+                )
+        log.info(
+            "cluster.start",
+            "集群节点 {node} 的内部通信地址: {address}，共 {nodes} 个节点",
+            node=node_id,
+            address=nodes[node_id],
+            nodes=len(nodes),
+        )
+
+    def claim_user(self, user_name: str) -> bool:
+        return self._user_link(user_name).claim_user(user_name)
+
+    def confirm_user(self, user_name: str):
+        with self._claimed_lock:
+            self._claimed[user_name] = self._claimed.get(user_name, 0) + 1
+        self._user_link(user_name).confirm_user(user_name)
+
+    def release_user(self, user_name: str, joined: bool = False):
+        if joined:
+            with self._claimed_lock:
+                remaining = self._claimed.get(user_name, 0) - 1
+                if remaining > 0:
+                    self._claimed[user_name] = remaining
+                else:
+                    self._claimed.pop(user_name, None)
+        self._user_link(user_name).release_user(user_name, joined)
+
+    def join(
+        self,
+        room_id: str,
+        user_name: str,
+        replay_last: int = 0,
+        replay_since: Optional[int] = None,
+        on_joined: Optional[Callable[[str, List[bytes]], Any]] = None,
+    ) -> Tuple[bool, str, List[bytes]]:
+        return self._room_link(room_id).join(
+            room_id, user_name, replay_last, replay_since, on_joined
+        )
+
+    def leave(self, room_id: str, user_name: str):
+        self._room_link(room_id).leave(room_id, user_name)
+
+    def publish(self, room_id: str, sender: str, text: str, timestamp: int):
+        self._room_link(room_id).publish(room_id, sender, text, timestamp)
+
+    def create_room(self, room_id: str, max_capacity: int) -> Tuple[bool, str]:
+        return self._room_link(room_id).create_room(room_id, max_capacity)
+
+    def delete_room(self, room_id: str) -> Tuple[bool, str]:
+        return self._room_link(room_id).delete_room(room_id)
+
+    def close(self):
+        for link in self._links.values():
+            link.close()
+        self._peer_server.stop(0)
+
+    def _room_link(self, room_id: str) -> BusEndpoint:
+        return self._links[self.ring.owner(room_id)]
+
+    def _user_link(self, user_name: str) -> BusEndpoint:
+        return self._links[self.ring.owner(USER_KEY_PREFIX + user_name)]
+
+    def _on_link_event(self, node_id: str, kind: int, fields: List[bytes]):
+        """处理某个节点的权威方发来的事件"""
+        if kind in (BUS_ROOM_STATE, BUS_ROOM_DELETED):
+            room_id = fields[0].decode("utf-8")
+            owner = self.ring.owner(room_id)
+            if owner != node_id:
+                if (
+                    kind == BUS_ROOM_STATE
+                    and owner == self.node_id
+                    and not self.authority.has_room(room_id)
+                ):
+                    # 本节点重建哈希环时还不知道的房间，由本节点接管
+                    _, max_capacity, _, last_sequence = fields
+                    self.authority.adopt_room(
+                        room_id, int(max_capacity), int(last_sequence)
+                    )
+                return
+        self._on_event(kind, fields)
+
+    def _on_link_state(self, link: _PeerLink, up: bool):
+        log.info(
+            "cluster.link",
+            "集群节点 {node} ({address}) {state}",
+            node=link.node_id,
+            address=link.address,
+            state="已连接" if up else "已断开",
+        )
+        with self._rebalance_lock:
+            self._rebalance()
+
+    def _rebalance(self):
+        """按当前在线的节点重建哈希环（调用时已持有 _rebalance_lock）
+
+        接管新分到本节点的房间、交出不再属于本节点的房间，并把本地成员和
+        用户名重新登记到换了拥有者的节点上。
+        """
+        old_ring = self.ring
+        ring = HashRing(
+            [node_id for node_id, link in self._links.items() if link.up],
+            self.virtual_nodes,
+        )
+        self.ring = ring
+        known: Set[str] = set()
+        moved = 0
+        for room in self.rooms:
+            room_id = room.room_id
+            known.add(room_id)
+            owner = ring.owner(room_id)
+            if owner == self.node_id:
+                self.authority.adopt_room(
+                    room_id, room.max_capacity, room.last_sequence
+                )
+            else:
+                self.authority.drop_room(room_id)
+            if owner == old_ring.owner(room_id):
+                continue
+            moved += 1
+            link = self._links[owner]
+            for handler in room.subscribers:
+                link.rejoin(
+                    room_id, handler.user_name, room.max_capacity, room.last_sequence
+                )
+        for room_id in self.authority.room_ids():
+            if room_id not in known and ring.owner(room_id) != self.node_id:
+                self.authority.drop_room(room_id)
+        for user_name in self.authority.user_names():
+            if ring.owner(USER_KEY_PREFIX + user_name) != self.node_id:
+                self.authority.drop_user(user_name)
+        with self._claimed_lock:
+            claimed = list(self._claimed.items())
+        for user_name, count in claimed:
+            key = USER_KEY_PREFIX + user_name
+            owner = ring.owner(key)
+            if owner != old_ring.owner(key):
+                self._links[owner].confirm_user(user_name, count)
+        log.info(
+            "cluster.rebalance",
+            "集群在线节点: {nodes}，{moved} 个房间换了拥有者，本节点拥有 {owned} 个",
+            nodes=", ".join(ring.nodes),
+            moved=moved,
+            owned=len(self.authority.room_ids()),
+        )
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用户名租约
+
+CheckUsername 只为用户名登记一个带有效期的预留；第一个成功加入房间的
+聊天流确认租约，此后只要还有使用该用户名的聊天流，租约就一直有效；
+最后一个聊天流结束时立即释放。客户端校验用户名后没有打开聊天流（例如
+在大厅中崩溃）时，预留在有效期后自动过期，用户名集合不会只增不减。
+
+预留的到期由哈希时间轮管理：加入、取消和每个到期项都是 O(1)，推进时
+只访问经过的槽，不需要扫描全部用户名。这里的类都不加锁，由调用方持有
+保护用户名的锁。
+"""
+
+import math
+import time
+from typing import Callable, Dict, Hashable, List, Tuple
+
+# 预留的默认有效期（秒）
+DEFAULT_LEASE_TTL = 120.0
+
+# 时间轮的刻度（秒），预留最多比有效期晚一个刻度过期
+DEFAULT_LEASE_TICK = 1.0
+
+
+class TimerWheel:
+    """哈希时间轮：按到期刻度把键放进固定数量的槽中
+
+    槽数不少于 有效期 / 刻度 时，推进到某个槽时其中的键都已到期，
+    每个键只会被访问一次。
+    """
+
+    def __init__(self, tick: float, slots: int, now: float):
+        self.tick = tick
+        # 每个槽: {键: 到期刻度}
+        self._slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        # 键 -> 所在的槽，用于 O(1) 取消
+        self._slot_of: Dict[Hashable, int] = {}
+        # 已经处理到的刻度
+        self._current = int(now / tick)
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """在 deadline（与 now 同一时钟）之后让 key 到期，已存在时重新计时"""
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.tick), self._current + 1)
+        index = tick % len(self._slots)
+        self._slots[index][key] = tick
+        self._slot_of[key] = index
+
+    def cancel(self, key: Hashable) -> bool:
+        index = self._slot_of.pop(key, None)
+        if index is None:
+            return False
+        del self._slots[index][key]
+        return True
+
+    def advance(self, now: float) -> List[Hashable]:
+        """推进到 now，返回其间到期的键"""
+        target = int(now / self.tick)
+        if target <= self._current:
+            return []
+        expired: List[Hashable] = []
+        count = len(self._slots)
+        # 停顿超过一整圈时每个槽也只需访问一次
+        first = max(self._current + 1, target - count + 1)
+        for tick in range(first, target + 1):
+            slot = self._slots[tick % count]
+            if not slot:
+                continue
+            due = [key for key, deadline in slot.items() if deadline <= target]
+            for key in due:
+                del slot[key]
+                del self._slot_of[key]
+            expired.extend(due)
+        self._current = target
+        return expired
+
+
+class _Lease:
+    __slots__ = ("owner", "holders")
+
+    def __init__(self, owner):
+        self.owner = owner
+        # 使用该用户名的聊天流数，为 0 时是尚未确认的预留
+        self.holders = 0
+
+
+class LeaseTable:
+    """用户名 -> 租约
+
+    每个租约可以带一个 owner（如占用它的总线连接方），在租约被移除时
+    返回给调用方，便于同步调用方自己的索引。
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_LEASE_TTL,
+        tick: float = DEFAULT_LEASE_TICK,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if ttl <= 0:
+            raise ValueError("用户名预留的有效期必须大于 0")
+        self.ttl = ttl
+        self._clock = clock
+        self._leases: Dict[str, _Lease] = {}
+        self._wheel = TimerWheel(tick, int(ttl / tick) + 2, clock())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._leases
+
+    def __len__(self) -> int:
+        return len(self._leases)
+
+    @property
+    def reserved_count(self) -> int:
+        """尚未确认的预留数"""
+        return len(self._wheel)
+
+    @property
+    def held_count(self) -> int:
+        """有聊天流在使用的用户名数"""
+        return len(self._leases) - len(self._wheel)
+
+    def names(self) -> List[str]:
+        return list(self._leases)
+
+    def reserve(self, name: str, owner=None) -> bool:
+        """预留用户名，已被预留或使用时返回 False"""
+        if name in self._leases:
+            return False
+        self._leases[name] = _Lease(owner)
+        self._wheel.schedule(name, self._clock() + self.ttl)
+        return True
+
+    def confirm(self, name: str, owner=None, count: int = 1):
+        """count 个聊天流开始使用该用户名，租约不再过期
+
+        没有预留（已过期或未校验就加入）时直接登记。
+        """
+        lease = self._leases.get(name)
+        if lease is None:
+            lease = self._leases[name] = _Lease(owner)
+        if not lease.holders:
+            self._wheel.cancel(name)
+        lease.holders += count
+
+    def release(self, name: str):
+        """一个已确认的聊天流结束，没有聊天流在使用时释放用户名
+
+        Returns:
+            释放时返回租约的 owner，否则返回 None
+        """
+        lease = self._leases.get(name)
+        if lease is None:
+            return None
+        lease.holders -= 1
+        if lease.holders > 0:
+            return None
+        return self.drop(name)
+
+    def discard(self, name: str):
+        """释放尚未确认的预留，有聊天流在使用时保留
+
+        Returns:
+            释放时返回租约的 owner，否则返回 None
+        """
+        lease = self._leases.get(name)
+        if lease is None or lease.holders:
+            return None
+        return self.drop(name)
+
+    def drop(self, name: str):
+        """无条件移除租约，返回它的 owner（不存在时为 None）"""
+        lease = self._leases.pop(name, None)
+        if lease is None:
+            return None
+        self._wheel.cancel(name)
+        return lease.owner
+
+    def expire(self) -> List[Tuple[str, object]]:
+        """移除已过期的预留，返回 [(用户名, owner)]"""
+        expired = []
+        for name in self._wheel.advance(self._clock()):
+            expired.append((name, self._leases.pop(name).owner))
+        return expired
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结构化日志：非阻塞入队，后台线程写出
+
+每条日志是一个事件：事件名（如 "chat.message"）、消息模板和若干字段。
+调用方只做级别检查、按事件的采样与限速，以及把未格式化的记录放入有界
+队列；模板的格式化和对 stdout 的阻塞写入都在后台线程中完成，终端或管道
+的背压不会传导到广播路径上。队列满时直接丢弃并计数。
+
+聊天内容使用单独的 MESSAGE 级别（低于 INFO），默认的 info 级别下逐条
+消息的日志在第一步级别检查时就被跳过。
+"""
+
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional, TextIO
+
+# 聊天内容的日志级别，介于 DEBUG 和 INFO 之间
+MESSAGE = 15
+logging.addLevelName(MESSAGE, "MESSAGE")
+
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "message": MESSAGE,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+LOG_FORMATS = ("text", "json")
+
+# 每种事件每秒最多写出的条数，0 表示不限
+DEFAULT_RATE_LIMIT = 100.0
+# 等待后台线程写出的最大记录数，超过时丢弃新记录
+DEFAULT_QUEUE_SIZE = 10000
+
+_logger = logging.getLogger("grpc_chat")
+_logger.propagate = False
+# 未调用 configure 时（如作为库使用）沿用原来直接写 stdout 的行为
+_logger.setLevel(logging.INFO)
+
+
+class _EventState:
+    """单个事件的采样计数和令牌桶"""
+
+    __slots__ = ("count", "tokens", "updated", "suppressed", "lock")
+
+    def __init__(self, burst: float):
+        self.count = 0
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+
+class _EventFilter:
+    """按事件名采样和限速
+
+    采样保留每 N 条中的第一条；限速使用每种事件一个令牌桶。被跳过的条数
+    记在下一条写出的记录的 suppressed 字段中。
+    """
+
+    def __init__(self, sample: Dict[str, int], rate_limit: float):
+        self.sample = dict(sample)
+        self.rate_limit = rate_limit
+        self._states: Dict[str, _EventState] = {}
+        self._lock = threading.Lock()
+
+    def admit(self, event: str) -> Optional[int]:
+        """
+        Returns:
+            不写出时返回 None，否则返回此前被跳过的条数
+        """
+        state = self._states.get(event)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(
+                    event, _EventState(max(self.rate_limit, 1.0))
+                )
+        every = self.sample.get(event, 1)
+        with state.lock:
+            state.count += 1
+            if every > 1 and (state.count - 1) % every:
+                state.suppressed += 1
+                return None
+            if self.rate_limit > 0:
+                now = time.monotonic()
+                state.tokens = min(
+                    self.rate_limit,
+                    state.tokens + (now - state.updated) * self.rate_limit,
+                )
+                state.updated = now
+                if state.tokens < 1:
+                    state.suppressed += 1
+                    return None
+                state.tokens -= 1
+            suppressed, state.suppressed = state.suppressed, 0
+            return suppressed
+
+
+_filter = _EventFilter({}, 0)
+
+
+def _render(record: logging.LogRecord) -> str:
+    fields = getattr(record, "fields", None)
+    if fields:
+        return str(record.msg).format(**fields)
+    return str(record.msg)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = f"[{record.levelname}] {_render(record)}"
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f"（另有 {suppressed} 条同类日志被省略）"
+        return text
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "event": getattr(record, "event", ""),
+            "msg": _render(record),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """队列满时丢弃记录，不阻塞调用方"""
+
+    def __init__(self, log_queue: "queue.Queue[Any]"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 同一进程内交给后台线程，无需像默认实现那样在调用方线程中格式化
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[QueueListener] = None
+_fallback = logging.StreamHandler(sys.stdout)
+_fallback.setFormatter(_TextFormatter())
+_logger.addHandler(_fallback)
+
+
+def configure(
+    level: str = "info",
+    fmt: str = "text",
+    sample: Optional[Dict[str, int]] = None,
+    rate_limit: float = DEFAULT_RATE_LIMIT,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    stream: Optional[TextIO] = None,
+):
+    """配置日志：级别、格式、按事件的采样和限速，启动后台写出线程
+
+    可以重复调用，新的配置替换旧的配置。
+
+    Args:
+        level: LOG_LEVELS 中的级别名，'info' 及以上不记录聊天内容
+        fmt: 'text' 为 "[级别] 消息" 的文本行，'json' 为每行一个 JSON 对象
+        sample: {事件名: N}，该事件每 N 条只写出 1 条
+        rate_limit: 每种事件每秒最多写出的条数，0 表示不限
+        queue_size: 等待写出的最大记录数
+        stream: 输出流，默认为 stdout
+    """
+    global _listener, _filter
+    if level not in LOG_LEVELS:
+        raise ValueError(f"未知的日志级别: {level}，可选: {', '.join(LOG_LEVELS)}")
+    if fmt not in LOG_FORMATS:
+        raise ValueError(f"未知的日志格式: {fmt}，可选: {', '.join(LOG_FORMATS)}")
+    shutdown()
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(_JsonFormatter() if fmt == "json" else _TextFormatter())
+    log_queue: "queue.Queue[Any]" = queue.Queue(queue_size)
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+    _logger.addHandler(_DroppingQueueHandler(log_queue))
+    _logger.setLevel(LOG_LEVELS[level])
+    _filter = _EventFilter(sample or {}, rate_limit)
+    _listener = QueueListener(log_queue, writer)
+    _listener.start()
+
+
+def shutdown():
+    """写完队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
+
+
+def dropped_count() -> int:
+    """因队列满被丢弃的日志条数"""
+    return sum(
+        handler.dropped
+        for handler in _logger.handlers
+        if isinstance(handler, _DroppingQueueHandler)
+    )
+
+
+def enabled(level: int) -> bool:
+    return _logger.isEnabledFor(level)
+
+
+def log(level: int, event: str, msg: str, **fields: Any):
+    """记录一个事件
+
+    Args:
+        level: 日志级别
+        event: 事件名，采样和限速按事件名分别计算
+        msg: 消息模板，写出时以 fields 做 str.format
+        **fields: 结构化字段
+    """
+    if not _logger.isEnabledFor(level):
+        return
+    suppressed = _filter.admit(event)
+    if suppressed is None:
+        return
+    _logger.log(
+        level,
+        msg,
+        extra={"event": event, "fields": fields, "suppressed": suppressed},
+    )
+
+
+def message(event: str, msg: str, **fields: Any):
+    log(MESSAGE, event, msg, **fields)
+
+
+def debug(event: str, msg: str, **fields: Any):
+    log(logging.DEBUG, event, msg, **fields)
+
+
+def info(event: str, msg: str, **fields: Any):
+    log(logging.INFO, event, msg, **fields)
+
+
+def warning(event: str, msg: str, **fields: Any):
+    log(logging.WARNING, event, msg, **fields)
+
+
+def error(event: str, msg: str, **fields: Any):
+    log(logging.ERROR, event, msg, **fields)
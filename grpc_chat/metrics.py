@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+服务器指标：计数器、直方图，以 Prometheus 文本格式通过 HTTP 暴露
+
+记录指标时不加锁：每个线程写自己的分片（普通 dict，只有所属线程会修改），
+采集时再把所有分片合并。asyncio 模式下所有记录都发生在事件循环线程中，
+只有一个分片。线程结束后它的分片在下一次采集时并入汇总值。
+
+只能在采集时计算的值（当前连接数、各连接的队列深度分布）由回调函数提供，
+不占用广播路径上的任何时间。
+"""
+
+import socket
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from grpc_chat import log
+
+LabelValues = Tuple[str, ...]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 延迟类直方图的默认桶上界（秒）
+LATENCY_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+# 队列深度直方图的桶上界（条）
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(v))}"' for name, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """所有指标的公共部分：名称、说明和标签名"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class _Sharded(_Metric):
+    """按线程分片记录的指标
+
+    每个分片是 {标签值: 数据} 的 dict，只由所属线程写入。
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._local = threading.local()
+        # [(所属线程, 分片)]，只在注册新分片和采集时加锁
+        self._shards: List[Tuple[threading.Thread, Dict[LabelValues, object]]] = []
+        # 已结束线程的分片合并后的值
+        self._retired: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict[LabelValues, object]:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard: Dict[LabelValues, object] = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+            return shard
+
+    def _collect(self) -> Dict[LabelValues, object]:
+        """合并所有分片，同时把已结束线程的分片并入 _retired"""
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    for labels, value in shard.copy().items():
+                        self._merge(self._retired, labels, value)
+            self._shards = live
+            total: Dict[LabelValues, object] = {}
+            for labels, value in self._retired.items():
+                self._merge(total, labels, value)
+            for _, shard in live:
+                for labels, value in shard.copy().items():
+                    self._merge(total, labels, value)
+            return total
+
+    def _merge(self, into: Dict[LabelValues, object], labels: LabelValues, value):
+        raise NotImplementedError
+
+
+class Counter(_Sharded):
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def inc(self, label_values: LabelValues = (), amount: float = 1):
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def _merge(self, into, labels, value):
+        into[labels] = into.get(labels, 0) + value
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} "
+            f"{_format_value(value)}"
+            for labels, value in sorted(self._collect().items())
+        ]
+
+
+def _histogram_lines(
+    name: str,
+    labelnames: Sequence[str],
+    labels: LabelValues,
+    bounds: Sequence[float],
+    row: Sequence[float],
+) -> List[str]:
+    """row 为各桶（含 +Inf）的非累计计数，最后一项为总和"""
+    lines = []
+    cumulative = 0
+    names = tuple(labelnames) + ("le",)
+    for bound, count in zip(tuple(bounds) + (float("inf"),), row):
+        cumulative += count
+        le = _format_labels(names, labels + (_format_value(bound),))
+        lines.append(f"{name}_bucket{le} {cumulative}")
+    base = _format_labels(labelnames, labels)
+    lines.append(f"{name}_sum{base} {_format_value(row[-1])}")
+    lines.append(f"{name}_count{base} {cumulative}")
+    return lines
+
+
+class Histogram(_Sharded):
+    """固定桶的直方图"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, label_values: LabelValues = ()):
+        shard = self._shard()
+        row = shard.get(label_values)
+        if row is None:
+            # 各桶的非累计计数（最后一个是 +Inf），再加上总和
+            row = shard[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def _merge(self, into, labels, value):
+        current = into.get(labels)
+        if current is None:
+            into[labels] = list(value)
+        else:
+            into[labels] = [a + b for a, b in zip(current, value)]
+
+    def _samples(self) -> List[str]:
+        lines: List[str] = []
+        for labels, row in sorted(self._collect().items()):
+            lines.extend(
+                _histogram_lines(self.name, self.labelnames, labels, self.buckets, row)
+            )
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """采集时由回调函数计算的值"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+
+    def set_function(self, function: Callable[[], Dict[LabelValues, float]]):
+        """function 返回 {标签值: 数值}"""
+        self._function = function
+
+    def _samples(self) -> List[str]:
+        if self._function is None:
+            return []
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} "
+            f"{_format_value(value)}"
+            for labels, value in sorted(self._function().items())
+        ]
+
+
+class SnapshotHistogram(_Metric):
+    """采集时由回调函数给出一组当前值，按桶统计分布"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float]):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._function: Optional[Callable[[], Iterable[float]]] = None
+
+    def set_function(self, function: Callable[[], Iterable[float]]):
+        self._function = function
+
+    def _samples(self) -> List[str]:
+        if self._function is None:
+            return []
+        row: List[float] = [0] * (len(self.buckets) + 1) + [0]
+        for value in self._function():
+            row[bisect_left(self.buckets, value)] += 1
+            row[-1] += value
+        return _histogram_lines(self.name, (), (), self.buckets, row)
+
+
+_registry: List[_Metric] = []
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+MESSAGES_RECEIVED = _register(
+    Counter("chat_messages_received_total", "客户端发来的聊天消息数", ("room",))
+)
+MESSAGES_DELIVERED = _register(
+    Counter(
+        "chat_messages_delivered_total",
+        "放入本进程各连接发送队列的聊天消息数",
+        ("room",),
+    )
+)
+MESSAGES_DROPPED = _register(
+    Counter("chat_messages_dropped_total", "因发送队列已满被丢弃的消息数", ("room",))
+)
+MESSAGES_RATE_LIMITED = _register(
+    Counter(
+        "chat_messages_rate_limited_total",
+        "超出限速的聊天消息数（scope 为超出的一级，action 为延迟、丢弃或拒绝）",
+        ("room", "scope", "action"),
+    )
+)
+STREAMS_REJECTED = _register(
+    Counter(
+        "chat_streams_rejected_total",
+        "准入控制拒绝的聊天流和房间列表订阅数（reason 为超出的上限或 draining）",
+        ("reason",),
+    )
+)
+STREAMS_REAPED = _register(
+    Counter("chat_streams_reaped_total", "因长时间没有心跳被服务器回收的聊天流数")
+)
+ACTIVE_STREAMS = _register(CallbackGauge("chat_active_streams", "已加入房间的聊天流数"))
+ROOM_SUBSCRIPTIONS = _register(
+    CallbackGauge(
+        "chat_room_subscriptions",
+        "各聊天流加入的房间数之和（一个聊天流可加入多个房间）",
+    )
+)
+ROOM_WATCHERS = _register(CallbackGauge("chat_room_watchers", "房间列表订阅者数"))
+PARKED_SESSIONS = _register(
+    CallbackGauge("chat_parked_sessions", "意外断开后等待重连的聊天会话数")
+)
+USERNAME_LEASES = _register(
+    CallbackGauge(
+        "chat_username_leases",
+        "用户名租约数（reserved 为尚未加入房间的预留）",
+        ("state",),
+    )
+)
+QUEUED_BYTES = _register(
+    CallbackGauge("chat_queued_bytes", "所有聊天流发送队列中等待发送的字节数")
+)
+QUEUE_DEPTH = _register(
+    SnapshotHistogram(
+        "chat_stream_queue_depth", "采集时各聊天流发送队列中的消息数", DEPTH_BUCKETS
+    )
+)
+FANOUT_LATENCY = _register(
+    Histogram(
+        "chat_fanout_latency_seconds", "聊天消息从开始广播到被发送方从队列取出的时间"
+    )
+)
+LOCK_WAIT = _register(Histogram("chat_lock_wait_seconds", "等待锁的时间", ("lock",)))
+LOG_DROPPED = _register(
+    CallbackGauge(
+        "chat_log_dropped_total", "因日志队列已满被丢弃的日志条数", kind="counter"
+    )
+)
+LOG_DROPPED.set_function(lambda: {(): log.dropped_count()})
+
+
+def render() -> str:
+    """以 Prometheus 文本格式输出所有指标"""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不把每次采集写进服务器日志
+        pass
+
+
+def start_http_server(host: str, port: int) -> ThreadingHTTPServer:
+    """在后台线程中提供 GET /metrics
+
+    Args:
+        host: 监听地址，可以是 gRPC 使用的 '[::]' 形式
+        port: 监听端口
+    """
+    host = host.strip("[]")
+    server_class = ThreadingHTTPServer
+    if ":" in host:
+
+        class _V6Server(ThreadingHTTPServer):
+            address_family = socket.AF_INET6
+
+        server_class = _V6Server
+    server = server_class((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="chat-metrics", daemon=True
+    ).start()
+    log.info(
+        "metrics.start",
+        "指标接口已启动: http://{host}:{port}/metrics",
+        host=f"[{host}]" if ":" in host else host,
+        port=port,
+    )
+    return server
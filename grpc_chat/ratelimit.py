@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天消息的令牌桶限速
+
+每条聊天消息的广播代价与房间人数成正比，一个循环发送的客户端会把负载
+放大到整个房间。消息在广播之前依次经过用户、房间和全服务器三个令牌桶，
+三者都有令牌时才放行。
+
+令牌桶不使用定时器：每次取令牌时按距上次的时间补充，每个活跃用户只占
+一个固定大小的对象，用户离开后由调用方移除。所有桶共用一把锁，锁内只有
+几次浮点运算；asyncio 模式下所有调用都在事件循环线程中，锁不会发生竞争。
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+SCOPE_USER = "user"
+SCOPE_ROOM = "room"
+SCOPE_SERVER = "server"
+
+# 超出限额时的处理方式
+RATE_LIMIT_DROP = "drop"  # 直接丢弃消息
+RATE_LIMIT_DELAY = "delay"  # 暂停读取该聊天流，等到有令牌再转发
+RATE_LIMIT_REJECT = "reject"  # 丢弃消息并在流上发送 RateLimited 事件
+RATE_LIMIT_POLICIES = (RATE_LIMIT_DROP, RATE_LIMIT_DELAY, RATE_LIMIT_REJECT)
+
+# delay 策略下一条消息最多等待的秒数，超过时按丢弃处理，
+# 避免读取长时间停顿导致心跳检查回收该聊天流
+MAX_RATE_LIMIT_DELAY = 5.0
+
+
+class TokenBucket:
+    """每秒补充 rate 个令牌、最多积累 burst 个的令牌桶，可以透支"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """补充令牌，返回还需等待多少秒才有一个令牌"""
+        if now > self.updated:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """用户、房间和全服务器三级令牌桶
+
+    rate 为 0 的一级不限速；burst 为 0 时取 max(1, rate)，即一秒的量。
+    """
+
+    def __init__(
+        self,
+        user_rate: float = 0.0,
+        user_burst: float = 0.0,
+        room_rate: float = 0.0,
+        room_burst: float = 0.0,
+        server_rate: float = 0.0,
+        server_burst: float = 0.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        limits = (
+            user_rate,
+            user_burst,
+            room_rate,
+            room_burst,
+            server_rate,
+            server_burst,
+        )
+        if min(limits) < 0:
+            raise ValueError("速率和突发量不能为负数")
+        self._clock = clock
+        self._user_limit = (user_rate, _burst(user_rate, user_burst))
+        self._room_limit = (room_rate, _burst(room_rate, room_burst))
+        self._users: Dict[str, TokenBucket] = {}
+        self._rooms: Dict[str, TokenBucket] = {}
+        self._server: Optional[TokenBucket] = None
+        if server_rate > 0:
+            self._server = TokenBucket(
+                server_rate, _burst(server_rate, server_burst), clock()
+            )
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._user_limit[0] or self._room_limit[0] or self._server)
+
+    def acquire(
+        self, user_name: str, room_id: str, max_wait: float = 0.0
+    ) -> Tuple[float, str]:
+        """为一条消息取令牌
+
+        最紧张的一级需要等待的时间不超过 max_wait 时从三级各取一个令牌
+        （可能透支），调用方等待返回的秒数后再转发；超过时不取令牌。
+
+        Returns:
+            (需要等待的秒数, 最紧张的一级)，不需要等待时一级为空字符串
+        """
+        with self._lock:
+            now = self._clock()
+            buckets = []
+            if self._user_limit[0]:
+                bucket = self._users.get(user_name)
+                if bucket is None:
+                    bucket = self._users[user_name] = TokenBucket(
+                        *self._user_limit, now
+                    )
+                buckets.append((bucket, SCOPE_USER))
+            if self._room_limit[0]:
+                bucket = self._rooms.get(room_id)
+                if bucket is None:
+                    bucket = self._rooms[room_id] = TokenBucket(*self._room_limit, now)
+                buckets.append((bucket, SCOPE_ROOM))
+            if self._server is not None:
+                buckets.append((self._server, SCOPE_SERVER))
+            wait = 0.0
+            scope = ""
+            for bucket, name in buckets:
+                bucket_wait = bucket.wait_time(now)
+                if bucket_wait > wait:
+                    wait = bucket_wait
+                    scope = name
+            if wait <= max_wait:
+                for bucket, _ in buckets:
+                    bucket.tokens -= 1
+            return wait, scope
+
+    def forget_user(self, user_name: str):
+        """用户离开所有房间后移除其令牌桶"""
+        with self._lock:
+            self._users.pop(user_name, None)
+
+    def forget_room(self, room_id: str):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+
+def _burst(rate: float, burst: float) -> float:
+    return burst or max(1.0, rate)
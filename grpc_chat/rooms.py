@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天室注册表
+
+每个房间拥有自己的锁，不同房间之间的加入、离开和广播互不阻塞。
+订阅者列表以不可变元组的形式发布：写入方在房间锁内整体替换元组，
+读取方（广播、人数统计）直接读取当前引用，无需加锁。
+
+每个房间还保存最近消息的环形缓冲区，供新加入的用户回放。
+
+一个聊天流可以加入多个房间，Memberships 记录每个用户所在的房间。
+"""
+
+import heapq
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from grpc_chat import metrics
+
+DEFAULT_ROOM_CAPACITY = 20
+# 每个房间保留的历史消息条数
+DEFAULT_HISTORY_SIZE = 100
+
+# 比任何字符都大的字符，用于计算前缀范围的上界
+_MAX_CHAR = chr(0x10FFFF)
+
+
+def select_history(
+    history: Deque[Tuple[int, bytes]], replay_last: int, replay_since: Optional[int]
+) -> List[bytes]:
+    """从序号连续的历史中截取回放消息
+
+    Args:
+        history: [(序号, 预编码消息)]
+        replay_last: 回放最近 N 条消息
+        replay_since: 回放序号大于该值的消息，优先于 replay_last
+    """
+    if not history:
+        return []
+    if replay_since is not None:
+        # 序号连续，可以直接换算出起始位置
+        start = max(0, replay_since + 1 - history[0][0])
+    elif replay_last > 0:
+        start = max(0, len(history) - replay_last)
+    else:
+        return []
+    return [payload for _, payload in islice(history, start, None)]
+
+
+class Room:
+    """单个聊天室"""
+
+    def __init__(
+        self,
+        room_id: str,
+        max_capacity: int = DEFAULT_ROOM_CAPACITY,
+        history_size: int = DEFAULT_HISTORY_SIZE,
+    ):
+        self.room_id = room_id
+        self.max_capacity = max_capacity
+        # 房间锁：只保护成员变更，持有时间极短
+        self.lock = threading.Lock()
+        # 广播锁：保证同一房间内的消息以相同顺序到达所有成员
+        self.publish_lock = threading.Lock()
+        self.handlers: Dict[str, Any] = {}
+        # 订阅者快照，只在房间锁内整体替换
+        self.subscribers: Tuple[Any, ...] = ()
+        # 最近消息的环形缓冲区 [(序号, 预编码消息)]，序号连续递增
+        self.history: Deque[Tuple[int, bytes]] = deque(maxlen=history_size)
+        # 最近一条消息的序号，只在广播锁内修改
+        self.last_sequence = 0
+        # 可选的持久化日志，需提供 append(room_id, sequence, payload)
+        self.log: Any = None
+        # 房间被删除后置为 True，之后不再接受加入
+        self.closed = False
+        # 多进程模式下由房间总线同步的全局在线人数，单进程时为 None
+        self.global_count: Optional[int] = None
+
+    @property
+    def participant_count(self) -> int:
+        """当前在线人数（无锁读取）"""
+        if self.global_count is not None:
+            return self.global_count
+        return len(self.subscribers)
+
+    def add(
+        self,
+        user_name: str,
+        handler: Any,
+        replay_last: int = 0,
+        replay_since: Optional[int] = None,
+        on_added: Optional[Callable[[int, List[bytes]], Any]] = None,
+    ) -> Tuple[bool, int, List[bytes], int]:
+        """加入房间，容量检查与加入是原子的
+
+        加入与历史快照在广播锁内同时完成，因此回放的消息与之后实时收到的
+        消息之间既不会重复也不会遗漏。快照只复制引用，回放本身由调用方在
+        锁外完成。加入时的最后序号记在 handler.sequences[房间ID] 中。
+
+        Args:
+            user_name: 用户名
+            handler: 连接处理器
+            replay_last: 回放最近 N 条消息
+            replay_since: 回放序号大于该值的消息，优先于 replay_last
+            on_added: 加入成功时在锁内以 (人数, 回放消息) 调用，用于已在接收
+                其他房间消息的处理器把加入响应和回放排在本房间的实时消息之前
+
+        Returns:
+            (是否成功, 加入后的人数, 需要回放的预编码消息, 内存历史中第一条消息的序号)
+            更早的消息需要由调用方从持久化日志中读取。
+        """
+        with self.publish_lock, self.lock:
+            history_start = (
+                self.history[0][0] if self.history else self.last_sequence + 1
+            )
+            if self.closed or len(self.handlers) >= self.max_capacity:
+                return False, len(self.handlers), [], history_start
+            self.handlers[user_name] = handler
+            self.subscribers = tuple(self.handlers.values())
+            handler.sequences[self.room_id] = self.last_sequence
+            replay = self._select_history(replay_last, replay_since)
+            if on_added is not None:
+                on_added(len(self.handlers), replay)
+            return True, len(self.handlers), replay, history_start
+
+    def resume(self, handler: Any, replay_since: int) -> Optional[List[bytes]]:
+        """恢复暂时断开、仍登记在房间中的处理器
+
+        与 add 相同，回放快照和重新开始接收在广播锁内同时完成。
+
+        Returns:
+            序号大于 replay_since 的历史消息；处理器已不在房间中时返回 None
+        """
+        with self.publish_lock, self.lock:
+            if self.handlers.get(handler.user_name) is not handler:
+                return None
+            replay = self._select_history(0, replay_since)
+            handler.reopen(self.last_sequence)
+            return replay
+
+    def _select_history(
+        self, replay_last: int, replay_since: Optional[int]
+    ) -> List[bytes]:
+        """按条件截取历史消息（调用时已持有广播锁）"""
+        return select_history(self.history, replay_last, replay_since)
+
+    def remove(self, user_name: str, handler: Any = None) -> Tuple[Any, int]:
+        """离开房间
+
+        Args:
+            user_name: 用户名
+            handler: 若指定，只有当房间内登记的正是该处理器时才移除
+
+        Returns:
+            (被移除的处理器或 None, 移除后的人数)
+        """
+        with self.lock:
+            current = self.handlers.get(user_name)
+            if current is None or (handler is not None and current is not handler):
+                return None, len(self.handlers)
+            del self.handlers[user_name]
+            self.subscribers = tuple(self.handlers.values())
+            return current, len(self.handlers)
+
+    def publish(
+        self, encode: Callable[[int], bytes], sent_at: Optional[float] = None
+    ) -> int:
+        """广播一条带序号的消息并写入历史
+
+        Args:
+            encode: 根据分配到的序号生成预编码消息
+            sent_at: 开始广播的时间（time.perf_counter），用于统计扇出延迟
+
+        Returns:
+            分配给该消息的序号
+        """
+        waiting = time.perf_counter()
+        with self.publish_lock:
+            metrics.LOCK_WAIT.observe(time.perf_counter() - waiting, ("room_publish",))
+            sequence = self.last_sequence + 1
+            self._deliver(sequence, encode(sequence), sent_at or waiting)
+            return sequence
+
+    def deliver(self, sequence: int, payload: bytes, sent_at: Optional[float] = None):
+        """广播一条已由房间总线分配好序号的消息并写入历史"""
+        waiting = time.perf_counter()
+        with self.publish_lock:
+            metrics.LOCK_WAIT.observe(time.perf_counter() - waiting, ("room_publish",))
+            self._deliver(sequence, payload, sent_at or waiting)
+
+    def _deliver(self, sequence: int, payload: bytes, sent_at: float):
+        """调用时已持有广播锁"""
+        self.last_sequence = sequence
+        self.history.append((sequence, payload))
+        if self.log is not None:
+            self.log.append(self.room_id, sequence, payload)
+        subscribers = self.subscribers
+        room_id = self.room_id
+        for handler in subscribers:
+            handler.send_message(payload, sent_at, sequence, room_id)
+        metrics.MESSAGES_DELIVERED.inc((self.room_id,), len(subscribers))
+
+    def restore(self, last_sequence: int, payloads: List[bytes]):
+        """从持久化日志恢复序号和最近的历史消息（启动时调用）
+
+        Args:
+            last_sequence: 已持久化的最后一条消息的序号
+            payloads: 以 last_sequence 结尾的连续若干条消息
+        """
+        with self.publish_lock:
+            self.last_sequence = last_sequence
+            self.history.clear()
+            first = last_sequence - len(payloads) + 1
+            for offset, payload in enumerate(payloads):
+                self.history.append((first + offset, payload))
+
+    def broadcast(self, message: Any, exclude: Any = None):
+        """向房间内所有成员发送消息
+
+        只在广播锁内遍历订阅者快照，不会阻塞本房间的加入和离开，
+        也不会影响其他房间。
+        """
+        with self.publish_lock:
+            for handler in self.subscribers:
+                if handler is not exclude:
+                    handler.send_message(message)
+
+
+class Memberships:
+    """用户 -> 所在房间ID 的索引
+
+    按用户查找所在房间不需要遍历所有房间。每个用户的房间以不可变元组
+    发布，只在锁内整体替换，读取方无需加锁。
+    """
+
+    def __init__(self):
+        self._rooms: Dict[str, Tuple[str, ...]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_name: str, room_id: str):
+        with self._lock:
+            rooms = self._rooms.get(user_name, ())
+            if room_id not in rooms:
+                self._rooms[user_name] = rooms + (room_id,)
+
+    def discard(self, user_name: str, room_id: str) -> int:
+        """
+        Returns:
+            该用户剩余的房间数
+        """
+        with self._lock:
+            rooms = tuple(r for r in self._rooms.get(user_name, ()) if r != room_id)
+            if rooms:
+                self._rooms[user_name] = rooms
+            else:
+                self._rooms.pop(user_name, None)
+            return len(rooms)
+
+    def rooms(self, user_name: str) -> Tuple[str, ...]:
+        """用户所在的房间，按加入顺序（无锁读取）"""
+        return self._rooms.get(user_name, ())
+
+    def __contains__(self, user_name: str) -> bool:
+        return user_name in self._rooms
+
+    def __len__(self) -> int:
+        """至少在一个房间中的用户数"""
+        return len(self._rooms)
+
+    def subscription_count(self) -> int:
+        """所有用户所在房间数之和"""
+        return sum(len(rooms) for rooms in list(self._rooms.values()))
+
+
+class RoomRegistry:
+    """房间注册表
+
+    除了按ID查找的字典外，还维护一个按房间ID排序的列表，用于前缀过滤和
+    分页。两者都只在创建、删除房间时修改；排序列表采用写时复制，读取方
+    拿到的始终是一个不会再变化的列表，无需加锁。
+    """
+
+    def __init__(self):
+        self._rooms: Dict[str, Room] = {}
+        self._sorted_ids: List[str] = []
+        # 只在创建和删除房间时使用
+        self._lock = threading.Lock()
+
+    def create(
+        self,
+        room_id: str,
+        max_capacity: int = DEFAULT_ROOM_CAPACITY,
+        history_size: int = DEFAULT_HISTORY_SIZE,
+    ) -> Tuple[Room, bool]:
+        """创建房间
+
+        Returns:
+            (房间, 是否为新建)；房间已存在时返回已有房间
+        """
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is not None:
+                return room, False
+            room = Room(room_id, max_capacity, history_size)
+            sorted_ids = list(self._sorted_ids)
+            insort(sorted_ids, room_id)
+            self._rooms[room_id] = room
+            self._sorted_ids = sorted_ids
+            return room, True
+
+    def delete(self, room_id: str) -> Tuple[bool, str]:
+        """删除空房间
+
+        Returns:
+            (是否成功, 提示信息)
+        """
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return False, f"房间 '{room_id}' 不存在"
+            with room.lock:
+                if room.handlers:
+                    return False, f"房间 '{room_id}' 中还有 {len(room.handlers)} 人"
+                room.closed = True
+            del self._rooms[room_id]
+            sorted_ids = list(self._sorted_ids)
+            del sorted_ids[bisect_left(sorted_ids, room_id)]
+            self._sorted_ids = sorted_ids
+            return True, f"房间 '{room_id}' 已删除"
+
+    def get(self, room_id: str) -> Optional[Room]:
+        """按ID查找房间（无锁读取）"""
+        return self._rooms.get(room_id)
+
+    def snapshot(self) -> Tuple[Room, ...]:
+        """所有房间的快照（无锁读取）"""
+        return tuple(self._rooms.values())
+
+    def _prefix_range(self, ids: List[str], prefix: str) -> Tuple[int, int]:
+        """ID 以 prefix 开头的房间在排序列表中的下标范围"""
+        if not prefix:
+            return 0, len(ids)
+        return bisect_left(ids, prefix), bisect_left(ids, prefix + _MAX_CHAR)
+
+    def count(self, prefix: str = "") -> int:
+        """ID 以 prefix 开头的房间数，O(log n)"""
+        start, end = self._prefix_range(self._sorted_ids, prefix)
+        return end - start
+
+    def with_prefix(self, prefix: str) -> List[Room]:
+        """ID 以 prefix 开头的所有房间，按ID升序"""
+        ids = self._sorted_ids
+        start, end = self._prefix_range(ids, prefix)
+        rooms = self._rooms
+        return [rooms[room_id] for room_id in ids[start:end] if room_id in rooms]
+
+    def page_by_name(
+        self, prefix: str, after: str, limit: int
+    ) -> Tuple[List[Room], bool]:
+        """按房间ID升序分页
+
+        Args:
+            prefix: 房间ID前缀
+            after: 上一页最后一个房间ID，为空表示第一页
+            limit: 每页数量
+
+        Returns:
+            (本页房间, 是否还有下一页)
+        """
+        ids = self._sorted_ids
+        start, end = self._prefix_range(ids, prefix)
+        if after:
+            start = max(start, bisect_right(ids, after))
+        page = []
+        for room_id in ids[start : min(end, start + limit + 1)]:
+            room = self._rooms.get(room_id)
+            if room is not None:
+                page.append(room)
+        return page[:limit], len(page) > limit
+
+    def page_by_participants(
+        self, prefix: str, offset: int, limit: int
+    ) -> Tuple[List[Room], bool]:
+        """按在线人数降序（人数相同按ID升序）分页，O(n log(offset + limit))
+
+        Returns:
+            (本页房间, 是否还有下一页)
+        """
+        top = heapq.nsmallest(
+            offset + limit + 1,
+            self.with_prefix(prefix),
+            key=lambda room: (-room.participant_count, room.room_id),
+        )
+        return top[offset : offset + limit], len(top) > offset + limit
+
+    def __contains__(self, room_id: str) -> bool:
+        return room_id in self._rooms
+
+    def __iter__(self) -> Iterator[Room]:
+        return iter(self.snapshot())
+
+    def __len__(self) -> int:
+        return len(self._rooms)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+线程模式下的延迟回调
+
+心跳回收每个刻度调度一次，断开的会话和房间列表合并窗口也各自调度，
+每次都新建一个 threading.Timer 线程开销太大。这里用一个常驻的后台线程
+按到期时间依次执行所有回调，线程在第一次调度时才创建。回调在同一个
+线程中串行执行，应当很快返回。
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from grpc_chat import log
+
+
+class Scheduler:
+    """到期时间最小堆 + 一个执行回调的后台线程"""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        # (到期时间, 调度顺序, 回调)，调度顺序保证同一时间的回调先来先执行
+        self._heap: List[Tuple[float, int, Callable[[], None]]] = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        """在 delay 秒后于后台线程中调用 callback，停止后忽略"""
+        with self._cond:
+            if self._stopped:
+                return
+            entry = (self._clock() + delay, next(self._order), callback)
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="chat-scheduler", daemon=True
+                )
+                self._thread.start()
+            elif self._heap[0] is entry:
+                # 比正在等待的回调更早到期，唤醒后台线程重新计算等待时间
+                self._cond.notify()
+
+    def stop(self):
+        """丢弃尚未到期的回调并结束后台线程"""
+        with self._cond:
+            self._stopped = True
+            self._heap.clear()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - self._clock()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if self._stopped:
+                    return
+                _, _, callback = heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception as e:
+                log.error("scheduler.error", "执行延迟回调时出错: {error}", error=e)
@@ -0,0 +1,969 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天客户端库，不依赖 tkinter
+
+提供同步（ChatClient，基于线程和回调）和异步（AsyncChatClient，基于
+grpc.aio 和异步迭代器）两套接口，GUI、机器人和压测工具都建立在它之上。
+
+一个客户端对象持有一条长期使用的 gRPC 连接，所有 RPC 和聊天会话共用；
+加入房间得到一个会话，服务器发来的批量消息在库内展开，调用方只会看到
+单个事件：BroadcastMessage、UserJoinedNotification、UserLeftNotification、
+MessagesDropped 和 RateLimited（均为 chat_pb2 中的消息类型）。一个会话可以用
+join_room 在同一个聊天流上再加入其他房间，按 (房间ID, 事件) 接收。
+
+发送不经过轮询：同步会话的请求迭代器阻塞在队列上，有消息时立即发出；
+异步会话直接写入流。会话默认按服务器要求的间隔发送心跳，服务器据此
+及时回收失联客户端的聊天流；心跳的回送不会作为事件出现。
+
+示例:
+    async with AsyncChatClient("localhost:50051") as client:
+        await client.check_username("bot")
+        session = await client.join("bot", "general")
+        async for event in session:
+            if isinstance(event, chat_pb2.BroadcastMessage):
+                await session.send(f"收到: {event.text}")
+"""
+
+import asyncio
+import queue
+import random
+import threading
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import grpc
+
+# 这里IDE可能会因为对chat_pb2和chat_pb2_grpc的import报错，忽略即可
+import chat_pb2  # type: ignore
+import chat_pb2_grpc  # type: ignore
+
+ChatEvent = Union[
+    "chat_pb2.BroadcastMessage",
+    "chat_pb2.UserJoinedNotification",
+    "chat_pb2.UserLeftNotification",
+    "chat_pb2.MessagesDropped",
+    "chat_pb2.RateLimited",
+    "chat_pb2.ServerDraining",
+]
+
+
+# 客户端连接的默认参数，调用方传入的同名参数优先：
+# - 有进行中的 RPC 时每 30 秒发送一次 keepalive ping（服务器允许的最小间隔为
+#   10 秒），10 秒没有应答即认为连接已断开，不必等待 TCP 超时
+# - 连接断开后按指数退避重连，最长间隔 5 秒，而不是 gRPC 默认的 120 秒
+DEFAULT_CHANNEL_OPTIONS = (
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.initial_reconnect_backoff_ms", 250),
+    ("grpc.min_reconnect_backoff_ms", 250),
+    ("grpc.max_reconnect_backoff_ms", 5000),
+)
+
+# ChatClient.reconnect 的默认总时长和两次尝试之间的等待（秒）
+DEFAULT_RECONNECT_TIMEOUT = 60.0
+RECONNECT_INITIAL_BACKOFF = 0.5
+RECONNECT_MAX_BACKOFF = 5.0
+
+# 连接中断、服务器重启或回收聊天流时的状态码，可以重连后恢复会话
+RETRYABLE_CODES = (
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.INTERNAL,
+    grpc.StatusCode.UNKNOWN,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+)
+
+
+class JoinError(Exception):
+    """服务器拒绝了加入请求（房间不存在、已满等），或等待应答超时"""
+
+
+class JoinTimeout(JoinError):
+    """等待加入应答超时"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """error 是否是连接问题，重连后可以恢复会话"""
+    if isinstance(error, JoinTimeout):
+        return True
+    return isinstance(error, grpc.RpcError) and error.code() in RETRYABLE_CODES
+
+
+def _retry_pushback(error: Exception) -> float:
+    """服务器在 trailing metadata 中建议的重试间隔（秒），没有时为 0"""
+    if not isinstance(error, grpc.RpcError):
+        return 0.0
+    for key, value in error.trailing_metadata() or ():
+        if key == "grpc-retry-pushback-ms" and value.isdigit():
+            return int(value) / 1000
+    return 0.0
+
+
+def channel_options(options: Optional[List[Any]] = None) -> List[Any]:
+    """在 DEFAULT_CHANNEL_OPTIONS 上应用调用方的通道参数"""
+    merged = dict(DEFAULT_CHANNEL_OPTIONS)
+    merged.update(options or ())
+    return list(merged.items())
+
+
+def _join_message(
+    user_name: str,
+    room_id: str,
+    replay_last: int,
+    replay_since: Optional[int],
+    accept_batches: bool,
+    resume_token: str = "",
+    heartbeats: bool = True,
+    resumable: bool = False,
+):
+    join = chat_pb2.JoinRequest(
+        user_name=user_name,
+        room_id=room_id,
+        accept_batches=accept_batches,
+        resume_token=resume_token,
+        heartbeats=heartbeats,
+        resumable=resumable,
+    )
+    if replay_since is not None:
+        join.replay_since = replay_since
+    elif replay_last:
+        join.replay_last = replay_last
+    return chat_pb2.ClientMessage(join_request=join)
+
+
+def _chat_message(text: str, room_id: str = ""):
+    chat = chat_pb2.ChatMessage(text=text, room_id=room_id)
+    return chat_pb2.ClientMessage(chat_message=chat)
+
+
+def _heartbeat_message():
+    heartbeat = chat_pb2.Heartbeat(timestamp_ms=int(time.time() * 1000))
+    return chat_pb2.ClientMessage(heartbeat=heartbeat)
+
+
+def _leave_message(user_name: str, room_id: str):
+    leave = chat_pb2.LeaveRequest(user_name=user_name, room_id=room_id)
+    return chat_pb2.ClientMessage(leave_request=leave)
+
+
+def _list_rooms_request(
+    name_prefix: str, page_size: int, page_token: str, sort_by_participants: bool
+):
+    return chat_pb2.ListRoomsRequest(
+        page_size=page_size,
+        page_token=page_token,
+        name_prefix=name_prefix,
+        sort_by=(
+            chat_pb2.ROOM_SORT_BY_PARTICIPANTS
+            if sort_by_participants
+            else chat_pb2.ROOM_SORT_BY_NAME
+        ),
+    )
+
+
+def iter_room_events(server_message, room_id: str = "") -> Iterator[Tuple[str, Any]]:
+    """把一条 ServerMessage 展开为 (房间ID, 事件)，包括加入响应
+
+    没有标记房间的事件（旧版服务器、MessagesDropped 等与整个流有关的
+    事件）归入 room_id。
+    """
+    if server_message.HasField("batch"):
+        for event in server_message.batch.events:
+            yield from iter_room_events(event, room_id)
+        return
+    kind = server_message.WhichOneof("event")
+    if kind not in (None, "heartbeat"):
+        yield server_message.room_id or room_id, getattr(server_message, kind)
+
+
+def iter_events(server_message) -> Iterator[ChatEvent]:
+    """把一条 ServerMessage 展开为事件，批量消息按顺序逐个返回"""
+    for _, event in iter_room_events(server_message):
+        if not isinstance(event, chat_pb2.JoinResponse):
+            yield event
+
+
+class ChatHandlers:
+    """同步会话的事件回调，按需覆盖
+
+    所有回调都在会话的读取线程中依次调用，on_joined 先于任何其他事件。
+    """
+
+    def on_joined(self, message: str):
+        """加入成功，message 为服务器的欢迎信息"""
+
+    def on_message(self, message: "chat_pb2.BroadcastMessage"):
+        """房间内的聊天消息（包括自己发送的）"""
+
+    def on_user_joined(self, event: "chat_pb2.UserJoinedNotification"):
+        """其他用户加入房间"""
+
+    def on_user_left(self, event: "chat_pb2.UserLeftNotification"):
+        """其他用户离开房间"""
+
+    def on_messages_dropped(self, event: "chat_pb2.MessagesDropped"):
+        """服务器因接收过慢跳过了若干条消息"""
+
+    def on_rate_limited(self, event: "chat_pb2.RateLimited"):
+        """自己发送的消息超出服务器的限速，没有被转发"""
+
+    def on_draining(self, event: "chat_pb2.ServerDraining"):
+        """服务器即将关闭，会话随后结束，reconnect 会先等待建议的重连时间"""
+
+    def on_closed(self, error: Optional[Exception]):
+        """会话结束，正常离开或主动关闭时 error 为 None"""
+
+    def on_room_event(self, room_id: str, event: ChatEvent):
+        """任一房间的事件，默认按类型分发给上面的回调
+
+        加入了多个房间时覆盖它以区分事件来自哪个房间。
+        """
+        _dispatch(self, event)
+
+
+def _dispatch(handlers: ChatHandlers, event: ChatEvent):
+    if isinstance(event, chat_pb2.BroadcastMessage):
+        handlers.on_message(event)
+    elif isinstance(event, chat_pb2.UserJoinedNotification):
+        handlers.on_user_joined(event)
+    elif isinstance(event, chat_pb2.UserLeftNotification):
+        handlers.on_user_left(event)
+    elif isinstance(event, chat_pb2.MessagesDropped):
+        handlers.on_messages_dropped(event)
+    elif isinstance(event, chat_pb2.RateLimited):
+        handlers.on_rate_limited(event)
+    elif isinstance(event, chat_pb2.ServerDraining):
+        handlers.on_draining(event)
+
+
+class ChatSession:
+    """同步聊天会话：一个 Chat 流和一个读取线程
+
+    由 ChatClient.join 创建。send、join_room 和 leave 可以在任意线程中调用，
+    但不能在事件回调中调用 join_room（它要等读取线程处理加入应答）。
+    """
+
+    def __init__(self, stub, handlers: ChatHandlers, join_message):
+        join = join_message.join_request
+        self.user_name = join.user_name
+        self.room_id = join.room_id
+        self.handlers = handlers
+        self.accept_batches = join.accept_batches
+        self.heartbeats = join.heartbeats
+        self.resumable = join.resumable
+        # 加入成功后服务器的欢迎信息
+        self.welcome = ""
+        # 断线后用 ChatClient.resume 恢复会话所需的信息
+        self.resume_token = ""
+        # 已加入的房间 -> 收到的最大消息序号，第一个是 room_id
+        self.sequences: Dict[str, int] = {}
+        # 等待应答的 join_room 请求: 房间ID -> (唤醒事件, [加入响应])
+        self._room_joins: Dict[str, Tuple[threading.Event, List[Any]]] = {}
+        # 是否恢复了之前断开的会话
+        self.resumed = False
+        # 服务器关闭前建议的重连等待秒数，收到 ServerDraining 时设置
+        self.reconnect_after = 0.0
+        self._outgoing: "queue.Queue[Any]" = queue.Queue()
+        self._outgoing.put(join_message)
+        # 读取到 None 时结束请求流；get 阻塞等待，不需要轮询
+        self._stream = stub.Chat(iter(self._outgoing.get, None))
+        self._joined = threading.Event()
+        self._join_error: Optional[Exception] = None
+        self._closed = threading.Event()
+        self._closing = False
+        self._thread = threading.Thread(
+            target=self._read, name=f"chat-session-{self.user_name}", daemon=True
+        )
+        self._thread.start()
+
+    def _wait_joined(self, timeout: Optional[float]):
+        if not self._joined.wait(timeout):
+            self.close()
+            raise JoinTimeout("等待加入应答超时")
+        if self._join_error is not None:
+            raise self._join_error
+
+    def _read(self):
+        error: Optional[Exception] = None
+        try:
+            responses = iter(self._stream)
+            first = next(responses, None)
+            if first is None or not first.HasField("join_response"):
+                self._join_error = JoinError("服务器未返回加入应答")
+                return
+            if not first.join_response.success:
+                self._join_error = JoinError(first.join_response.message)
+                return
+            self._on_join_response(first.join_response)
+            interval = first.join_response.heartbeat_interval_ms / 1000
+            if self.heartbeats and interval > 0:
+                threading.Thread(
+                    target=self._send_heartbeats,
+                    args=(interval,),
+                    name=f"chat-heartbeat-{self.user_name}",
+                    daemon=True,
+                ).start()
+            self._joined.set()
+            self.handlers.on_joined(self.welcome)
+            for server_message in responses:
+                for room_id, event in iter_room_events(server_message, self.room_id):
+                    if isinstance(event, chat_pb2.JoinResponse):
+                        self._on_room_join_response(room_id, event)
+                        continue
+                    if isinstance(event, chat_pb2.BroadcastMessage):
+                        sequences = self.sequences
+                        if event.sequence > sequences.get(room_id, 0):
+                            sequences[room_id] = event.sequence
+                    elif isinstance(event, chat_pb2.ServerDraining):
+                        self.reconnect_after = event.reconnect_after_ms / 1000
+                    self.handlers.on_room_event(room_id, event)
+        except grpc.RpcError as e:
+            if not self._closing:
+                error = e
+            if not self._joined.is_set():
+                self._join_error = e
+        finally:
+            self._outgoing.put(None)
+            joined = self._joined.is_set()
+            self._joined.set()
+            self._closed.set()
+            for done, _ in list(self._room_joins.values()):
+                done.set()
+            if joined:
+                self.handlers.on_closed(error)
+
+    def _on_join_response(self, join_response):
+        self.welcome = join_response.message
+        self.resume_token = join_response.resume_token
+        self.sequences[self.room_id] = join_response.last_sequence
+        self.resumed = join_response.resumed
+
+    def _on_room_join_response(self, room_id: str, join_response):
+        if join_response.success:
+            self.sequences[room_id] = join_response.last_sequence
+        pending = self._room_joins.pop(room_id, None)
+        if pending is not None:
+            done, result = pending
+            result.append(join_response)
+            done.set()
+
+    @property
+    def last_sequence(self) -> int:
+        """第一个房间中收到的最大消息序号"""
+        return self.sequences.get(self.room_id, 0)
+
+    @property
+    def rooms(self) -> List[str]:
+        """已加入的房间，按加入顺序"""
+        return list(self.sequences)
+
+    def _send_heartbeats(self, interval: float):
+        # 会话结束后放入的心跳在 None 之后，不会被发出
+        while not self._closed.wait(interval):
+            self._outgoing.put(_heartbeat_message())
+
+    @property
+    def active(self) -> bool:
+        return not self._closed.is_set()
+
+    def send(self, text: str, room_id: str = ""):
+        """发送一条聊天消息，room_id 为空时发往第一个房间"""
+        self._outgoing.put(_chat_message(text, room_id))
+
+    def join_room(
+        self,
+        room_id: str,
+        replay_last: int = 0,
+        replay_since: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> str:
+        """在同一个聊天流上再加入一个房间，阻塞到服务器应答为止
+
+        该房间的事件通过 ChatHandlers.on_room_event 送达。
+
+        Returns:
+            服务器的欢迎信息
+
+        Raises:
+            JoinError: 服务器拒绝加入、等待应答超时或会话已结束
+        """
+        done = threading.Event()
+        result: List[Any] = []
+        self._room_joins[room_id] = (done, result)
+        self._outgoing.put(
+            _join_message(
+                self.user_name, room_id, replay_last, replay_since, self.accept_batches
+            )
+        )
+        if not done.wait(timeout):
+            self._room_joins.pop(room_id, None)
+            raise JoinTimeout("等待加入应答超时")
+        if not result:
+            raise JoinError("会话已结束")
+        if not result[0].success:
+            raise JoinError(result[0].message)
+        return result[0].message
+
+    def leave_room(self, room_id: str):
+        """离开一个房间；离开最后一个房间时服务器结束会话"""
+        self.sequences.pop(room_id, None)
+        self._outgoing.put(_leave_message(self.user_name, room_id))
+
+    def leave(self):
+        """离开所有房间，服务器处理完后结束会话（on_closed 回调）"""
+        for room_id in self.rooms[1:]:
+            self._outgoing.put(_leave_message(self.user_name, room_id))
+        self._outgoing.put(_leave_message(self.user_name, self.room_id))
+        self._outgoing.put(None)
+
+    def close(self):
+        """立即取消聊天流，不等待服务器确认"""
+        self._closing = True
+        self._outgoing.put(None)
+        self._stream.cancel()
+
+    def wait_closed(self, timeout: Optional[float] = None) -> bool:
+        """等待会话结束，返回是否已结束"""
+        return self._closed.wait(timeout)
+
+
+class RoomWatch:
+    """房间列表订阅，推送在后台线程中交给 on_update"""
+
+    def __init__(
+        self,
+        stub,
+        name_prefix: str,
+        on_update: Callable[[Any], None],
+        on_error: Optional[Callable[[grpc.RpcError], None]],
+    ):
+        self._stream = stub.WatchRooms(
+            chat_pb2.WatchRoomsRequest(name_prefix=name_prefix)
+        )
+        self._on_update = on_update
+        self._on_error = on_error
+        self._cancelled = False
+        threading.Thread(target=self._read, name="chat-room-watch", daemon=True).start()
+
+    def _read(self):
+        try:
+            for update in self._stream:
+                self._on_update(update)
+        except grpc.RpcError as e:
+            if not self._cancelled and self._on_error is not None:
+                self._on_error(e)
+
+    def cancel(self):
+        self._cancelled = True
+        self._stream.cancel()
+
+
+class ChatClient:
+    """同步客户端，持有一条长期使用的连接
+
+    Args:
+        target: 服务器地址，如 'localhost:50051'
+        options: 传给 grpc.insecure_channel 的通道参数，覆盖
+            DEFAULT_CHANNEL_OPTIONS 中的同名参数
+    """
+
+    def __init__(self, target: str, options: Optional[List[Any]] = None):
+        self.target = target
+        self.channel = grpc.insecure_channel(target, options=channel_options(options))
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+
+    def __enter__(self) -> "ChatClient":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.channel.close()
+
+    def wait_ready(self, timeout: Optional[float] = None):
+        """等待连接建立，超时抛出 grpc.FutureTimeoutError"""
+        grpc.channel_ready_future(self.channel).result(timeout=timeout)
+
+    def check_username(self, user_name: str, timeout: Optional[float] = None):
+        """校验并占用用户名，返回 CheckUsernameResponse"""
+        return self.stub.CheckUsername(
+            chat_pb2.CheckUsernameRequest(user_name=user_name), timeout=timeout
+        )
+
+    def list_rooms(
+        self,
+        name_prefix: str = "",
+        page_size: int = 0,
+        page_token: str = "",
+        sort_by_participants: bool = False,
+        timeout: Optional[float] = None,
+    ):
+        """获取一页房间，返回 ListRoomsResponse"""
+        request = _list_rooms_request(
+            name_prefix, page_size, page_token, sort_by_participants
+        )
+        return self.stub.ListRooms(request, timeout=timeout)
+
+    def create_room(
+        self, room_id: str, max_capacity: int = 0, timeout: Optional[float] = None
+    ):
+        """创建房间，返回 CreateRoomResponse"""
+        request = chat_pb2.CreateRoomRequest(room_id=room_id, max_capacity=max_capacity)
+        return self.stub.CreateRoom(request, timeout=timeout)
+
+    def delete_room(self, room_id: str, timeout: Optional[float] = None):
+        """删除没有成员的房间，返回 DeleteRoomResponse"""
+        request = chat_pb2.DeleteRoomRequest(room_id=room_id)
+        return self.stub.DeleteRoom(request, timeout=timeout)
+
+    def watch_rooms(
+        self,
+        on_update: Callable[[Any], None],
+        name_prefix: str = "",
+        on_error: Optional[Callable[[grpc.RpcError], None]] = None,
+    ) -> RoomWatch:
+        """订阅房间列表变化，on_update 收到 RoomsUpdate"""
+        return RoomWatch(self.stub, name_prefix, on_update, on_error)
+
+    def join(
+        self,
+        user_name: str,
+        room_id: str,
+        handlers: Optional[ChatHandlers] = None,
+        replay_last: int = 0,
+        replay_since: Optional[int] = None,
+        accept_batches: bool = True,
+        timeout: Optional[float] = None,
+        resume_token: str = "",
+        heartbeats: bool = True,
+        resumable: bool = False,
+    ) -> ChatSession:
+        """加入房间，阻塞到服务器应答为止
+
+        Args:
+            resume_token: 断开的会话的 resume_token，服务器仍保留该会话时
+                直接恢复，否则按新加入处理
+            heartbeats: 是否按服务器要求的间隔发送心跳；不发送心跳的会话
+                只依靠 HTTP/2 keepalive 发现断线
+            resumable: 是否请求服务器在意外断开后保留会话、下发 resume_token，
+                打算用 resume 或 reconnect 恢复的调用方才需要开启。开启后应以
+                leave 结束会话，close 会让服务器保留会话直到宽限期结束
+
+        Raises:
+            JoinError: 服务器拒绝加入或等待应答超时
+            grpc.RpcError: 连接失败
+        """
+        message = _join_message(
+            user_name,
+            room_id,
+            replay_last,
+            replay_since,
+            accept_batches,
+            resume_token,
+            heartbeats,
+            resumable,
+        )
+        session = ChatSession(self.stub, handlers or ChatHandlers(), message)
+        session._wait_joined(timeout)
+        return session
+
+    def resume(
+        self, session: ChatSession, timeout: Optional[float] = None
+    ) -> ChatSession:
+        """断线后恢复会话，只补发断开期间缺失的消息
+
+        服务器已不再保留该会话（超过宽限期、连到了其他进程）时按新加入处理，
+        并回放 last_sequence 之后的历史消息；新会话的 resumed 表示是哪种情况。
+        之后用 join_room 加入的房间总是重新加入，只回放缺失的消息；无法重新
+        加入的房间（已删除、已满）不会出现在新会话的 rooms 中。
+        """
+        resumed = self.join(
+            session.user_name,
+            session.room_id,
+            session.handlers,
+            replay_since=session.last_sequence,
+            accept_batches=session.accept_batches,
+            timeout=timeout,
+            resume_token=session.resume_token,
+            heartbeats=session.heartbeats,
+            resumable=session.resumable,
+        )
+        for room_id, sequence in list(session.sequences.items())[1:]:
+            try:
+                resumed.join_room(room_id, replay_since=sequence, timeout=timeout)
+            except JoinError:
+                pass
+        return resumed
+
+    def reconnect(
+        self,
+        session: ChatSession,
+        timeout: float = DEFAULT_RECONNECT_TIMEOUT,
+        join_timeout: Optional[float] = 10.0,
+    ) -> ChatSession:
+        """连接中断后反复尝试 resume，两次尝试之间按指数退避等待
+
+        在同一条连接上重试，gRPC 会在后台重新建立 TCP 和 HTTP/2 连接。
+        适合在 ChatHandlers.on_closed 收到 is_retryable 的错误后，在
+        后台线程中调用。服务器关闭前通过 ServerDraining 建议了重连时间时
+        先等待该时间；服务器繁忙拒绝时至少等待它建议的重试间隔。
+
+        Raises:
+            JoinError: 服务器拒绝加入（房间已删除等），不再重试
+            grpc.RpcError: timeout 秒内仍无法恢复，为最后一次的错误
+        """
+        deadline = time.monotonic() + timeout
+        backoff = RECONNECT_INITIAL_BACKOFF
+        time.sleep(min(session.reconnect_after, timeout))
+        while True:
+            try:
+                return self.resume(session, join_timeout)
+            except (grpc.RpcError, JoinTimeout) as e:
+                # 随机化等待时间，避免服务器重启后所有客户端同时重连
+                delay = max(backoff * random.uniform(0.5, 1.5), _retry_pushback(e))
+                if not is_retryable(e) or time.monotonic() + delay > deadline:
+                    raise
+            time.sleep(delay)
+            backoff = min(backoff * 2, RECONNECT_MAX_BACKOFF)
+
+
+class AsyncChatSession:
+    """异步聊天会话，以 `async for event in session` 接收事件
+
+    由 AsyncChatClient.join 创建。迭代在会话结束（离开、服务器关闭）时
+    停止；连接异常时抛出 grpc.aio.AioRpcError。加入了多个房间时用
+    room_events() 按 (房间ID, 事件) 接收。
+    """
+
+    def __init__(
+        self,
+        call,
+        user_name: str,
+        room_id: str,
+        accept_batches: bool,
+        join_response,
+        heartbeats: bool = True,
+        resumable: bool = False,
+    ):
+        self.user_name = user_name
+        self.room_id = room_id
+        self.accept_batches = accept_batches
+        self.heartbeats = heartbeats
+        self.resumable = resumable
+        # 加入成功后服务器的欢迎信息
+        self.welcome = join_response.message
+        # 断线后用 AsyncChatClient.resume 恢复会话所需的信息
+        self.resume_token = join_response.resume_token
+        # 已加入的房间 -> 收到的最大消息序号，第一个是 room_id
+        self.sequences: Dict[str, int] = {room_id: join_response.last_sequence}
+        # 是否恢复了之前断开的会话
+        self.resumed = join_response.resumed
+        self._call = call
+        # 等待应答的 join_room 请求
+        self._room_joins: Dict[str, "asyncio.Future[Any]"] = {}
+        # 心跳与 send 可能同时写入，流上同一时刻只能有一个写操作
+        self._write_lock = asyncio.Lock()
+        self._heartbeat_task: Optional["asyncio.Task[None]"] = None
+        interval = join_response.heartbeat_interval_ms / 1000
+        if heartbeats and interval > 0:
+            self._heartbeat_task = asyncio.ensure_future(
+                self._send_heartbeats(interval)
+            )
+
+    @property
+    def last_sequence(self) -> int:
+        """第一个房间中收到的最大消息序号"""
+        return self.sequences.get(self.room_id, 0)
+
+    @property
+    def rooms(self) -> List[str]:
+        """已加入的房间，按加入顺序"""
+        return list(self.sequences)
+
+    def __aiter__(self) -> AsyncIterator[ChatEvent]:
+        return self.events()
+
+    async def events(self) -> AsyncIterator[ChatEvent]:
+        async for _, event in self.room_events():
+            yield event
+
+    async def room_events(self) -> AsyncIterator[Tuple[str, ChatEvent]]:
+        """逐个返回 (房间ID, 事件)"""
+        call = self._call
+        try:
+            while True:
+                server_message = await call.read()
+                if server_message is grpc.aio.EOF:
+                    break
+                for room_id, event in iter_room_events(server_message, self.room_id):
+                    if isinstance(event, chat_pb2.JoinResponse):
+                        self._on_room_join_response(room_id, event)
+                        continue
+                    if isinstance(event, chat_pb2.BroadcastMessage):
+                        sequences = self.sequences
+                        if event.sequence > sequences.get(room_id, 0):
+                            sequences[room_id] = event.sequence
+                    yield room_id, event
+        except grpc.RpcError:
+            self._on_closed()
+            raise
+        self._on_closed()
+
+    def _on_closed(self):
+        """聊天流结束：停止心跳，等待中的 join_room 失败"""
+        self._stop_heartbeats()
+        for future in self._room_joins.values():
+            if not future.done():
+                future.set_exception(JoinError("会话已结束"))
+        self._room_joins.clear()
+
+    def _on_room_join_response(self, room_id: str, join_response):
+        if join_response.success:
+            self.sequences[room_id] = join_response.last_sequence
+        future = self._room_joins.pop(room_id, None)
+        if future is not None and not future.done():
+            future.set_result(join_response)
+
+    async def _write(self, message):
+        async with self._write_lock:
+            await self._call.write(message)
+
+    async def _send_heartbeats(self, interval: float):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self._write(_heartbeat_message())
+        except (grpc.RpcError, asyncio.InvalidStateError):
+            # 聊天流已经结束，由读取方报告原因
+            pass
+
+    def _stop_heartbeats(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    async def send(self, text: str, room_id: str = ""):
+        """发送一条聊天消息，room_id 为空时发往第一个房间"""
+        await self._write(_chat_message(text, room_id))
+
+    async def join_room(
+        self,
+        room_id: str,
+        replay_last: int = 0,
+        replay_since: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> str:
+        """在同一个聊天流上再加入一个房间，等待服务器应答
+
+        应答通过事件流到达，需要有任务在迭代 room_events()。
+
+        Returns:
+            服务器的欢迎信息
+
+        Raises:
+            JoinError: 服务器拒绝加入、等待应答超时或会话已结束
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._room_joins[room_id] = future
+        join = _join_message(
+            self.user_name, room_id, replay_last, replay_since, self.accept_batches
+        )
+        try:
+            await self._write(join)
+        except (grpc.RpcError, asyncio.InvalidStateError):
+            self._room_joins.pop(room_id, None)
+            raise JoinError("会话已结束")
+        try:
+            join_response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._room_joins.pop(room_id, None)
+            raise JoinTimeout("等待加入应答超时")
+        if not join_response.success:
+            raise JoinError(join_response.message)
+        return join_response.message
+
+    async def leave_room(self, room_id: str):
+        """离开一个房间；离开最后一个房间时服务器结束会话"""
+        self.sequences.pop(room_id, None)
+        await self._write(_leave_message(self.user_name, room_id))
+
+    async def leave(self):
+        """离开房间并等待服务器结束聊天流
+
+        需要有任务在迭代事件：服务器发来的剩余消息全部读出之前，聊天流的
+        状态不会到达，即使只剩一条也会一直等待。
+        """
+        self._stop_heartbeats()
+        for room_id in self.rooms[1:]:
+            await self._write(_leave_message(self.user_name, room_id))
+        await self._write(_leave_message(self.user_name, self.room_id))
+        await self._call.done_writing()
+        await self._call.code()
+
+    def cancel(self):
+        """立即取消聊天流"""
+        self._stop_heartbeats()
+        self._call.cancel()
+
+
+class AsyncChatClient:
+    """异步客户端，持有一条长期使用的 grpc.aio 连接
+
+    Args:
+        target: 服务器地址，如 'localhost:50051'
+        options: 传给 grpc.aio.insecure_channel 的通道参数，覆盖
+            DEFAULT_CHANNEL_OPTIONS 中的同名参数
+    """
+
+    def __init__(self, target: str, options: Optional[List[Any]] = None):
+        self.target = target
+        self.channel = grpc.aio.insecure_channel(
+            target, options=channel_options(options)
+        )
+        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+
+    async def __aenter__(self) -> "AsyncChatClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.channel.close()
+
+    async def wait_ready(self, timeout: Optional[float] = None):
+        """等待连接建立，超时抛出 asyncio.TimeoutError"""
+        await asyncio.wait_for(self.channel.channel_ready(), timeout)
+
+    async def check_username(self, user_name: str, timeout: Optional[float] = None):
+        """校验并占用用户名，返回 CheckUsernameResponse"""
+        return await self.stub.CheckUsername(
+            chat_pb2.CheckUsernameRequest(user_name=user_name), timeout=timeout
+        )
+
+    async def list_rooms(
+        self,
+        name_prefix: str = "",
+        page_size: int = 0,
+        page_token: str = "",
+        sort_by_participants: bool = False,
+        timeout: Optional[float] = None,
+    ):
+        """获取一页房间，返回 ListRoomsResponse"""
+        request = _list_rooms_request(
+            name_prefix, page_size, page_token, sort_by_participants
+        )
+        return await self.stub.ListRooms(request, timeout=timeout)
+
+    async def create_room(
+        self, room_id: str, max_capacity: int = 0, timeout: Optional[float] = None
+    ):
+        """创建房间，返回 CreateRoomResponse"""
+        request = chat_pb2.CreateRoomRequest(room_id=room_id, max_capacity=max_capacity)
+        return await self.stub.CreateRoom(request, timeout=timeout)
+
+    async def delete_room(self, room_id: str, timeout: Optional[float] = None):
+        """删除没有成员的房间，返回 DeleteRoomResponse"""
+        request = chat_pb2.DeleteRoomRequest(room_id=room_id)
+        return await self.stub.DeleteRoom(request, timeout=timeout)
+
+    async def watch_rooms(self, name_prefix: str = "") -> AsyncIterator[Any]:
+        """订阅房间列表变化，逐个返回 RoomsUpdate"""
+        call = self.stub.WatchRooms(chat_pb2.WatchRoomsRequest(name_prefix=name_prefix))
+        try:
+            async for update in call:
+                yield update
+        finally:
+            call.cancel()
+
+    async def join(
+        self,
+        user_name: str,
+        room_id: str,
+        replay_last: int = 0,
+        replay_since: Optional[int] = None,
+        accept_batches: bool = True,
+        timeout: Optional[float] = None,
+        resume_token: str = "",
+        heartbeats: bool = True,
+        resumable: bool = False,
+    ) -> AsyncChatSession:
+        """加入房间，等待服务器应答
+
+        Args:
+            resume_token: 断开的会话的 resume_token，服务器仍保留该会话时
+                直接恢复，否则按新加入处理
+            heartbeats: 是否按服务器要求的间隔发送心跳
+            resumable: 同 ChatClient.join，开启后应以 leave 结束会话
+
+        Raises:
+            JoinError: 服务器拒绝加入或等待应答超时
+            grpc.aio.AioRpcError: 连接失败
+        """
+        call = self.stub.Chat()
+        try:
+            await call.write(
+                _join_message(
+                    user_name,
+                    room_id,
+                    replay_last,
+                    replay_since,
+                    accept_batches,
+                    resume_token,
+                    heartbeats,
+                    resumable,
+                )
+            )
+            first = await asyncio.wait_for(call.read(), timeout)
+        except asyncio.TimeoutError:
+            call.cancel()
+            raise JoinTimeout("等待加入应答超时")
+        except BaseException:
+            call.cancel()
+            raise
+        if first is grpc.aio.EOF or not first.HasField("join_response"):
+            call.cancel()
+            raise JoinError("服务器未返回加入应答")
+        if not first.join_response.success:
+            call.cancel()
+            raise JoinError(first.join_response.message)
+        return AsyncChatSession(
+            call,
+            user_name,
+            room_id,
+            accept_batches,
+            first.join_response,
+            heartbeats,
+            resumable,
+        )
+
+    async def resume(
+        self, session: AsyncChatSession, timeout: Optional[float] = None
+    ) -> AsyncChatSession:
+        """断线后恢复会话，规则同 ChatClient.resume
+
+        之后加入的房间不会自动重新加入：join_room 需要有任务在迭代事件，
+        由调用方开始迭代后按 session.sequences 重新加入。
+        """
+        return await self.join(
+            session.user_name,
+            session.room_id,
+            replay_since=session.last_sequence,
+            accept_batches=session.accept_batches,
+            timeout=timeout,
+            resume_token=session.resume_token,
+            heartbeats=session.heartbeats,
+            resumable=session.resumable,
+        )
@@ -4,285 +4,1728 @@
 import grpc
 import threading
 import time
-import queue
 import argparse
+import base64
+import binascii
+import multiprocessing
+import os
+import random
+import re
+import secrets
+import shutil
+import signal
+import tempfile
+from collections import deque
 from concurrent import futures
-from typing import Dict, Set, Iterator, Any
+from functools import partial
+from typing import Dict, Any, Deque, List, Optional, Tuple
 # 这里IDE可能会因为对chat_pb2和chat_pb2_grpc的import报错，忽略即可
 import chat_pb2  # type: ignore
 import chat_pb2_grpc  # type: ignore
+from grpc_chat import log, metrics
+from grpc_chat.admission import (
+    DEFAULT_RETRY_AFTER,
+    REJECT_DRAINING,
+    REJECT_WATCHERS,
+    RETRY_PUSHBACK_KEY,
+    AdmissionControl,
+)
+from grpc_chat.bus import (
+    BUS_DELIVER,
+    BUS_ROOM_DELETED,
+    BUS_ROOM_STATE,
+    REASON_FULL,
+    REASON_MISSING,
+    BusClient,
+)
+from grpc_chat.leases import DEFAULT_LEASE_TTL, LeaseTable, TimerWheel
+from grpc_chat.ratelimit import (
+    MAX_RATE_LIMIT_DELAY,
+    RATE_LIMIT_DELAY,
+    RATE_LIMIT_DROP,
+    RATE_LIMIT_POLICIES,
+    RATE_LIMIT_REJECT,
+    RateLimiter,
+)
+from grpc_chat.rooms import (
+    DEFAULT_HISTORY_SIZE,
+    DEFAULT_ROOM_CAPACITY,
+    Memberships,
+    RoomRegistry,
+)
+from grpc_chat.scheduler import Scheduler
+from grpc_chat.storage import (
+    DEFAULT_FSYNC_INTERVAL,
+    FSYNC_INTERVAL,
+    FSYNC_POLICIES,
+    MessageLog,
+)
+from grpc_chat.watch import DEFAULT_WATCH_INTERVAL, RoomWatchHub, room_info
+from grpc_chat.wire import (
+    add_chat_service_to_server,
+    encode_batch,
+    encode_chat_message,
+    encode_server_message,
+    encode_user_joined,
+    encode_user_left,
+)
+
+# 预定义的聊天室
+DEFAULT_ROOMS = ("general", "tech", "gaming", "random")
+
+
+# 发送队列溢出策略
+OVERFLOW_DROP_OLDEST = "drop-oldest"  # 丢弃队列中最旧的消息
+OVERFLOW_DROP_NEWEST = "drop-newest"  # 丢弃新消息，并在恢复后插入空洞标记
+OVERFLOW_DISCONNECT = "disconnect"  # 断开接收过慢的连接
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT)
+
+# 每个连接的发送队列默认容量（条）
+DEFAULT_QUEUE_SIZE = 256
+
+# 批量发送的默认等待时间（秒）和每批字节上限
+DEFAULT_BATCH_DELAY = 0.005
+DEFAULT_BATCH_MAX_BYTES = 16 * 1024
+
+# 一次加入最多回放的历史消息条数（含从持久化日志读取的部分）
+MAX_REPLAY_MESSAGES = 1000
+
+# ListRooms 每页默认和最多返回的房间数
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# 运行时创建房间的限制
+MAX_ROOM_CAPACITY = 1000
+ROOM_ID_PATTERN = re.compile(r"^[\w-]{1,32}$")
+
+# 聊天流意外断开后保留会话等待重连的默认秒数
+DEFAULT_RESUME_GRACE = 30.0
+
+# 声明发送心跳的客户端的默认心跳间隔（秒）；连续 HEARTBEAT_MISSES 个间隔
+# 没有收到该客户端的任何消息时回收其聊天流，回收检查每 REAPER_TICK 秒一次
+DEFAULT_HEARTBEAT_INTERVAL = 10.0
+HEARTBEAT_MISSES = 3
+REAPER_TICK = 1.0
+
+# HTTP/2 keepalive：连接空闲多少秒后发送 ping，以及等待应答的秒数
+DEFAULT_KEEPALIVE_TIME = 30.0
+DEFAULT_KEEPALIVE_TIMEOUT = 10.0
+# 允许客户端发送 keepalive ping 的最短间隔（毫秒）
+MIN_CLIENT_PING_INTERVAL_MS = 10000
+
+# 线程模式下未指定 max_streams 时的聊天流上限：每个聊天流占用一个 gRPC
+# 工作线程负责发送，以及读取线程池中的一个线程
+MAX_WORKERS = 10
+# 线程模式下在聊天流和房间列表订阅之外为一元 RPC 保留的工作线程数；
+# 工作线程都被占用时新的 RPC 立即以 RESOURCE_EXHAUSTED 失败，而不是排队
+UNARY_WORKERS = 4
+
+# 客户端发来的单条消息的字节上限
+MAX_RECEIVE_MESSAGE_BYTES = 64 * 1024
+
+# 优雅关闭：等待各聊天流发送完队列中消息的秒数，之后强制结束；
+# 建议客户端重连的时间在 0 到 DEFAULT_DRAIN_RECONNECT_SPREAD 秒之间随机分散
+DEFAULT_DRAIN_TIMEOUT = 10.0
+DEFAULT_DRAIN_RECONNECT_SPREAD = 5.0
+DRAIN_REASON = "服务器正在重启"
 
 
 class StreamHandler:
-    """处理单个用户的流连接"""
+    """处理单个用户的流连接
+
+    发送队列有固定容量，队列满时按 overflow_policy 处理，
+    因此单个连接占用的内存有确定的上限。一个连接可以加入多个房间，
+    所有房间的消息共用这一个队列；room_id 是第一次加入的房间。
+    """
 
-    def __init__(self, user_name: str, room_id: str):
+    def __init__(
+        self,
+        user_name: str,
+        room_id: str,
+        max_queue_size: int = DEFAULT_QUEUE_SIZE,
+        overflow_policy: str = OVERFLOW_DROP_OLDEST,
+    ):
         self.user_name = user_name
         self.room_id = room_id
-        self.message_queue = queue.Queue()
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.message_queue: Deque[Any] = deque()
+        # 与 message_queue 一一对应的 (开始广播时间, 房间ID, 序号)，用于统计
+        # 扇出延迟和断线恢复；不是聊天消息的条目为 None
+        self.message_meta: Deque[Optional[Tuple[float, str, int]]] = deque()
         self.active = True
+        # 是否已加入房间，即该聊天流持有用户名租约
+        self.joined = False
+        # 客户端能否处理批量消息，以第一次加入时为准
+        self.accept_batches = False
+        # {房间ID: 序号}，序号不大于它的聊天消息已回放或已取出发送，
+        # 由房间在加入和恢复时设置
+        self.sequences: Dict[str, int] = {}
+        # 断线重连时用于恢复本会话，加入成功后生成
+        self.resume_token = ""
+        # 每次恢复会话加 1，旧连接的结束回调据此不影响新连接
+        self.generation = 0
+        # 客户端是否承诺发送心跳，只有这样的聊天流才会因静默被回收
+        self.heartbeats = False
+        # 是否因长时间没有心跳而被回收
+        self.evicted = False
+        # 是否因接收过慢而被断开
+        self.overflowed = False
+        # 统计计数
+        self.queued_count = 0
+        self.dropped_count = 0
+        # 队列中等待发送的字节数，用于准入控制
+        self.queued_bytes = 0
+        # 尚未通知客户端的丢弃消息数（drop-newest 策略）
+        self._gap = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        # 正在 _ready 上等待的发送方数；发送方忙于发送时入队不必 notify，
+        # 大房间扇出时省去每个连接一次 Condition.notify 的开销
+        self._waiting = 0
 
-    def send_message(self, message):
-        """向用户发送消息"""
-        if self.active:
-            try:
-                self.message_queue.put(message, block=False)
-            except queue.Full:
-                print(f"[WARNING] 用户 {self.user_name} 的消息队列已满")
+    @property
+    def queue_depth(self) -> int:
+        """当前排队的消息数"""
+        return len(self.message_queue)
+
+    @property
+    def last_sequence(self) -> int:
+        """第一次加入的房间中已回放或已取出发送的最大序号"""
+        return self.sequences.get(self.room_id, 0)
+
+    def send_message(
+        self,
+        message,
+        sent_at: Optional[float] = None,
+        sequence: int = 0,
+        room_id: str = "",
+    ):
+        """向用户发送消息
+
+        Args:
+            message: 预编码的消息
+            sent_at: 开始广播的时间（time.perf_counter），只有聊天消息带有
+            sequence: 聊天消息的序号
+            room_id: 聊天消息所属的房间
+        """
+        meta = None if sent_at is None else (sent_at, room_id, sequence)
+        with self._lock:
+            if self.active and self._enqueue(message, meta):
+                self._notify()
+
+    def _enqueue(
+        self, message, meta: Optional[Tuple[float, str, int]] = None
+    ) -> bool:
+        """在锁内按溢出策略入队
+
+        Returns:
+            是否需要唤醒发送方
+        """
+        message_queue = self.message_queue
+        if self.overflow_policy == OVERFLOW_DROP_NEWEST:
+            # 有未通知的丢弃时，需要同时为空洞标记留出位置
+            needed = 2 if self._gap else 1
+            if len(message_queue) + needed > self.max_queue_size:
+                self._record_drop()
+                self._gap += 1
+                return False
+            if self._gap:
+                gap = chat_pb2.MessagesDropped(count=self._gap)
+                marker = encode_server_message(
+                    chat_pb2.ServerMessage(messages_dropped=gap)
+                )
+                message_queue.append(marker)
+                self.message_meta.append(None)
+                self.queued_bytes += len(marker)
+                self._gap = 0
+        elif len(message_queue) >= self.max_queue_size:
+            self._record_drop()
+            if self.overflow_policy == OVERFLOW_DISCONNECT:
+                self.overflowed = True
+                self.active = False
+                return True
+            self.queued_bytes -= len(message_queue.popleft())
+            self.message_meta.popleft()
+        message_queue.append(message)
+        self.message_meta.append(meta)
+        self.queued_bytes += len(message)
+        self.queued_count += 1
+        return True
+
+    def _pop(self):
+        """取出队首的消息，并记录聊天消息的扇出延迟（调用时已持有锁）"""
+        meta = self.message_meta.popleft()
+        if meta is not None:
+            sent_at, room_id, self.sequences[room_id] = meta
+            metrics.FANOUT_LATENCY.observe(time.perf_counter() - sent_at)
+        message = self.message_queue.popleft()
+        self.queued_bytes -= len(message)
+        return message
+
+    def _record_drop(self):
+        self.dropped_count += 1
+        metrics.MESSAGES_DROPPED.inc((self.room_id,))
+        if self.dropped_count == 1:
+            log.warning(
+                "stream.queue_full",
+                "用户 {user} 的消息队列已满，按 {policy} 策略处理",
+                user=self.user_name,
+                policy=self.overflow_policy,
+            )
+
+    def _notify(self):
+        """唤醒发送方（调用时已持有锁）"""
+        if self._waiting:
+            self._ready.notify()
+
+    def _wait(self, timeout: Optional[float] = None):
+        """等待新消息或停止（调用时已持有锁）"""
+        self._waiting += 1
+        try:
+            self._ready.wait(timeout)
+        finally:
+            self._waiting -= 1
 
     def get_messages(self):
-        """获取待发送的消息生成器"""
-        while self.active:
-            try:
-                message = self.message_queue.get(timeout=0.5)
-                if message is None:  # 停止信号
+        """获取待发送的消息生成器，只在有新消息或停止时被唤醒
+
+        正常停止时会先发送完队列中剩余的消息；因接收过慢被断开时立即结束。
+        """
+        while True:
+            with self._ready:
+                while self.active and not self.message_queue:
+                    self._wait()
+                if self.overflowed or not self.message_queue:
+                    break
+                message = self._pop()
+            yield message
+
+    def get_batches(self, max_delay: float, max_bytes: int):
+        """获取待发送消息的批次生成器
+
+        取到第一条消息后，继续收集后续消息，直到等待超过 max_delay 秒
+        或累计字节数达到 max_bytes 为止。
+        """
+        while True:
+            with self._ready:
+                while self.active and not self.message_queue:
+                    self._wait()
+                if self.overflowed or not self.message_queue:
                     break
-                yield message
-            except queue.Empty:
-                continue
-            except Exception as e:
-                print(f"[ERROR] 处理用户 {self.user_name} 消息时出错: {e}")
-                break
+                batch = [self._pop()]
+                size = len(batch[0])
+                deadline = time.monotonic() + max_delay
+                while size < max_bytes and not self.overflowed:
+                    if self.message_queue:
+                        message = self._pop()
+                        batch.append(message)
+                        size += len(message)
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if not self.active or remaining <= 0:
+                        break
+                    self._wait(remaining)
+            yield batch
+
+    def stop(self, generation: Optional[int] = None):
+        """停止处理消息
+
+        Args:
+            generation: 不为 None 时只在会话未被恢复过（仍是该代）时停止
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.active = False
+            self._notify()
 
-    def stop(self):
-        """停止处理消息"""
-        self.active = False
-        self.message_queue.put(None)
+    def evict(self):
+        """回收失联的聊天流：立即丢弃排队的消息并结束发送"""
+        with self._lock:
+            self.message_queue.clear()
+            self.message_meta.clear()
+            self.queued_bytes = 0
+            self.evicted = True
+            self.active = False
+            self._notify()
+
+    def reopen(self, last_sequence: int):
+        """恢复暂时断开的会话：清空断开前剩余的消息，重新开始接收
+
+        缺失的聊天消息由调用方从房间历史中回放，之后的消息从 last_sequence
+        之后开始实时接收。调用时已持有房间的广播锁。
+        """
+        with self._lock:
+            self.message_queue.clear()
+            self.message_meta.clear()
+            self.queued_bytes = 0
+            self._gap = 0
+            self.overflowed = False
+            self.active = True
+            self.sequences = {self.room_id: last_sequence}
+            self.generation += 1
 
 
 class ChatServer(chat_pb2_grpc.ChatServiceServicer):
-    def __init__(self):
-        # 预定义的聊天室
-        self.rooms = {
-            "general": {"handlers": {}, "max_capacity": 20},
-            "tech": {"handlers": {}, "max_capacity": 20},
-            "gaming": {"handlers": {}, "max_capacity": 20},
-            "random": {"handlers": {}, "max_capacity": 20},
-        }
-        # 全局用户名集合，确保唯一性
-        self.global_users: Set[str] = set()
-        # 线程锁
-        self.lock = threading.Lock()
+    handler_class = StreamHandler
+
+    def __init__(
+        self,
+        max_queue_size: int = DEFAULT_QUEUE_SIZE,
+        overflow_policy: str = OVERFLOW_DROP_OLDEST,
+        batch_delay: float = DEFAULT_BATCH_DELAY,
+        batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES,
+        history_size: int = DEFAULT_HISTORY_SIZE,
+        data_dir: Optional[str] = None,
+        fsync_policy: str = FSYNC_INTERVAL,
+        fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+        watch_interval: float = DEFAULT_WATCH_INTERVAL,
+        bus_path: Optional[str] = None,
+        cluster_node: Optional[str] = None,
+        cluster_nodes: Optional[Dict[str, str]] = None,
+        username_ttl: float = DEFAULT_LEASE_TTL,
+        resume_grace: float = DEFAULT_RESUME_GRACE,
+        heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+        user_rate: float = 0.0,
+        user_burst: float = 0.0,
+        room_rate: float = 0.0,
+        room_burst: float = 0.0,
+        server_rate: float = 0.0,
+        server_burst: float = 0.0,
+        rate_limit_policy: str = RATE_LIMIT_DROP,
+        max_streams: int = 0,
+        join_rate: float = 0.0,
+        join_burst: float = 0.0,
+        max_queue_bytes: int = 0,
+        max_watchers: int = 0,
+        drain_timeout: float = DEFAULT_DRAIN_TIMEOUT,
+        drain_reconnect_spread: float = DEFAULT_DRAIN_RECONNECT_SPREAD,
+    ):
+        if max_queue_size < 2:
+            raise ValueError("发送队列容量至少为 2")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"未知的溢出策略: {overflow_policy}，可选: {', '.join(OVERFLOW_POLICIES)}"
+            )
+        if rate_limit_policy not in RATE_LIMIT_POLICIES:
+            raise ValueError(
+                f"未知的限速策略: {rate_limit_policy}，"
+                f"可选: {', '.join(RATE_LIMIT_POLICIES)}"
+            )
+        # 每个连接的发送队列容量和溢出策略
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        # 批量发送：最多等待的秒数（0 表示关闭）和每批的字节上限
+        self.batch_delay = batch_delay
+        self.batch_max_bytes = batch_max_bytes
+        # 线程模式下所有延迟回调共用一个常驻的定时线程
+        self._scheduler = Scheduler()
+        # 预定义的聊天室，每个房间拥有独立的锁；运行时可通过 CreateRoom 增加
+        self.history_size = history_size
+        self.rooms = RoomRegistry()
+        for room_id in DEFAULT_ROOMS:
+            self.rooms.create(room_id, DEFAULT_ROOM_CAPACITY, history_size)
+        # 可选的持久化消息日志
+        self.message_log: Optional[MessageLog] = None
+        if data_dir:
+            self.message_log = MessageLog(data_dir, fsync_policy, fsync_interval)
+            for room in self.rooms:
+                self._attach_log(room)
+        # 用户 -> 所在房间，一个聊天流可以加入多个房间
+        self.memberships = Memberships()
+        # 大厅订阅者，房间变化在 watch_interval 秒内合并后推送
+        self.room_watch = RoomWatchHub(self.rooms, self._call_later, watch_interval)
+        # 全局用户名租约，确保唯一性；校验后未加入房间的预留在 username_ttl 秒后过期
+        self.user_leases = LeaseTable(username_ttl)
+        # 只保护全局用户名租约，与房间锁相互独立
+        self.users_lock = threading.Lock()
+        # 意外断开、等待重连的会话 {resume_token: 处理器}，宽限期内处理器仍在
+        # 房间中，用户名租约也不释放；resume_grace 为 0 时不保留
+        self.resume_grace = resume_grace
+        self._parked: Dict[str, Any] = {}
+        self._parked_lock = threading.Lock()
+        # 发送心跳的聊天流按静默期限放入时间轮，收到客户端消息时重新计时，
+        # 定期推进时间轮回收到期的聊天流；heartbeat_interval 为 0 时不检查
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = heartbeat_interval * HEARTBEAT_MISSES
+        self._idle_wheel = TimerWheel(
+            REAPER_TICK, int(self.idle_timeout / REAPER_TICK) + 2, time.monotonic()
+        )
+        self._idle_lock = threading.Lock()
+        self._closing = False
+        if heartbeat_interval > 0:
+            self._call_later(REAPER_TICK, self._reap_idle_streams)
+        # 聊天消息在广播之前按用户、房间和全服务器限速，都为 0 时不限速
+        self.rate_limiter: Optional[RateLimiter] = RateLimiter(
+            user_rate, user_burst, room_rate, room_burst, server_rate, server_burst
+        )
+        if not self.rate_limiter.enabled:
+            self.rate_limiter = None
+        self.rate_limit_policy = rate_limit_policy
+        # 新的聊天流超出聊天流数、加入速率或发送队列字节数上限时立即被拒绝，
+        # 房间列表订阅超出订阅数上限时同样被拒绝
+        self.admission = AdmissionControl(
+            max_streams, join_rate, join_burst, max_queue_bytes, max_watchers
+        )
+        # 优雅关闭：drain 之后不再接纳新的聊天流，已有的聊天流发送完队列中的
+        # 消息后结束；由调用方在 drain_timeout 秒后强制停止 gRPC 服务器
+        self.draining = False
+        self.drain_timeout = drain_timeout
+        self.drain_reconnect_spread = drain_reconnect_spread
+        # 线程模式下读取客户端消息的线程池，每个聊天流占用一个线程；线程在
+        # 首次使用时才创建，因此 asyncio 模式下不会产生任何读取线程
+        self._reader_pool = futures.ThreadPoolExecutor(
+            max_workers=max_streams or MAX_WORKERS, thread_name_prefix="chat-reader"
+        )
+        # 多进程模式下连接主进程中的房间总线（BusClient），集群模式下按房间ID
+        # 路由到拥有该房间的节点（ClusterBus）；用户名、人数和消息序号以总线为准
+        self.bus: Any = None
+        if bus_path and cluster_nodes:
+            raise ValueError("多进程模式与集群模式不能同时使用")
+        if (bus_path or cluster_nodes) and self.message_log is not None:
+            raise ValueError("多进程模式和集群模式暂不支持持久化消息日志")
+        if bus_path:
+            self.bus = BusClient(bus_path, self._call_soon, self._apply_bus_event)
+        elif cluster_nodes:
+            from grpc_chat.cluster import ClusterBus
+
+            if cluster_node not in cluster_nodes:
+                raise ValueError(f"节点 '{cluster_node}' 不在集群节点列表中")
+            self.bus = ClusterBus(
+                cluster_node,
+                cluster_nodes,
+                self.rooms,
+                history_size,
+                self._call_soon,
+                self._apply_bus_event,
+                username_ttl=username_ttl,
+            )
+        # 只能在采集时计算的指标
+        metrics.ACTIVE_STREAMS.set_function(lambda: {(): len(self.memberships)})
+        metrics.ROOM_SUBSCRIPTIONS.set_function(
+            lambda: {(): self.memberships.subscription_count()}
+        )
+        metrics.ROOM_WATCHERS.set_function(
+            lambda: {(): self.room_watch.watcher_count}
+        )
+        metrics.USERNAME_LEASES.set_function(
+            lambda: {
+                ("reserved",): self.user_leases.reserved_count,
+                ("held",): self.user_leases.held_count,
+            }
+        )
+        metrics.PARKED_SESSIONS.set_function(lambda: {(): len(self._parked)})
+        metrics.QUEUED_BYTES.set_function(lambda: {(): self._queued_bytes()})
+        metrics.QUEUE_DEPTH.set_function(
+            lambda: [handler.queue_depth for handler in self._stream_handlers()]
+        )
+
+    def _stream_handlers(self) -> set:
+        """各房间中的聊天流，加入多个房间的只出现一次"""
+        return {handler for room in self.rooms for handler in room.subscribers}
+
+    def _queued_bytes(self) -> int:
+        """所有聊天流发送队列中等待发送的字节数"""
+        return sum(handler.queued_bytes for handler in self._stream_handlers())
+
+    def _attach_log(self, room):
+        """为房间接上持久化日志，并从日志恢复序号和最近的历史"""
+        room.log = self.message_log
+        last_sequence = self.message_log.last_sequence(room.room_id)
+        if last_sequence:
+            recent = self.message_log.read_last(room.room_id, room.history.maxlen)
+            room.restore(last_sequence, recent)
+            log.info(
+                "room.restore",
+                "房间 {room} 从日志恢复，最后序号 {sequence}",
+                room=room.room_id,
+                sequence=last_sequence,
+            )
+
+    def _call_later(self, delay: float, callback):
+        """在 delay 秒后于定时线程中调用 callback"""
+        self._scheduler.call_later(delay, callback)
+
+    def _call_soon(self, callback, *args):
+        """在适合操作房间和连接的线程中调用 callback（线程模式下直接调用）"""
+        callback(*args)
+
+    def close(self):
+        """关闭服务，写完并落盘持久化日志中剩余的消息"""
+        self._closing = True
+        self._scheduler.stop()
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.bus is not None:
+            self.bus.close()
+
+    def _apply_bus_event(self, kind: int, fields: List[bytes]):
+        """把总线事件应用到本进程的房间"""
+        room_id = fields[0].decode("utf-8")
+        if kind == BUS_DELIVER:
+            room = self.rooms.get(room_id)
+            if room is None:
+                return
+            _, sequence, payload, exclude = fields
+            if int(sequence):
+                room.deliver(int(sequence), payload, time.perf_counter())
+            else:
+                # 加入、离开通知不计入历史
+                excluded = room.handlers.get(exclude.decode("utf-8"))
+                room.broadcast(payload, exclude=excluded)
+        elif kind == BUS_ROOM_STATE:
+            max_capacity, count, last_sequence = (int(field) for field in fields[1:])
+            room, _ = self.rooms.create(room_id, max_capacity, self.history_size)
+            room.max_capacity = max_capacity
+            room.global_count = count
+            if last_sequence > room.last_sequence:
+                # 晚于其他工作进程启动时，从总线的序号继续
+                room.restore(last_sequence, [])
+            self.room_watch.mark(room_id)
+        elif kind == BUS_ROOM_DELETED:
+            self.rooms.delete(room_id)
+            self.room_watch.mark(room_id)
+            if self.rate_limiter is not None:
+                self.rate_limiter.forget_room(room_id)
 
     def ListRooms(self, request, context):
-        """获取房间列表 (一元RPC)"""
-        with self.lock:
-            rooms_info = []
-            for room_id, room_data in self.rooms.items():
-                room_info = chat_pb2.RoomInfo(
-                    room_id=room_id, participant_count=len(room_data["handlers"])
+        """获取房间列表 (一元RPC)，分页返回，无锁读取各房间人数
+
+        按名称排序时，页码标记记录上一页最后一个房间ID，在有序索引上二分
+        定位；按人数排序时记录偏移量，人数随时变化，翻页结果只是近似的。
+        """
+        page_size = request.page_size or DEFAULT_PAGE_SIZE
+        if page_size < 0:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("page_size 不能为负数")
+            return chat_pb2.ListRoomsResponse()
+        page_size = min(page_size, MAX_PAGE_SIZE)
+        by_participants = request.sort_by == chat_pb2.ROOM_SORT_BY_PARTICIPANTS
+        try:
+            cursor = _decode_page_token(request.page_token, by_participants)
+        except ValueError:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("无效的 page_token")
+            return chat_pb2.ListRoomsResponse()
+
+        prefix = request.name_prefix
+        if by_participants:
+            offset = int(cursor or 0)
+            rooms, has_more = self.rooms.page_by_participants(
+                prefix, offset, page_size
+            )
+            next_cursor = str(offset + len(rooms))
+        else:
+            rooms, has_more = self.rooms.page_by_name(prefix, cursor, page_size)
+            next_cursor = rooms[-1].room_id if rooms else ""
+
+        response = chat_pb2.ListRoomsResponse(
+            rooms=[room_info(room) for room in rooms],
+            total_count=self.rooms.count(prefix),
+        )
+        if has_more:
+            response.next_page_token = _encode_page_token(next_cursor, by_participants)
+        log.info(
+            "rooms.list",
+            "房间列表请求：返回 {returned}/{total} 个房间",
+            returned=len(rooms),
+            total=response.total_count,
+        )
+        return response
+
+    def CreateRoom(self, request, context):
+        """运行时创建房间"""
+        room_id = request.room_id
+        if not ROOM_ID_PATTERN.match(room_id):
+            return chat_pb2.CreateRoomResponse(
+                success=False,
+                message="房间ID只能包含字母、数字、下划线和连字符，长度 1-32",
+            )
+        max_capacity = request.max_capacity or DEFAULT_ROOM_CAPACITY
+        if not 1 <= max_capacity <= MAX_ROOM_CAPACITY:
+            return chat_pb2.CreateRoomResponse(
+                success=False, message=f"房间容量须在 1-{MAX_ROOM_CAPACITY} 之间"
+            )
+        if self.bus is not None:
+            # 房间由总线创建后同步到所有工作进程
+            try:
+                created, _ = self.bus.create_room(room_id, max_capacity)
+            except ConnectionError as e:
+                return chat_pb2.CreateRoomResponse(success=False, message=str(e))
+            if not created:
+                return chat_pb2.CreateRoomResponse(
+                    success=False, message=f"房间 '{room_id}' 已存在"
                 )
-                rooms_info.append(room_info)
+            log.info(
+                "room.create",
+                "创建房间 {room}，容量 {capacity}",
+                room=room_id,
+                capacity=max_capacity,
+            )
+            return chat_pb2.CreateRoomResponse(
+                success=True,
+                message=f"房间 '{room_id}' 已创建",
+                room=chat_pb2.RoomInfo(room_id=room_id, max_capacity=max_capacity),
+            )
+        room, created = self.rooms.create(room_id, max_capacity, self.history_size)
+        if not created:
+            return chat_pb2.CreateRoomResponse(
+                success=False,
+                message=f"房间 '{room_id}' 已存在",
+                room=room_info(room),
+            )
+        if self.message_log is not None:
+            self._attach_log(room)
+        self.room_watch.mark(room_id)
+        log.info(
+            "room.create",
+            "创建房间 {room}，容量 {capacity}",
+            room=room_id,
+            capacity=max_capacity,
+        )
+        return chat_pb2.CreateRoomResponse(
+            success=True, message=f"房间 '{room_id}' 已创建", room=room_info(room)
+        )
+
+    def DeleteRoom(self, request, context):
+        """删除没有成员的房间"""
+        if self.bus is not None:
+            return self._delete_room_via_bus(request.room_id)
+        success, message = self.rooms.delete(request.room_id)
+        if success:
+            if self.message_log is not None:
+                # 否则同名的新房间会从日志恢复旧房间的历史
+                self.message_log.delete_room(request.room_id)
+            self.room_watch.mark(request.room_id)
+            if self.rate_limiter is not None:
+                self.rate_limiter.forget_room(request.room_id)
+            log.info("room.delete", "删除房间 {room}", room=request.room_id)
+        return chat_pb2.DeleteRoomResponse(success=success, message=message)
+
+    def _delete_room_via_bus(self, room_id: str):
+        """多进程模式下删除房间，成功后由总线通知所有工作进程"""
+        try:
+            deleted, value = self.bus.delete_room(room_id)
+        except ConnectionError as e:
+            return chat_pb2.DeleteRoomResponse(success=False, message=str(e))
+        if deleted:
+            log.info("room.delete", "删除房间 {room}", room=room_id)
+            message = f"房间 '{room_id}' 已删除"
+        elif value == REASON_MISSING:
+            message = f"房间 '{room_id}' 不存在"
+        else:
+            message = f"房间 '{room_id}' 中还有 {value} 人"
+        return chat_pb2.DeleteRoomResponse(success=deleted, message=message)
+
+    def WatchRooms(self, request, context):
+        """订阅房间列表变化 (服务端流RPC)
+
+        先发送一次完整快照，之后只发送合并后的变化。订阅者接收过慢时直接
+        断开，由客户端重新订阅获取新的快照，而不是丢弃部分变化。
+        """
+        if not self._admit_watcher(context):
+            return
+        watcher = self._create_watcher(context)
+        try:
+            if not context.add_callback(watcher.stop):
+                return
+            count = self.room_watch.subscribe(watcher, request.name_prefix)
+            log.info(
+                "rooms.watch",
+                "{peer} 订阅房间列表，快照 {rooms} 个房间，当前订阅者 {watchers}",
+                peer=watcher.user_name,
+                rooms=count,
+                watchers=self.room_watch.watcher_count,
+            )
+            for frame in watcher.get_messages():
+                yield frame
+            if watcher.overflowed:
+                self._abort_slow_consumer(watcher, context)
+        finally:
+            self.room_watch.unsubscribe(watcher)
+            self.admission.release_watcher()
+
+    def _admit_watcher(self, context) -> bool:
+        """房间列表订阅的准入检查，通过的订阅结束时须调用 release_watcher"""
+        if self.admission.admit_watcher():
+            return True
+        self._reject(context, REJECT_WATCHERS, DEFAULT_RETRY_AFTER)
+        return False
 
-            response = chat_pb2.ListRoomsResponse(rooms=rooms_info)
-            print(f"[INFO] 房间列表请求：返回 {len(rooms_info)} 个房间")
-            return response
+    def _create_watcher(self, context):
+        """创建房间列表订阅者，以对端地址代替用户名"""
+        return self.handler_class(
+            context.peer(), "", self.max_queue_size, OVERFLOW_DISCONNECT
+        )
 
     def Chat(self, request_iterator, context):
         """聊天双向流RPC"""
         handler = None
-        user_left = False
         user_name = None
-        room_id = None
+        admitted = False
         try:
             # 必须第一个消息是 join_request
             first_message = next(request_iterator)
             if not first_message.HasField("join_request"):
                 # 非法连接，直接关闭
                 return
+            admitted = self._admit(context)
+            if not admitted:
+                return
             join_req = first_message.join_request
             user_name = join_req.user_name
             room_id = join_req.room_id
 
-            # 校验房间和容量
-            success, message = self._handle_join_request(user_name, room_id)
-            if success:
-                handler = StreamHandler(user_name, room_id)
-                with self.lock:
-                    self.rooms[room_id]["handlers"][user_name] = handler
-                join_response = chat_pb2.JoinResponse(success=True, message=message)
-                join_msg = chat_pb2.ServerMessage(join_response=join_response)
-                handler.send_message(join_msg)
-                self._broadcast_user_joined(user_name, room_id)
-                print(f"[INFO] 用户 {user_name} 成功加入房间 {room_id}")
-            else:
-                handler = StreamHandler(user_name, "")
-                join_response = chat_pb2.JoinResponse(success=False, message=message)
-                join_msg = chat_pb2.ServerMessage(join_response=join_response)
-                handler.send_message(join_msg)
-                handler.stop()
-                print(f"[WARNING] 用户 {user_name} 加入房间 {room_id} 失败: {message}")
+            # 恢复断开前的会话，或校验房间和容量后原子地加入房间
+            handler, success, message, replay, resumed = self._open_session(join_req)
+            # 加入响应先于队列中的任何广播发送
+            yield self._join_response(handler, success, message, resumed)
+            if not success:
+                log.warning(
+                    "user.join_failed",
+                    "用户 {user} 加入房间 {room} 失败: {reason}",
+                    user=user_name,
+                    room=room_id,
+                    reason=message,
+                )
                 return
+            # 历史消息紧跟在加入响应之后、实时消息之前发送
+            for frame in self._replay_frames(replay, join_req.accept_batches):
+                yield frame
+            self._announce_join(handler, len(replay), resumed)
+
+            # RPC 结束（客户端断开、服务器关闭）时立即唤醒发送方；
+            # 会话之后被新连接恢复时不受影响
+            context.add_callback(partial(handler.stop, handler.generation))
+
+            # 后续消息由固定大小的读取线程池处理
+            self._reader_pool.submit(
+                self._read_client_messages, request_iterator, handler
+            )
+            if join_req.accept_batches and self.batch_delay > 0:
+                for batch in handler.get_batches(
+                    self.batch_delay, self.batch_max_bytes
+                ):
+                    yield encode_batch(batch)
+            else:
+                for message in handler.get_messages():
+                    yield message
+            self._finish_stream(handler, context)
+        except Exception as e:
+            log.error("chat.error", "聊天流异常: {error}", error=e)
+        finally:
+            if admitted:
+                self.admission.release()
+            self._handle_stream_closed(handler, user_name)
+
+    def _read_client_messages(self, request_iterator, handler):
+        """读取并处理一个聊天流的后续客户端消息"""
+        try:
+            for client_message in request_iterator:
+                delay = self._throttle(handler, client_message)
+                if delay is None:
+                    continue
+                if delay > 0:
+                    # 暂停读取，HTTP/2 流控会让发送过快的客户端等待
+                    time.sleep(delay)
+                if not self._handle_client_message(handler, client_message):
+                    return
+        except Exception as e:
+            log.error("chat.read_error", "处理客户端消息时出错: {error}", error=e)
+
+    def _create_handler(self, user_name: str, room_id: str):
+        """创建连接处理器"""
+        return self.handler_class(
+            user_name, room_id, self.max_queue_size, self.overflow_policy
+        )
+
+    def _finish_stream(self, handler, context):
+        """发送结束后，为被服务器断开的聊天流设置状态码"""
+        if handler.overflowed:
+            self._abort_slow_consumer(handler, context)
+        elif handler.evicted:
+            context.set_code(grpc.StatusCode.UNAVAILABLE)
+            context.set_details("长时间没有收到心跳，连接已被服务器回收")
+        elif self.draining:
+            context.set_code(grpc.StatusCode.UNAVAILABLE)
+            context.set_details(DRAIN_REASON)
+
+    def _admit(self, context) -> bool:
+        """准入检查，拒绝时为聊天流设置状态码和建议的重试间隔
+
+        通过检查的聊天流结束时须调用 self.admission.release()。
+        """
+        if self.draining:
+            reason = REJECT_DRAINING
+            retry_after = random.uniform(0, self.drain_reconnect_spread)
+        else:
+            reason, retry_after = self.admission.admit(self._queued_bytes)
+            if not reason:
+                return True
+        self._reject(context, reason, retry_after)
+        return False
+
+    def _reject(self, context, reason: str, retry_after: float):
+        """以 RESOURCE_EXHAUSTED（关闭中为 UNAVAILABLE）拒绝一个流"""
+        metrics.STREAMS_REJECTED.inc((reason,))
+        log.warning(
+            "stream.rejected",
+            "拒绝来自 {peer} 的流: {reason}",
+            peer=context.peer(),
+            reason=reason,
+        )
+        retry_after_ms = max(1, int(retry_after * 1000))
+        context.set_trailing_metadata(((RETRY_PUSHBACK_KEY, str(retry_after_ms)),))
+        if reason == REJECT_DRAINING:
+            # 让客户端换到其他节点或等待重启完成
+            context.set_code(grpc.StatusCode.UNAVAILABLE)
+            context.set_details(DRAIN_REASON)
+        else:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details(f"服务器繁忙（{reason}），请 {retry_after_ms} 毫秒后重试")
+
+    def drain(self):
+        """开始优雅关闭
+
+        不再接纳新的聊天流；等待重连的会话立即按离开处理；已有的聊天流收到
+        ServerDraining 后停止接收新消息，发送完队列中的消息即以 UNAVAILABLE
+        结束，离开房间时照常广播离开通知。建议的重连时间在各聊天流之间随机
+        分散。之后由调用方停止 gRPC 服务器并调用 close。
+        """
+        self.draining = True
+        with self._parked_lock:
+            parked = [
+                (token, handler.generation) for token, handler in self._parked.items()
+            ]
+        for token, generation in parked:
+            self._expire_session(token, generation)
+        handlers = self._stream_handlers()
+        for handler in handlers:
+            draining = chat_pb2.ServerDraining(
+                reason=DRAIN_REASON,
+                reconnect_after_ms=int(
+                    random.uniform(0, self.drain_reconnect_spread) * 1000
+                ),
+            )
+            handler.send_message(
+                encode_server_message(chat_pb2.ServerMessage(draining=draining))
+            )
+            handler.stop()
+        log.info(
+            "server.drain",
+            "开始优雅关闭，通知 {streams} 个聊天流，最多等待 {timeout:g} 秒",
+            streams=len(handlers),
+            timeout=self.drain_timeout,
+        )
+
+    def _abort_slow_consumer(self, handler, context):
+        """以 RESOURCE_EXHAUSTED 结束接收过慢的连接"""
+        log.warning(
+            "stream.slow_consumer",
+            "用户 {user} 接收过慢，已丢弃 {dropped} 条消息，断开连接",
+            user=handler.user_name,
+            dropped=handler.dropped_count,
+        )
+        context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+        context.set_details("消息接收过慢，连接已被服务器断开")
+
+    def _throttle(self, handler, client_message) -> Optional[float]:
+        """在广播之前对聊天消息限速
+
+        Returns:
+            None 表示丢弃该消息，否则为处理之前需要等待的秒数
+        """
+        if self.rate_limiter is None or not client_message.HasField("chat_message"):
+            return 0.0
+        room_id = client_message.chat_message.room_id or handler.room_id
+        if room_id not in self.memberships.rooms(handler.user_name):
+            # 不在房间中的消息由 _handle_client_message 记录后忽略
+            return 0.0
+        delay = self.rate_limit_policy == RATE_LIMIT_DELAY
+        wait, scope = self.rate_limiter.acquire(
+            handler.user_name, room_id, MAX_RATE_LIMIT_DELAY if delay else 0.0
+        )
+        if not wait:
+            return 0.0
+        if delay and wait <= MAX_RATE_LIMIT_DELAY:
+            metrics.MESSAGES_RATE_LIMITED.inc((room_id, scope, RATE_LIMIT_DELAY))
+            return wait
+        # delay 策略下需要等待太久的消息也被丢弃
+        reject = self.rate_limit_policy == RATE_LIMIT_REJECT
+        action = RATE_LIMIT_REJECT if reject else RATE_LIMIT_DROP
+        metrics.MESSAGES_RATE_LIMITED.inc((room_id, scope, action))
+        if reject:
+            limited = chat_pb2.RateLimited(
+                scope=scope, retry_after_ms=max(1, int(wait * 1000))
+            )
+            handler.send_message(
+                encode_server_message(
+                    chat_pb2.ServerMessage(room_id=room_id, rate_limited=limited)
+                )
+            )
+        return None
+
+    def _handle_client_message(self, handler, client_message) -> bool:
+        """处理加入房间后收到的客户端消息
+
+        Returns:
+            是否继续读取该连接的后续消息
+        """
+        if handler.heartbeats:
+            # 任何消息都说明客户端仍然在线
+            self._watch_idle(handler)
+        if client_message.HasField("heartbeat"):
+            # 原样回送，客户端据此确认服务器仍然可达
+            heartbeat = chat_pb2.ServerMessage(heartbeat=client_message.heartbeat)
+            handler.send_message(encode_server_message(heartbeat))
+        elif client_message.HasField("chat_message"):
+            chat_msg = client_message.chat_message
+            room_id = chat_msg.room_id or handler.room_id
+            if handler.active and room_id in self.memberships.rooms(handler.user_name):
+                metrics.MESSAGES_RECEIVED.inc((room_id,))
+                log.message(
+                    "chat.message",
+                    "房间 {room} 中的用户 {user} 发送消息: {text}",
+                    room=room_id,
+                    user=handler.user_name,
+                    text=chat_msg.text,
+                )
+                self._broadcast_chat_message(handler.user_name, room_id, chat_msg.text)
+            else:
+                log.error(
+                    "chat.not_joined",
+                    "收到聊天消息但用户 {user} 不在房间 {room} 中",
+                    user=handler.user_name,
+                    room=room_id,
+                )
+        elif client_message.HasField("join_request"):
+            if handler.active:
+                self._join_another_room(handler, client_message.join_request)
+        elif client_message.HasField("leave_request"):
+            # 以连接上下文中的身份为准，忽略请求中携带的用户名
+            room_id = client_message.leave_request.room_id or handler.room_id
+            if handler.active and room_id in self.memberships.rooms(handler.user_name):
+                log.info(
+                    "user.leave_request",
+                    "用户 {user} 请求离开房间 {room}",
+                    user=handler.user_name,
+                    room=room_id,
+                )
+                self._handle_user_disconnect(
+                    handler.user_name,
+                    room_id,
+                    remove_from_global=False,
+                    handler=handler,
+                )
+                if handler.user_name not in self.memberships:
+                    # 离开了最后一个房间，结束聊天流
+                    handler.stop()
+                    return False
+        return True
+
+    def _join_another_room(self, handler, join_req):
+        """已加入房间的聊天流再加入一个房间
+
+        加入响应和回放的历史消息在登记到房间的同时放入发送队列，排在该房间
+        之后的实时消息之前；只回放内存中的历史。用户名等其余字段以第一次
+        加入时为准。多进程和集群模式下会阻塞等待总线应答，asyncio 模式下
+        需在线程池中调用，因此失败应答也经 _call_soon 放入队列。
+        """
+        room_id = join_req.room_id
+        if room_id in self.memberships.rooms(handler.user_name):
+            self._call_soon(
+                handler.send_message,
+                self._room_join_response(room_id, False, f"已在房间 '{room_id}' 中"),
+            )
+            return
+        request = chat_pb2.JoinRequest()
+        request.CopyFrom(join_req)
+        request.user_name = handler.user_name
+
+        def on_added(count: int, replay: List[bytes]):
+            handler.send_message(
+                self._room_join_response(
+                    room_id,
+                    True,
+                    _welcome(room_id, count),
+                    handler.sequences.get(room_id, 0),
+                )
+            )
+            for frame in self._replay_frames(replay, handler.accept_batches):
+                handler.send_message(frame)
+
+        success, message, replay = self._join_room(request, handler, on_added)
+        if not success:
+            log.warning(
+                "user.join_failed",
+                "用户 {user} 加入房间 {room} 失败: {reason}",
+                user=handler.user_name,
+                room=room_id,
+                reason=message,
+            )
+            self._call_soon(
+                handler.send_message, self._room_join_response(room_id, False, message)
+            )
+            return
+        if not handler.active:
+            # 聊天流在加入期间已经结束，离开全部房间的清理可能没有包括本房间
+            self._handle_user_disconnect(
+                handler.user_name, room_id, remove_from_global=False, handler=handler
+            )
+            return
+        self._announce_join(handler, len(replay), False, room_id)
+
+    def _room_join_response(
+        self, room_id: str, success: bool, message: str, last_sequence: int = 0
+    ) -> bytes:
+        """编码在已有聊天流上加入房间的应答"""
+        join_response = chat_pb2.JoinResponse(
+            success=success, message=message, last_sequence=last_sequence
+        )
+        return encode_server_message(
+            chat_pb2.ServerMessage(join_response=join_response, room_id=room_id)
+        )
+
+    def _open_session(self, join_req) -> Tuple[Any, bool, str, List[bytes], bool]:
+        """处理聊天流的加入请求
+
+        Returns:
+            (处理器, 是否成功, 提示信息, 需要回放的消息, 是否恢复了原会话)
+        """
+        if join_req.resume_token:
+            resumed = self._resume_session(join_req)
+            if resumed is not None:
+                handler, replay = resumed
+                room_id = join_req.room_id
+                message = f"已恢复房间 '{room_id}' 中的会话，补发 {len(replay)} 条消息"
+                self._start_idle_watch(handler, join_req.heartbeats)
+                return handler, True, message, replay, True
+        handler = self._create_handler(join_req.user_name, join_req.room_id)
+        handler.accept_batches = join_req.accept_batches
+        success, message, replay = self._handle_join_request(join_req, handler)
+        if success:
+            if self.resume_grace > 0 and join_req.resumable:
+                handler.resume_token = secrets.token_urlsafe(16)
+            self._start_idle_watch(handler, join_req.heartbeats)
+        return handler, success, message, replay, False
+
+    def _join_response(self, handler, success: bool, message: str, resumed: bool):
+        join_response = chat_pb2.JoinResponse(success=success, message=message)
+        if success:
+            join_response.resume_token = handler.resume_token
+            join_response.last_sequence = handler.last_sequence
+            join_response.resumed = resumed
+            join_response.heartbeat_interval_ms = int(self.heartbeat_interval * 1000)
+        return chat_pb2.ServerMessage(
+            join_response=join_response, room_id=handler.room_id
+        )
+
+    def _announce_join(
+        self, handler, replayed: int, resumed: bool, room_id: Optional[str] = None
+    ):
+        """加入成功后通知房间内的其他用户；恢复的会话不再通知
+
+        Args:
+            room_id: 加入的房间，默认为聊天流第一次加入的房间
+        """
+        room_id = room_id or handler.room_id
+        if resumed:
+            log.info(
+                "user.resume",
+                "用户 {user} 恢复了房间 {room} 中的会话，补发 {replayed} 条消息",
+                user=handler.user_name,
+                room=handler.room_id,
+                replayed=replayed,
+            )
+            return
+        self._broadcast_user_joined(handler.user_name, room_id, handler)
+        log.info(
+            "user.join",
+            "用户 {user} 成功加入房间 {room}，回放 {replayed} 条历史消息",
+            user=handler.user_name,
+            room=room_id,
+            replayed=replayed,
+        )
+
+    def _start_idle_watch(self, handler, heartbeats: bool):
+        """客户端承诺发送心跳时，开始检查该聊天流是否失联"""
+        handler.heartbeats = heartbeats and self.heartbeat_interval > 0
+        if handler.heartbeats:
+            self._watch_idle(handler)
+
+    def _watch_idle(self, handler):
+        """从现在起重新计算聊天流的静默期限"""
+        deadline = time.monotonic() + self.idle_timeout
+        with self._idle_lock:
+            self._idle_wheel.schedule(handler, deadline)
 
-            # 后续消息处理
-            def process_client_messages():
-                nonlocal handler, user_left
-                try:
-                    for client_message in request_iterator:
-                        if client_message.HasField("chat_message"):
-                            if handler and handler.active:
-                                chat_msg = client_message.chat_message
-                                print(
-                                    f"[INFO] 房间 {handler.room_id} 中的用户 {handler.user_name} 发送消息: {chat_msg.text}"
-                                )
-                                self._broadcast_chat_message(
-                                    handler.user_name, handler.room_id, chat_msg.text
-                                )
-                            else:
-                                print(f"[ERROR] 收到聊天消息但用户未正确加入房间")
-                        elif client_message.HasField("leave_request"):
-                            if handler and handler.active:
-                                leave_req = client_message.leave_request
-                                print(
-                                    f"[INFO] 用户 {leave_req.user_name} 请求离开房间 {leave_req.room_id}"
-                                )
-                                self._handle_user_disconnect(
-                                    leave_req.user_name,
-                                    leave_req.room_id,
-                                    remove_from_global=False,
-                                )
-                                user_left = True
-                                handler.stop()
-                                return
-                except Exception as e:
-                    print(f"[ERROR] 处理客户端消息时出错: {e}")
-
-            client_thread = threading.Thread(target=process_client_messages)
-            client_thread.daemon = True
-            client_thread.start()
-            for message in handler.get_messages():
-                yield message
+    def _unwatch_idle(self, handler):
+        with self._idle_lock:
+            self._idle_wheel.cancel(handler)
+
+    def _reap_idle_streams(self):
+        """回收静默超过期限的聊天流，之后继续定期检查"""
+        if self._closing:
+            return
+        try:
+            with self._idle_lock:
+                expired = self._idle_wheel.advance(time.monotonic())
+            for handler in expired:
+                self._evict_stream(handler)
         except Exception as e:
-            print(f"[ERROR] 聊天流异常: {e}")
+            log.error("stream.reap_error", "回收失联的聊天流时出错: {error}", error=e)
         finally:
-            # 在连接断开时，从全局用户集合中移除用户名
-            with self.lock:
-                self.global_users.discard(user_name)
-                print(f"[INFO] 用户 {user_name} 已从全局用户集合中移除")
-
-            if handler and handler.room_id and handler.user_name and not user_left:
-                with self.lock:
-                    if (
-                        handler.room_id in self.rooms
-                        and handler.user_name in self.rooms[handler.room_id]["handlers"]
-                    ):
-                        self._handle_user_disconnect(
-                            handler.user_name, handler.room_id, remove_from_global=False
-                        )
-                        print(
-                            f"[INFO] 用户 {handler.user_name} 离开房间 {handler.room_id}"
-                        )
-
-    def _handle_join_request(self, user_name: str, room_id: str) -> tuple[bool, str]:
-        """处理加入房间请求"""
-        with self.lock:
-            # 检查房间是否存在
-            if room_id not in self.rooms:
-                return False, f"房间 '{room_id}' 不存在"
-            # 检查房间是否已满
-            room = self.rooms[room_id]
-            if len(room["handlers"]) >= room["max_capacity"]:
-                return (
-                    False,
-                    f"房间 '{room_id}' 已满 ({room['max_capacity']}/{room['max_capacity']})",
+            self._call_later(REAPER_TICK, self._reap_idle_streams)
+
+    def _evict_stream(self, handler):
+        """立即让失联的聊天流离开房间并释放其队列
+
+        gRPC 可能要过一段时间才发现连接已断开，在此之前该聊天流不再占用
+        房间名额，也不再接收广播；用户名在聊天流真正结束时释放。
+        """
+        log.warning(
+            "stream.idle",
+            "用户 {user} 超过 {timeout:g} 秒没有心跳，回收其聊天流",
+            user=handler.user_name,
+            timeout=self.idle_timeout,
+        )
+        handler.evict()
+        metrics.STREAMS_REAPED.inc()
+        self._leave_rooms(handler)
+
+    def _resume_session(self, join_req) -> Optional[Tuple[Any, List[bytes]]]:
+        """按 resume_token 取回等待重连的会话
+
+        Returns:
+            (处理器, 需要补发的消息)；没有可恢复的会话时返回 None，按新加入处理
+        """
+        token = join_req.resume_token
+        with self._parked_lock:
+            handler = self._parked.get(token)
+            if (
+                handler is None
+                or handler.user_name != join_req.user_name
+                or handler.room_id != join_req.room_id
+            ):
+                return None
+            del self._parked[token]
+        room = self.rooms.get(handler.room_id)
+        replay_since = handler.last_sequence
+        if join_req.WhichOneof("replay") == "replay_since":
+            # 以客户端实际收到的为准，补上断开时尚在途中的消息
+            replay_since = min(replay_since, join_req.replay_since)
+        replay = None if room is None else room.resume(handler, replay_since)
+        if replay is None:
+            # 宽限期内房间被删除或成员被替换
+            self._release_user_name(handler.user_name, True)
+            return None
+        return handler, replay
+
+    def _park_session(self, handler) -> bool:
+        """聊天流意外断开时保留会话，宽限期内可凭 resume_token 恢复
+
+        Returns:
+            是否保留了会话；客户端未声明会重连、已离开房间、接收过慢被断开
+            或未加入时返回 False
+        """
+        if (
+            not handler.resume_token
+            or not handler.joined
+            or handler.overflowed
+            or self.draining
+        ):
+            return False
+        room = self.rooms.get(handler.room_id)
+        if room is None or room.handlers.get(handler.user_name) is not handler:
+            return False
+        # 只保留第一次加入的房间，之后加入的房间立即离开，重连后由客户端重新加入
+        for room_id in self.memberships.rooms(handler.user_name):
+            if room_id != handler.room_id:
+                self._handle_user_disconnect(
+                    handler.user_name,
+                    room_id,
+                    remove_from_global=False,
+                    handler=handler,
+                )
+        with self._parked_lock:
+            self._parked[handler.resume_token] = handler
+        self._call_later(
+            self.resume_grace,
+            partial(self._expire_session, handler.resume_token, handler.generation),
+        )
+        log.info(
+            "user.park",
+            "用户 {user} 与房间 {room} 的连接断开，保留会话 {grace:g} 秒等待重连",
+            user=handler.user_name,
+            room=handler.room_id,
+            grace=self.resume_grace,
+        )
+        return True
+
+    def _expire_session(self, token: str, generation: int):
+        """宽限期结束仍未重连：按正常离开处理"""
+        with self._parked_lock:
+            handler = self._parked.get(token)
+            if handler is None or handler.generation != generation:
+                # 已恢复（之后可能再次断开，由新的定时器负责）
+                return
+            del self._parked[token]
+        self._release_user_name(handler.user_name, True)
+        for room_id in self._leave_rooms(handler):
+            log.info(
+                "user.leave",
+                "用户 {user} 未在宽限期内重连，离开房间 {room}",
+                user=handler.user_name,
+                room=room_id,
+            )
+
+    def _handle_stream_closed(self, handler, user_name):
+        """聊天流结束时的清理"""
+        if handler is None:
+            # 被准入控制拒绝或不是以加入请求开始的聊天流没有登记任何状态；
+            # 打开会话时出错的只释放校验用户名时的预留
+            if user_name:
+                self._release_user_name(user_name)
+            return
+        self._unwatch_idle(handler)
+        if self._park_session(handler):
+            return
+        # 在连接断开时释放该聊天流持有的用户名租约；未加入房间时释放预留
+        self._release_user_name(user_name, handler.joined)
+        if self.rate_limiter is not None and user_name:
+            self.rate_limiter.forget_user(user_name)
+        log.info("user.release", "用户 {user} 已从全局用户集合中移除", user=user_name)
+
+        if handler.room_id and handler.user_name:
+            log.info(
+                "stream.stats",
+                "用户 {user} 连接统计: 入队 {queued} 条, 丢弃 {dropped} 条",
+                user=handler.user_name,
+                queued=handler.queued_count,
+                dropped=handler.dropped_count,
+            )
+            for room_id in self._leave_rooms(handler):
+                log.info(
+                    "user.leave",
+                    "用户 {user} 离开房间 {room}",
+                    user=handler.user_name,
+                    room=room_id,
                 )
+
+    def _leave_rooms(self, handler) -> List[str]:
+        """让聊天流离开它所在的全部房间
+
+        Returns:
+            该聊天流确实在其中、已经离开的房间
+        """
+        room_ids = dict.fromkeys(
+            (handler.room_id,) + self.memberships.rooms(handler.user_name)
+        )
+        return [
+            room_id
+            for room_id in room_ids
+            if self._handle_user_disconnect(
+                handler.user_name, room_id, remove_from_global=False, handler=handler
+            )
+        ]
+
+    def _handle_join_request(self, join_req, handler) -> Tuple[bool, str, List[bytes]]:
+        """处理加入房间请求，成功时处理器已登记到房间中，并确认用户名租约
+
+        Returns:
+            (是否成功, 提示信息, 需要回放的历史消息)
+        """
+        success, message, replay = self._join_room(join_req, handler)
+        if success:
+            self._confirm_user_name(handler)
+        return success, message, replay
+
+    def _join_room(
+        self, join_req, handler, on_added=None
+    ) -> Tuple[bool, str, List[bytes]]:
+        """校验房间和容量，成功时把处理器登记到房间中
+
+        Args:
+            on_added: 见 Room.add；指定时不从持久化日志读取更早的历史
+        """
+        room_id = join_req.room_id
+        # 检查房间是否存在
+        room = self.rooms.get(room_id)
+        if room is None:
+            return False, f"房间 '{room_id}' 不存在", []
+        replay_since = None
+        if join_req.WhichOneof("replay") == "replay_since":
+            replay_since = join_req.replay_since
+        if self.bus is not None:
+            return self._join_via_bus(room, join_req, handler, replay_since, on_added)
+        # 检查房间是否已满并加入
+        success, count, replay, history_start = room.add(
+            join_req.user_name, handler, join_req.replay_last, replay_since, on_added
+        )
+        if success and self.message_log is not None and on_added is None:
+            # 内存历史之外的更早消息从持久化日志中读取（在房间锁之外）
+            replay = (
+                self._read_older_history(
+                    room_id, join_req, replay_since, len(replay), history_start
+                )
+                + replay
+            )
+        if not success:
+            if room.closed:
+                return False, f"房间 '{room_id}' 不存在", []
             return (
-                True,
-                f"欢迎来到房间 '{room_id}'！当前在线人数: {len(room['handlers']) + 1}",
+                False,
+                f"房间 '{room_id}' 已满 ({room.max_capacity}/{room.max_capacity})",
+                [],
+            )
+        self.memberships.add(join_req.user_name, room_id)
+        self.room_watch.mark(room_id)
+        return True, _welcome(room_id, count), replay
+
+    def _join_via_bus(
+        self, room, join_req, handler, replay_since: Optional[int], on_added=None
+    ) -> Tuple[bool, str, List[bytes]]:
+        """多进程和集群模式下加入房间
+
+        容量检查和回放都由房间的权威方完成。本地登记在 on_joined 中进行，
+        它与总线事件按同一顺序执行，因此回放的消息与之后实时收到的消息
+        之间既不会重复也不会遗漏。请求会阻塞等待应答，asyncio 模式下需在
+        线程池中调用。
+        """
+        room_id = room.room_id
+        added: List[bool] = []
+
+        def on_joined(count: str, replay: List[bytes]):
+            success, _, _, _ = room.add(join_req.user_name, handler)
+            added.append(success)
+            if success and on_added is not None:
+                # 本房间之后的事件在此之后才会处理，不会排到回放之前
+                on_added(int(count), replay)
+
+        try:
+            joined, value, replay = self.bus.join(
+                room_id,
+                join_req.user_name,
+                join_req.replay_last,
+                replay_since,
+                on_joined,
             )
+        except ConnectionError as e:
+            return False, f"房间 '{room_id}' 暂时不可用: {e}", []
+        if not joined:
+            if value == REASON_FULL:
+                capacity = room.max_capacity
+                return False, f"房间 '{room_id}' 已满 ({capacity}/{capacity})", []
+            return False, f"房间 '{room_id}' 不存在", []
+        if not added or not added[0]:
+            # 权威方已接受，但本地房间已被删除
+            self.bus.leave(room_id, join_req.user_name)
+            return False, f"房间 '{room_id}' 不存在", []
+        self.memberships.add(join_req.user_name, room_id)
+        self.room_watch.mark(room_id)
+        return True, _welcome(room_id, value), replay
 
-    def _broadcast_user_joined(self, new_user: str, room_id: str):
+    def _read_older_history(
+        self,
+        room_id: str,
+        join_req,
+        replay_since: Optional[int],
+        in_memory: int,
+        history_start: int,
+    ) -> List[bytes]:
+        """从持久化日志读取序号小于 history_start 的回放消息"""
+        budget = MAX_REPLAY_MESSAGES - in_memory
+        if replay_since is not None:
+            first = replay_since + 1
+        else:
+            first = history_start - (join_req.replay_last - in_memory)
+        first = max(1, first, history_start - budget)
+        if first >= history_start:
+            return []
+        return self.message_log.read(room_id, first, history_start - 1)
+
+    def _replay_frames(self, replay: List[bytes], accept_batches: bool):
+        """将回放的历史消息切分为发送帧，支持批量的客户端按字节上限合并"""
+        if not accept_batches:
+            for payload in replay:
+                yield payload
+            return
+        batch: List[bytes] = []
+        size = 0
+        for payload in replay:
+            batch.append(payload)
+            size += len(payload)
+            if size >= self.batch_max_bytes:
+                yield encode_batch(batch)
+                batch = []
+                size = 0
+        if batch:
+            yield encode_batch(batch)
+
+    def _broadcast_user_joined(self, new_user: str, room_id: str, new_handler=None):
         """广播用户加入通知"""
-        with self.lock:
-            if room_id in self.rooms:
-                # 获取当前房间人数（包括新加入的用户）
-                current_count = len(self.rooms[room_id]["handlers"])
-                notification = chat_pb2.UserJoinedNotification(
-                    user_name=new_user, current_count=current_count
-                )
-                server_message = chat_pb2.ServerMessage(user_joined=notification)
+        if self.bus is not None:
+            # 由房间总线在加入时统一广播
+            return
+        room = self.rooms.get(room_id)
+        if room is not None:
+            # 当前房间人数（包括新加入的用户）
+            payload = encode_user_joined(room_id, new_user, room.participant_count)
 
-                # 发送给房间内的所有其他用户（不包括刚加入的用户）
-                for user_name, handler in self.rooms[room_id]["handlers"].items():
-                    if user_name != new_user:
-                        handler.send_message(server_message)
+            # 发送给房间内的所有其他用户（不包括刚加入的用户）
+            room.broadcast(payload, exclude=new_handler)
 
     def _broadcast_chat_message(self, sender: str, room_id: str, text: str):
         """广播聊天消息"""
-        with self.lock:
-            if room_id in self.rooms:
-                timestamp = int(time.time())
-                broadcast_msg = chat_pb2.BroadcastMessage(
-                    sender_name=sender, text=text, timestamp=timestamp
-                )
-                server_message = chat_pb2.ServerMessage(broadcast=broadcast_msg)
+        started = time.perf_counter()
+        room = self.rooms.get(room_id)
+        if room is not None:
+            timestamp = int(time.time())
+            if self.bus is not None:
+                # 由房间总线分配序号并发给所有工作进程
+                self.bus.publish(room_id, sender, text, timestamp)
+                return
 
-                # 发送给房间内的所有用户（包括发送者）
-                for user_name, handler in list(self.rooms[room_id]["handlers"].items()):
-                    handler.send_message(server_message)
+            def encode(sequence: int) -> bytes:
+                # 只编码一次，所有接收者和历史记录共享同一份字节
+                return encode_chat_message(room_id, sender, text, timestamp, sequence)
+
+            # 发送给房间内的所有用户（包括发送者），并写入房间历史
+            room.publish(encode, started)
 
     def _handle_user_disconnect(
-        self, user_name: str, room_id: str, remove_from_global: bool = True
-    ):
-        """处理用户断开连接"""
-        with self.lock:
-            self._remove_user_from_room(user_name, room_id, remove_from_global)
-            self._broadcast_user_left(user_name, room_id)
+        self,
+        user_name: str,
+        room_id: str,
+        remove_from_global: bool = True,
+        handler=None,
+    ) -> bool:
+        """处理用户断开连接
+
+        Returns:
+            用户此前是否在房间中
+        """
+        count = self._remove_user_from_room(
+            user_name, room_id, remove_from_global, handler
+        )
+        if count is None:
+            return False
+        self._broadcast_user_left(user_name, room_id, count)
+        return True
 
     def _remove_user_from_room(
-        self, user_name: str, room_id: str, remove_from_global: bool = True
-    ):
-        """从房间移除用户"""
-        if room_id in self.rooms and user_name in self.rooms[room_id]["handlers"]:
-            handler = self.rooms[room_id]["handlers"][user_name]
+        self,
+        user_name: str,
+        room_id: str,
+        remove_from_global: bool = True,
+        handler=None,
+    ) -> Optional[int]:
+        """从房间移除用户
+
+        Args:
+            handler: 若指定，只有当房间内登记的正是该处理器时才移除
+
+        Returns:
+            移除后的房间人数，用户不在房间中时返回 None
+        """
+        room = self.rooms.get(room_id)
+        if room is None:
+            return None
+        handler, count = room.remove(user_name, handler)
+        if handler is None:
+            return None
+        if not self.memberships.discard(user_name, room_id):
+            # 已不在任何房间中
             handler.stop()
-            del self.rooms[room_id]["handlers"][user_name]
-            # 只在需要时从全局用户集合中移除用户
-            if remove_from_global:
-                self.global_users.discard(user_name)
-                print(f"[INFO] 用户 {user_name} 已从全局用户集合中移除")
+        self.room_watch.mark(room_id)
+        if self.bus is not None:
+            self.bus.leave(room_id, user_name)
+        # 只在需要时从全局用户集合中移除用户
+        if remove_from_global:
+            self._release_user_name(user_name)
+            log.info(
+                "user.release", "用户 {user} 已从全局用户集合中移除", user=user_name
+            )
+        return count
+
+    def _confirm_user_name(self, handler):
+        """聊天流加入房间后确认用户名租约，此后直到聊天流结束都不会过期"""
+        handler.joined = True
+        with self.users_lock:
+            self.user_leases.confirm(handler.user_name)
+        if self.bus is not None:
+            self.bus.confirm_user(handler.user_name)
+
+    def _release_user_name(self, user_name: Optional[str], joined: bool = False):
+        """释放用户名
+
+        Args:
+            joined: 是否是已确认租约的聊天流结束；为 False 时只释放尚未确认的预留
+        """
+        with self.users_lock:
+            if joined:
+                self.user_leases.release(user_name)
+            else:
+                self.user_leases.discard(user_name)
+        if self.bus is not None and user_name:
+            self.bus.release_user(user_name, joined)
 
-    def _broadcast_user_left(self, left_user: str, room_id: str):
+    def _broadcast_user_left(self, left_user: str, room_id: str, current_count: int):
         """广播用户离开通知"""
-        if room_id in self.rooms:
-            # 获取当前房间人数（不包括离开的用户）
-            current_count = len(self.rooms[room_id]["handlers"])
-            notification = chat_pb2.UserLeftNotification(
-                user_name=left_user, current_count=current_count
-            )
-            server_message = chat_pb2.ServerMessage(user_left=notification)
+        if self.bus is not None:
+            # 由房间总线统一广播
+            return
+        room = self.rooms.get(room_id)
+        if room is not None:
+            # 当前房间人数（不包括离开的用户）
+            payload = encode_user_left(room_id, left_user, current_count)
 
             # 发送给房间内的剩余用户
-            for user_name, handler in list(self.rooms[room_id]["handlers"].items()):
-                handler.send_message(server_message)
+            room.broadcast(payload)
 
     def CheckUsername(self, request, context):
         """校验用户名唯一性"""
         user_name = request.user_name
-        with self.lock:
-            # 检查全局用户名集合
-            if user_name in self.global_users:
+        if self.bus is not None:
+            # 多进程和集群模式下由房间总线保证全局唯一
+            try:
+                available = self.bus.claim_user(user_name)
+            except ConnectionError as e:
+                return chat_pb2.CheckUsernameResponse(available=False, message=str(e))
+            if not available:
+                return chat_pb2.CheckUsernameResponse(
+                    available=False, message=f"用户名 '{user_name}' 已被占用"
+                )
+            return chat_pb2.CheckUsernameResponse(available=True, message="用户名可用")
+        waiting = time.perf_counter()
+        with self.users_lock:
+            metrics.LOCK_WAIT.observe(time.perf_counter() - waiting, ("users",))
+            # 先移除已过期的预留，再检查并预留用户名
+            expired = self.user_leases.expire()
+            if expired:
+                log.debug(
+                    "user.lease_expired",
+                    "{count} 个用户名预留已过期",
+                    count=len(expired),
+                )
+            if not self.user_leases.reserve(user_name):
                 return chat_pb2.CheckUsernameResponse(
                     available=False, message=f"用户名 '{user_name}' 已被占用"
                 )
-            # 用户名可用，立即添加到全局集合
-            self.global_users.add(user_name)
             return chat_pb2.CheckUsernameResponse(available=True, message="用户名可用")
 
 
-def serve(host: str = "[::]", port: int = 50051):
+def _welcome(room_id: str, count) -> str:
+    return f"欢迎来到房间 '{room_id}'！当前在线人数: {count}"
+
+
+# 页码标记的前缀，防止把一种排序的标记用于另一种排序
+_TOKEN_BY_NAME = "n:"
+_TOKEN_BY_PARTICIPANTS = "p:"
+
+
+def _encode_page_token(cursor: str, by_participants: bool) -> str:
+    kind = _TOKEN_BY_PARTICIPANTS if by_participants else _TOKEN_BY_NAME
+    return base64.urlsafe_b64encode((kind + cursor).encode("utf-8")).decode("ascii")
+
+
+def _decode_page_token(token: str, by_participants: bool) -> str:
+    """解析页码标记，格式不对或与排序方式不符时抛出 ValueError"""
+    if not token:
+        return ""
+    try:
+        raw = base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError(token) from e
+    kind = _TOKEN_BY_PARTICIPANTS if by_participants else _TOKEN_BY_NAME
+    if not raw.startswith(kind):
+        raise ValueError(token)
+    cursor = raw[len(kind) :]
+    if by_participants and not cursor.isdigit():
+        raise ValueError(token)
+    return cursor
+
+
+SERVER_MODES = ("thread", "asyncio")
+
+
+def _print_banner(listen_addr: str, mode: str):
+    """打印服务器启动信息"""
+    print(f"🚀 聊天服务器已启动，监听地址: {listen_addr} (模式: {mode})")
+    print(f"📋 初始房间: {', '.join(DEFAULT_ROOMS)}（可通过 CreateRoom/DeleteRoom 增删）")
+    print(
+        f"👥 房间默认容量: {DEFAULT_ROOM_CAPACITY} 人，"
+        f"创建时可指定 1-{MAX_ROOM_CAPACITY} 人"
+    )
+    print("⌨️  按 Ctrl+C 停止服务器\n")
+
+
+def serve(
+    host: str = "[::]",
+    port: int = 50051,
+    mode: str = "asyncio",
+    workers: int = 1,
+    log_config: Optional[Dict[str, Any]] = None,
+    metrics_port: Optional[int] = None,
+    **server_options,
+):
     """启动聊天服务器
 
     Args:
         host: 监听地址，默认为 '[::]'（所有IPv4和IPv6地址）
         port: 监听端口，默认为 50051
+        mode: 服务器模式，'thread' 为线程池模式，'asyncio' 为基于 grpc.aio 的异步模式
+        workers: 工作进程数，大于 1 时启用多进程模式
+        log_config: 传给 log.configure 的参数，为 None 时不改变日志配置
+        metrics_port: 提供 Prometheus 指标（GET /metrics）的 HTTP 端口，为 None 时
+            不提供；多进程模式下第 i 个工作进程使用 metrics_port + i
+        **server_options: 传给 ChatServer 的参数，如 max_queue_size、overflow_policy
     """
-    # 创建gRPC服务器
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    if mode not in SERVER_MODES:
+        raise ValueError(f"未知的服务器模式: {mode}，可选: {', '.join(SERVER_MODES)}")
+    if log_config is not None:
+        log.configure(**log_config)
+    if workers > 1:
+        if server_options.get("cluster_nodes"):
+            raise ValueError("集群模式下每个节点只能使用一个工作进程")
+        serve_workers(
+            host, port, mode, workers, log_config, metrics_port, **server_options
+        )
+        return
+    if metrics_port is not None:
+        metrics.start_http_server(host, metrics_port)
+
+    if mode == "asyncio":
+        import asyncio
+
+        from grpc_chat.aio_server import serve_async
+
+        try:
+            asyncio.run(serve_async(host, port, **server_options))
+        except KeyboardInterrupt:
+            pass
+        print("✅ 服务器已关闭")
+        return
+
+    # 创建gRPC服务器：每个聊天流和房间列表订阅各占用一个工作线程，分别
+    # 计数，长期占用的流不会挤占一元 RPC 的线程；工作线程都被占用时新的
+    # RPC 立即以 RESOURCE_EXHAUSTED 失败，而不是排队等待
+    max_streams = server_options.get("max_streams") or MAX_WORKERS
+    max_watchers = server_options.get("max_watchers") or max_streams
+    server_options["max_streams"] = max_streams
+    server_options["max_watchers"] = max_watchers
+    workers = max_streams + max_watchers + UNARY_WORKERS
+    options = grpc_server_options(server_options)
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=workers),
+        options=options,
+        maximum_concurrent_rpcs=workers,
+    )
 
     # 添加服务到服务器
-    chat_service = ChatServer()
-    chat_pb2_grpc.add_ChatServiceServicer_to_server(chat_service, server)
+    chat_service = ChatServer(**server_options)
+    add_chat_service_to_server(chat_service, server)
 
     # 监听地址和端口
     listen_addr = f"{host}:{port}"
@@ -290,23 +1733,156 @@ def serve(host: str = "[::]", port: int = 50051):
 
     # 启动服务器
     server.start()
-    print(f"🚀 聊天服务器已启动，监听地址: {listen_addr}")
-    print("📋 可用房间: general, tech, gaming, random")
-    print("👥 每个房间最大容量: 20 人")
-    print("⌨️  按 Ctrl+C 停止服务器\n")
+    _print_banner(listen_addr, mode)
 
+    _interrupt_once()
     try:
         server.wait_for_termination()
     except KeyboardInterrupt:
         print("\n⏹️  正在关闭服务器...")
-        server.stop(0)
+        chat_service.drain()
+        server.stop(chat_service.drain_timeout).wait()
+        chat_service.close()
         print("✅ 服务器已关闭")
 
 
-def main():
-    import argparse
+def _interrupt_once():
+    """把 SIGTERM 当作 Ctrl+C 处理，滚动重启时同样优雅关闭
 
-    parser = argparse.ArgumentParser(description="启动聊天服务器")
+    只有第一个信号引发 KeyboardInterrupt：多进程模式下工作进程可能先收到
+    终端的 Ctrl+C，再收到主进程转发的 SIGTERM，后者不能打断正在进行的关闭。
+    """
+    interrupted = []
+
+    def interrupt(signum, frame):
+        if not interrupted:
+            interrupted.append(signum)
+            raise KeyboardInterrupt
+
+    try:
+        signal.signal(signal.SIGINT, interrupt)
+        signal.signal(signal.SIGTERM, interrupt)
+    except ValueError:
+        # 不在主线程中，保持默认行为
+        pass
+
+
+def serve_workers(
+    host: str,
+    port: int,
+    mode: str,
+    workers: int,
+    log_config: Optional[Dict[str, Any]] = None,
+    metrics_port: Optional[int] = None,
+    **server_options,
+):
+    """多进程模式：主进程运行房间总线，workers 个工作进程共享监听端口
+
+    每个工作进程是一个完整的聊天服务器（含自己的 GIL），通过 SO_REUSEPORT
+    监听同一端口，连接由内核在进程间分配；跨进程的广播、用户名和人数由
+    房间总线统一协调。
+    """
+    from grpc_chat.bus import BusHub
+
+    if server_options.get("data_dir"):
+        raise ValueError("多进程模式暂不支持 --data-dir")
+    bus_dir = tempfile.mkdtemp(prefix="grpc-chat-")
+    bus_path = os.path.join(bus_dir, "bus.sock")
+    hub = BusHub(
+        bus_path,
+        {room_id: DEFAULT_ROOM_CAPACITY for room_id in DEFAULT_ROOMS},
+        server_options.get("history_size", DEFAULT_HISTORY_SIZE),
+        server_options.get("username_ttl", DEFAULT_LEASE_TTL),
+    )
+    hub.start()
+
+    # 使用 spawn 而不是 fork，避免子进程继承 gRPC 的内部线程状态
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=serve,
+            args=(host, port, mode),
+            kwargs=dict(
+                server_options,
+                log_config=log_config,
+                metrics_port=None if metrics_port is None else metrics_port + index,
+                bus_path=bus_path,
+            ),
+            name=f"chat-worker-{index}",
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward_sigterm(signum, frame):
+        # 工作进程各自优雅关闭，主进程等待它们退出
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward_sigterm)
+    log.info(
+        "server.workers",
+        "已启动 {workers} 个工作进程 (模式: {mode})",
+        workers=workers,
+        mode=mode,
+    )
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # 终端的 Ctrl+C 会同时发给所有工作进程；只发给主进程时（kill -INT、
+        # 进程管理器）由主进程转发，工作进程只响应第一个关闭信号
+        forward_sigterm(signal.SIGINT, None)
+        for process in processes:
+            process.join()
+        print("✅ 服务器已关闭")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        hub.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+def grpc_server_options(server_options: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    """从 server_options 中取出 gRPC 服务器本身的参数，其余留给 ChatServer"""
+    keepalive_time = server_options.pop("keepalive_time", DEFAULT_KEEPALIVE_TIME)
+    keepalive_timeout = server_options.pop(
+        "keepalive_timeout", DEFAULT_KEEPALIVE_TIMEOUT
+    )
+    connection_streams = server_options.pop("max_connection_streams", 0)
+    # 即使服务器自己不发送 ping，也接受客户端（sdk 默认每 30 秒）的 keepalive
+    # ping，否则 gRPC 默认会以 too_many_pings 断开；服务器发送 ping 时，没有
+    # 进行中的 RPC（如停留在大厅）也检查连接
+    options: List[Tuple[str, Any]] = [
+        ("grpc.keepalive_permit_without_calls", 1),
+        (
+            "grpc.http2.min_recv_ping_interval_without_data_ms",
+            MIN_CLIENT_PING_INTERVAL_MS,
+        ),
+        ("grpc.max_receive_message_length", MAX_RECEIVE_MESSAGE_BYTES),
+    ]
+    if connection_streams > 0:
+        # 通过 HTTP/2 SETTINGS 限制单条连接上同时打开的流数，超出的流在
+        # 客户端排队，不占用服务器资源
+        options.append(("grpc.max_concurrent_streams", connection_streams))
+    if keepalive_time > 0:
+        options += [
+            ("grpc.keepalive_time_ms", int(keepalive_time * 1000)),
+            ("grpc.keepalive_timeout_ms", int(keepalive_timeout * 1000)),
+            # 空闲连接上没有数据帧时也持续发送 ping
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+    if server_options.get("bus_path"):
+        # 多进程模式下所有工作进程监听同一端口，由内核分配连接
+        options.append(("grpc.so_reuseport", 1))
+    return options
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """向命令行解析器添加服务器参数"""
     parser.add_argument(
         "--host",
         type=str,
@@ -316,9 +1892,315 @@ def main():
     parser.add_argument(
         "--port", type=int, default=50051, help="监听端口 (默认: 50051)"
     )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=SERVER_MODES,
+        default="asyncio",
+        help="服务器模式 (默认: asyncio; thread 模式下每个连接占用两个线程)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="工作进程数，大于 1 时多个进程共享监听端口并通过房间总线协调 (默认: 1)",
+    )
+    parser.add_argument(
+        "--node-id",
+        type=str,
+        default=None,
+        help="集群模式下本节点的ID，须出现在 --cluster 中",
+    )
+    parser.add_argument(
+        "--cluster",
+        type=str,
+        default=None,
+        help="集群节点列表，格式为 'a=127.0.0.1:60051,b=127.0.0.1:60052'，"
+        "地址用于节点之间的内部通信；房间按一致性哈希分配给各节点",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help=f"每个连接的发送队列容量 (默认: {DEFAULT_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        type=str,
+        choices=OVERFLOW_POLICIES,
+        default=OVERFLOW_DROP_OLDEST,
+        help="发送队列满时的处理策略 (默认: drop-oldest)",
+    )
+    parser.add_argument(
+        "--batch-delay-ms",
+        type=float,
+        default=DEFAULT_BATCH_DELAY * 1000,
+        help="向支持批量的客户端合并发送事件时最多等待的毫秒数，0 表示关闭 (默认: 5)",
+    )
+    parser.add_argument(
+        "--batch-max-bytes",
+        type=int,
+        default=DEFAULT_BATCH_MAX_BYTES,
+        help=f"每个批次的字节上限 (默认: {DEFAULT_BATCH_MAX_BYTES})",
+    )
+    parser.add_argument(
+        "--history-size",
+        type=int,
+        default=DEFAULT_HISTORY_SIZE,
+        help=f"每个房间保留用于回放的历史消息条数，0 表示关闭 (默认: {DEFAULT_HISTORY_SIZE})",
+    )
+    parser.add_argument(
+        "--watch-interval-ms",
+        type=float,
+        default=DEFAULT_WATCH_INTERVAL * 1000,
+        help="合并房间列表变化后推送给大厅订阅者的窗口毫秒数 (默认: 200)",
+    )
+    parser.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        default=DEFAULT_HEARTBEAT_INTERVAL,
+        help="要求客户端发送心跳的间隔秒数，连续 "
+        f"{HEARTBEAT_MISSES} 个间隔没有消息的聊天流被回收，0 表示关闭 "
+        f"(默认: {DEFAULT_HEARTBEAT_INTERVAL:g})",
+    )
+    parser.add_argument(
+        "--keepalive-time",
+        type=float,
+        default=DEFAULT_KEEPALIVE_TIME,
+        help="连接空闲多少秒后发送 HTTP/2 keepalive ping，0 表示关闭 "
+        f"(默认: {DEFAULT_KEEPALIVE_TIME:g})",
+    )
+    parser.add_argument(
+        "--keepalive-timeout",
+        type=float,
+        default=DEFAULT_KEEPALIVE_TIMEOUT,
+        help="等待 keepalive ping 应答的秒数，超时即断开连接 "
+        f"(默认: {DEFAULT_KEEPALIVE_TIMEOUT:g})",
+    )
+    parser.add_argument(
+        "--resume-grace",
+        type=float,
+        default=DEFAULT_RESUME_GRACE,
+        help="聊天流意外断开后保留会话等待重连的秒数，0 表示不保留 "
+        f"(默认: {DEFAULT_RESUME_GRACE:g})",
+    )
+    parser.add_argument(
+        "--username-ttl",
+        type=float,
+        default=DEFAULT_LEASE_TTL,
+        help="校验通过但尚未加入房间的用户名保留的秒数 "
+        f"(默认: {DEFAULT_LEASE_TTL:g})",
+    )
+    rate_scopes = (("user", "每个用户"), ("room", "每个房间"), ("server", "整个服务器"))
+    for scope, name in rate_scopes:
+        parser.add_argument(
+            f"--{scope}-rate",
+            type=float,
+            default=0.0,
+            help=f"{name}每秒最多转发的聊天消息数，0 表示不限 (默认: 0)",
+        )
+        parser.add_argument(
+            f"--{scope}-burst",
+            type=float,
+            default=0.0,
+            help=f"{name}最多可以连续发送的消息数，"
+            f"0 表示与 --{scope}-rate 相同 (默认: 0)",
+        )
+    parser.add_argument(
+        "--rate-limit-policy",
+        type=str,
+        choices=RATE_LIMIT_POLICIES,
+        default=RATE_LIMIT_DROP,
+        help="超出限速时的处理: drop 丢弃，delay 暂停读取该聊天流，"
+        "reject 丢弃并向发送者返回 RateLimited 事件 (默认: drop)",
+    )
+    parser.add_argument(
+        "--max-streams",
+        type=int,
+        default=0,
+        help="同时打开的聊天流数上限，超出时新的聊天流立即以 RESOURCE_EXHAUSTED "
+        f"被拒绝，0 表示不限；thread 模式下默认为 {MAX_WORKERS} (默认: 0)",
+    )
+    parser.add_argument(
+        "--max-watchers",
+        type=int,
+        default=0,
+        help="同时打开的房间列表订阅（大厅）数上限，0 表示不限；thread 模式下"
+        "默认与聊天流数上限相同 (默认: 0)",
+    )
+    parser.add_argument(
+        "--max-connection-streams",
+        type=int,
+        default=0,
+        help="每条 HTTP/2 连接上同时打开的流数上限，0 表示使用 gRPC 的默认值 "
+        "(默认: 0)",
+    )
+    parser.add_argument(
+        "--join-rate",
+        type=float,
+        default=0.0,
+        help="每秒最多接纳的新聊天流数，0 表示不限 (默认: 0)",
+    )
+    parser.add_argument(
+        "--join-burst",
+        type=float,
+        default=0.0,
+        help="最多连续接纳的新聊天流数，0 表示与 --join-rate 相同 (默认: 0)",
+    )
+    parser.add_argument(
+        "--max-queue-bytes",
+        type=int,
+        default=0,
+        help="所有发送队列中等待发送的字节数超过该值时拒绝新的聊天流，"
+        "0 表示不限 (默认: 0)",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=DEFAULT_DRAIN_TIMEOUT,
+        help="收到 Ctrl+C 或 SIGTERM 后等待聊天流发送完剩余消息的秒数，"
+        f"之后强制关闭 (默认: {DEFAULT_DRAIN_TIMEOUT:g})",
+    )
+    parser.add_argument(
+        "--drain-reconnect-spread",
+        type=float,
+        default=DEFAULT_DRAIN_RECONNECT_SPREAD,
+        help="关闭时建议客户端在 0 到该秒数之间随机选择重连时间 "
+        f"(默认: {DEFAULT_DRAIN_RECONNECT_SPREAD:g})",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        choices=tuple(log.LOG_LEVELS),
+        default="info",
+        help="日志级别 (默认: info; message 及以下才记录聊天内容)",
+    )
+    parser.add_argument(
+        "--log-format",
+        type=str,
+        choices=log.LOG_FORMATS,
+        default="text",
+        help="日志格式 (默认: text; json 为每行一个 JSON 对象)",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=str,
+        action="append",
+        default=[],
+        metavar="EVENT=N",
+        help="该事件每 N 条只记录 1 条，可重复指定，如 chat.message=100",
+    )
+    parser.add_argument(
+        "--log-rate-limit",
+        type=float,
+        default=log.DEFAULT_RATE_LIMIT,
+        help=f"每种事件每秒最多记录的条数，0 表示不限 (默认: {log.DEFAULT_RATE_LIMIT:g})",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="在该端口以 HTTP 提供 Prometheus 指标 (/metrics)，不指定则不提供",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        default=None,
+        help="持久化消息日志的目录，不指定则不持久化",
+    )
+    parser.add_argument(
+        "--fsync",
+        type=str,
+        choices=FSYNC_POLICIES,
+        default=FSYNC_INTERVAL,
+        help="消息日志的 fsync 策略 (默认: interval)",
+    )
+    parser.add_argument(
+        "--fsync-interval",
+        type=float,
+        default=DEFAULT_FSYNC_INTERVAL,
+        help=f"interval 策略下两次 fsync 的最大间隔秒数 (默认: {DEFAULT_FSYNC_INTERVAL})",
+    )
+
+
+def server_options_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    """从命令行参数中提取传给 ChatServer 的参数"""
+    return {
+        "max_queue_size": args.queue_size,
+        "overflow_policy": args.overflow_policy,
+        "batch_delay": args.batch_delay_ms / 1000,
+        "batch_max_bytes": args.batch_max_bytes,
+        "history_size": args.history_size,
+        "data_dir": args.data_dir,
+        "fsync_policy": args.fsync,
+        "fsync_interval": args.fsync_interval,
+        "watch_interval": args.watch_interval_ms / 1000,
+        "username_ttl": args.username_ttl,
+        "resume_grace": args.resume_grace,
+        "heartbeat_interval": args.heartbeat_interval,
+        "user_rate": args.user_rate,
+        "user_burst": args.user_burst,
+        "room_rate": args.room_rate,
+        "room_burst": args.room_burst,
+        "server_rate": args.server_rate,
+        "server_burst": args.server_burst,
+        "rate_limit_policy": args.rate_limit_policy,
+        "max_streams": args.max_streams,
+        "max_connection_streams": args.max_connection_streams,
+        "max_watchers": args.max_watchers,
+        "join_rate": args.join_rate,
+        "join_burst": args.join_burst,
+        "max_queue_bytes": args.max_queue_bytes,
+        "drain_timeout": args.drain_timeout,
+        "drain_reconnect_spread": args.drain_reconnect_spread,
+        "keepalive_time": args.keepalive_time,
+        "keepalive_timeout": args.keepalive_timeout,
+        "cluster_node": args.node_id,
+        "cluster_nodes": parse_cluster_nodes(args.cluster) if args.cluster else None,
+    }
+
+
+def log_config_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    """从命令行参数中提取传给 log.configure 的参数"""
+    sample: Dict[str, int] = {}
+    for item in args.log_sample:
+        event, sep, every = item.partition("=")
+        if not sep or not every.isdigit() or int(every) < 1:
+            raise ValueError(f"无法解析日志采样: '{item}'，格式应为 事件名=正整数")
+        sample[event] = int(every)
+    return {
+        "level": args.log_level,
+        "fmt": args.log_format,
+        "sample": sample,
+        "rate_limit": args.log_rate_limit,
+    }
+
+
+def parse_cluster_nodes(spec: str) -> Dict[str, str]:
+    """解析 'a=host:port,b=host:port' 格式的集群节点列表"""
+    nodes: Dict[str, str] = {}
+    for item in spec.split(","):
+        node_id, sep, address = item.strip().partition("=")
+        if not sep or not node_id or not address:
+            raise ValueError(f"无法解析集群节点: '{item}'，格式应为 节点ID=地址:端口")
+        nodes[node_id] = address
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动聊天服务器")
+    add_server_arguments(parser)
     args = parser.parse_args()
     print("🚀 正在启动聊天服务器...")
-    serve(args.host, args.port)
+    serve(
+        args.host,
+        args.port,
+        args.mode,
+        args.workers,
+        log_config_from_args(args),
+        args.metrics_port,
+        **server_options_from_args(args),
+    )
 
 
 if __name__ == "__main__":
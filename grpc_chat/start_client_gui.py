@@ -6,7 +6,7 @@
 
 import argparse
 
-from grpc_chat.client import main
+from grpc_chat.client import add_cache_arguments, main
 
 if __name__ == "__main__":
     try:
@@ -18,6 +18,7 @@ if __name__ == "__main__":
         parser.add_argument(
             "--port", type=int, default=50051, help="服务器端口 (默认: 50051)"
         )
+        add_cache_arguments(parser)
         # 解析命令行参数
         args = parser.parse_args()
         # 启动客户端
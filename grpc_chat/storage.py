@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+持久化消息日志
+
+每个房间一个目录，目录下是按起始序号命名的追加写段文件。每条记录为
+定长头部（负载长度、序号、CRC32）加上预编码的 ServerMessage 字节，
+与广播时发送给客户端的内容完全相同，写入时无需重新编码。
+
+写入由后台线程完成：广播路径只把记录放入有界队列，写线程一次取出所有
+待写记录，按房间合并为一次 write 调用（组提交），再按 fsync 策略落盘。
+磁盘跟不上时队列写满，广播路径最多等待 append_timeout 秒，仍无空位则
+丢弃该记录（只影响持久化，内存中的历史和实时广播照常）。
+读取通过内存映射段文件完成，并借助稀疏的 序号→偏移 索引定位起点。
+
+启动时校验所有段文件中每条记录的 CRC：最后一段从第一条损坏的记录处
+截断，之前已封存的段不修改文件，只读取损坏处之前的记录。
+"""
+
+import mmap
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from grpc_chat import log
+
+# fsync 策略
+FSYNC_ALWAYS = "always"  # 每次组提交后 fsync
+FSYNC_INTERVAL = "interval"  # 最多每隔 fsync_interval 秒 fsync 一次
+FSYNC_NEVER = "never"  # 交给操作系统决定何时落盘
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+DEFAULT_FSYNC_INTERVAL = 1.0
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+# 每写入这么多字节记录一个稀疏索引项
+DEFAULT_INDEX_INTERVAL = 4096
+# 写线程一次组提交最多处理的记录数
+MAX_GROUP_COMMIT = 4096
+# 写入队列最多积压的记录数，以及队列满时广播路径最多等待的秒数
+DEFAULT_MAX_PENDING = 65536
+DEFAULT_APPEND_TIMEOUT = 1.0
+
+# 记录头部：负载长度、序号、负载的 CRC32
+_HEADER = struct.Struct("!IQI")
+_SEGMENT_SUFFIX = ".log"
+
+
+class Segment:
+    """单个段文件"""
+
+    def __init__(self, path: str, base_sequence: int):
+        self.path = path
+        self.base_sequence = base_sequence
+        self.size = 0
+        self.last_sequence = base_sequence - 1
+        # 稀疏索引 [(序号, 偏移)]
+        self.index: List[Tuple[int, int]] = []
+        self._indexed_at = -DEFAULT_INDEX_INTERVAL
+        self._mmap: Optional[mmap.mmap] = None
+        self._mapped_size = 0
+
+    def note_record(self, sequence: int, offset: int, index_interval: int):
+        """登记一条已写入的记录，按间隔补充稀疏索引"""
+        if offset - self._indexed_at >= index_interval:
+            self.index.append((sequence, offset))
+            self._indexed_at = offset
+        self.last_sequence = sequence
+
+    def offset_for(self, sequence: int) -> int:
+        """序号不大于 sequence 的最近索引项的偏移"""
+        pos = bisect_right(self.index, (sequence, float("inf"))) - 1
+        return self.index[pos][1] if pos >= 0 else 0
+
+    def view(self, size: int) -> Optional[mmap.mmap]:
+        """返回覆盖前 size 字节的只读内存映射，映射随文件增长按需重建"""
+        if size == 0:
+            return None
+        if self._mmap is None or self._mapped_size < size:
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return self._mmap
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class RoomLog:
+    """单个房间的段文件集合"""
+
+    def __init__(self, directory: str, segment_bytes: int, index_interval: int):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.segments: List[Segment] = []
+        self._file = None
+        # 保护段列表和已写入位置，读写线程共用
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self.dirty = False
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    @property
+    def last_sequence(self) -> int:
+        return self.segments[-1].last_sequence if self.segments else 0
+
+    def _recover(self):
+        """扫描已有段文件，重建索引并截掉末尾不完整或损坏的记录"""
+        names = sorted(
+            name
+            for name in os.listdir(self.directory)
+            if name.endswith(_SEGMENT_SUFFIX)
+        )
+        for i, name in enumerate(names):
+            base = int(name[: -len(_SEGMENT_SUFFIX)])
+            segment = Segment(os.path.join(self.directory, name), base)
+            segment.size = self._scan(segment)
+            if segment.size < os.path.getsize(segment.path):
+                if i == len(names) - 1:
+                    with open(segment.path, "r+b") as f:
+                        f.truncate(segment.size)
+                    log.warning(
+                        "storage.truncate",
+                        "段文件 {path} 末尾存在不完整记录，已截断",
+                        path=segment.path,
+                    )
+                else:
+                    # 封存的段中间损坏：之后的段仍然完好，保留文件以便排查
+                    log.error(
+                        "storage.corrupt",
+                        "段文件 {path} 在偏移 {offset} 处损坏，之后的记录不可读",
+                        path=segment.path,
+                        offset=segment.size,
+                    )
+            self.segments.append(segment)
+
+    def _scan(self, segment: Segment) -> int:
+        """逐条读取并校验记录，返回有效数据的长度"""
+        file_size = os.path.getsize(segment.path)
+        if file_size == 0:
+            return 0
+        with open(segment.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), file_size, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset + _HEADER.size <= file_size:
+                length, sequence, crc = _HEADER.unpack_from(data, offset)
+                end = offset + _HEADER.size + length
+                if end > file_size:
+                    break
+                if zlib.crc32(data[offset + _HEADER.size : end]) != crc:
+                    break
+                segment.note_record(sequence, offset, self.index_interval)
+                offset = end
+            return offset
+        finally:
+            data.close()
+
+    def _active_segment(self, next_sequence: int, record_size: int) -> Segment:
+        """返回当前可写的段，必要时滚动到新段"""
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or (
+            segment.size > 0 and segment.size + record_size > self.segment_bytes
+        ):
+            if self._file is not None:
+                # 封存的段不再写入，滚动时总是落盘
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+            name = f"{next_sequence:020d}{_SEGMENT_SUFFIX}"
+            segment = Segment(os.path.join(self.directory, name), next_sequence)
+            self.segments.append(segment)
+        if self._file is None:
+            self._file = open(segment.path, "ab", buffering=0)
+        return segment
+
+    def write(self, records: List[Tuple[int, bytes]]):
+        """追加一组记录（只由写线程调用），每个段只调用一次 write"""
+        segment = None
+        chunks: List[bytes] = []
+        entries: List[Tuple[int, int]] = []
+        chunk_size = 0
+        for sequence, payload in records:
+            record_size = _HEADER.size + len(payload)
+            if segment is None or (
+                segment.size + chunk_size > 0
+                and segment.size + chunk_size + record_size > self.segment_bytes
+            ):
+                if entries:
+                    self._flush(segment, chunks, entries)
+                    chunks, entries, chunk_size = [], [], 0
+                segment = self._active_segment(sequence, record_size)
+            chunks.append(_HEADER.pack(len(payload), sequence, zlib.crc32(payload)))
+            chunks.append(payload)
+            entries.append((sequence, record_size))
+            chunk_size += record_size
+        if entries:
+            self._flush(segment, chunks, entries)
+
+    def _flush(
+        self, segment: Segment, chunks: List[bytes], entries: List[Tuple[int, int]]
+    ):
+        """一次 write 调用写入整组记录，再登记索引并唤醒等待的读取方"""
+        self._file.write(b"".join(chunks))
+        with self._written:
+            offset = segment.size
+            for sequence, record_size in entries:
+                segment.note_record(sequence, offset, self.index_interval)
+                offset += record_size
+            segment.size = offset
+            self.dirty = True
+            self._written.notify_all()
+
+    def fsync(self):
+        if self._file is not None and self.dirty:
+            os.fsync(self._file.fileno())
+        self.dirty = False
+
+    def wait_for(self, sequence: int, timeout: float) -> bool:
+        """等待写线程写到 sequence 为止"""
+        with self._written:
+            return self._written.wait_for(
+                lambda: self.last_sequence >= sequence, timeout
+            )
+
+    def read(self, first: int, last: int) -> List[bytes]:
+        """读取序号在 [first, last] 之间的记录负载"""
+        result: List[bytes] = []
+        with self._lock:
+            bases = [segment.base_sequence for segment in self.segments]
+            pos = max(0, bisect_right(bases, first) - 1)
+            for segment in self.segments[pos:]:
+                if segment.base_sequence > last:
+                    break
+                data = segment.view(segment.size)
+                if data is None:
+                    continue
+                offset = segment.offset_for(first)
+                while offset + _HEADER.size <= segment.size:
+                    length, sequence, _ = _HEADER.unpack_from(data, offset)
+                    start = offset + _HEADER.size
+                    offset = start + length
+                    if sequence > last:
+                        return result
+                    if sequence >= first:
+                        result.append(data[start:offset])
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self.fsync()
+                self._file.close()
+                self._file = None
+            for segment in self.segments:
+                segment.close()
+
+    def delete(self):
+        """关闭并删除房间目录，之后的读取返回空"""
+        self.close()
+        with self._lock:
+            self.segments = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class MessageLog:
+    """所有房间的持久化消息日志"""
+
+    def __init__(
+        self,
+        data_dir: str,
+        fsync_policy: str = FSYNC_INTERVAL,
+        fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+        segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+        index_interval: int = DEFAULT_INDEX_INTERVAL,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        append_timeout: float = DEFAULT_APPEND_TIMEOUT,
+    ):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(
+                f"未知的 fsync 策略: {fsync_policy}，可选: {', '.join(FSYNC_POLICIES)}"
+            )
+        self.data_dir = data_dir
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self._rooms: Dict[str, RoomLog] = {}
+        self._rooms_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(max_pending)
+        self.append_timeout = append_timeout
+        # 因写入队列已满而丢弃的记录数
+        self.dropped = 0
+        self._last_fsync = time.monotonic()
+        os.makedirs(data_dir, exist_ok=True)
+        for name in os.listdir(data_dir):
+            if os.path.isdir(os.path.join(data_dir, name)):
+                self._room(unquote(name))
+        self._writer = threading.Thread(
+            target=self._run, name="message-log-writer", daemon=True
+        )
+        self._writer.start()
+
+    def _room(self, room_id: str) -> RoomLog:
+        room_log = self._rooms.get(room_id)
+        if room_log is None:
+            with self._rooms_lock:
+                room_log = self._rooms.get(room_id)
+                if room_log is None:
+                    directory = os.path.join(self.data_dir, quote(room_id, safe=""))
+                    room_log = RoomLog(
+                        directory, self.segment_bytes, self.index_interval
+                    )
+                    self._rooms[room_id] = room_log
+        return room_log
+
+    def last_sequence(self, room_id: str) -> int:
+        """房间已持久化的最后一条消息的序号，没有记录时为 0"""
+        room_log = self._rooms.get(room_id)
+        return room_log.last_sequence if room_log else 0
+
+    def append(self, room_id: str, sequence: int, payload: bytes):
+        """追加一条消息，只入队不等待写盘，可在广播路径上调用
+
+        队列已满时最多等待 append_timeout 秒，仍无空位则丢弃该记录。
+        """
+        try:
+            self._queue.put((room_id, sequence, payload), timeout=self.append_timeout)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log.error(
+                    "storage.overflow",
+                    "消息日志写入队列已满，共丢弃 {dropped} 条记录",
+                    dropped=self.dropped,
+                )
+
+    def delete_room(self, room_id: str):
+        """删除房间的日志，等待写线程处理完该房间此前的所有记录后返回
+
+        之后同名的新房间从空日志开始，不会恢复旧房间的历史。
+        """
+        done = threading.Event()
+        self._queue.put((room_id, None, done))
+        done.wait()
+
+    def read(
+        self, room_id: str, first: int, last: int, timeout: float = 1.0
+    ) -> List[bytes]:
+        """读取房间中序号在 [first, last] 之间的消息
+
+        若这些消息还在写入队列中，最多等待 timeout 秒。
+        """
+        room_log = self._rooms.get(room_id)
+        if room_log is None or first > last:
+            return []
+        room_log.wait_for(last, timeout)
+        return room_log.read(first, last)
+
+    def read_last(self, room_id: str, count: int) -> List[bytes]:
+        """读取房间最近的 count 条消息"""
+        last = self.last_sequence(room_id)
+        return self.read(room_id, max(1, last - count + 1), last)
+
+    def _run(self):
+        """写线程：组提交 + 按策略 fsync"""
+        stopping = False
+        while not stopping:
+            try:
+                timeout = (
+                    self.fsync_interval if self.fsync_policy == FSYNC_INTERVAL else None
+                )
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < MAX_GROUP_COMMIT:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+
+            by_room: Dict[str, List[Tuple[int, bytes]]] = {}
+            for room_id, sequence, payload in batch:
+                if sequence is None:
+                    # 删除房间：丢弃之前尚未写入的记录，之后的记录属于新房间
+                    by_room.pop(room_id, None)
+                    self._delete_room(room_id)
+                    payload.set()
+                    continue
+                by_room.setdefault(room_id, []).append((sequence, payload))
+            for room_id, records in by_room.items():
+                try:
+                    self._room(room_id).write(records)
+                except OSError as e:
+                    log.error(
+                        "storage.write_error",
+                        "写入房间 {room} 的消息日志失败: {error}",
+                        room=room_id,
+                        error=e,
+                    )
+
+            self._maybe_fsync(force=stopping)
+
+    def _delete_room(self, room_id: str):
+        with self._rooms_lock:
+            room_log = self._rooms.pop(room_id, None)
+        if room_log is None:
+            return
+        try:
+            room_log.delete()
+        except OSError as e:
+            log.error(
+                "storage.delete_error",
+                "删除房间 {room} 的消息日志失败: {error}",
+                room=room_id,
+                error=e,
+            )
+
+    def _maybe_fsync(self, force: bool = False):
+        now = time.monotonic()
+        if not force:
+            if self.fsync_policy == FSYNC_NEVER:
+                return
+            if (
+                self.fsync_policy == FSYNC_INTERVAL
+                and now - self._last_fsync < self.fsync_interval
+            ):
+                return
+        for room_log in list(self._rooms.values()):
+            try:
+                room_log.fsync()
+            except OSError as e:
+                log.error("storage.fsync_error", "fsync 消息日志失败: {error}", error=e)
+        self._last_fsync = now
+
+    def close(self):
+        """写完队列中的剩余消息并落盘"""
+        self._queue.put(None)
+        self._writer.join()
+        for room_log in list(self._rooms.values()):
+            room_log.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+大厅订阅：房间列表的实时推送
+
+房间人数变化时只把房间ID记入待推送集合，合并窗口结束后统一读取这些
+房间的最新状态，每种前缀过滤只编码一次，再发给所有订阅者。窗口内同
+一房间的多次变化只推送一次，加入、离开的路径上也不产生任何编码开销。
+"""
+
+import threading
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+# 这里IDE可能会因为对chat_pb2的import报错，忽略即可
+import chat_pb2  # type: ignore
+from grpc_chat.rooms import Room, RoomRegistry
+from grpc_chat.wire import encode_server_message
+
+# 合并房间变化的默认窗口（秒）
+DEFAULT_WATCH_INTERVAL = 0.2
+
+
+def room_info(room: Room) -> "chat_pb2.RoomInfo":
+    """房间的对外描述"""
+    return chat_pb2.RoomInfo(
+        room_id=room.room_id,
+        participant_count=room.participant_count,
+        max_capacity=room.max_capacity,
+    )
+
+
+class RoomWatchHub:
+    """大厅订阅者的集合
+
+    订阅者只需要提供 send_message(bytes)，与聊天流共用 StreamHandler。
+    定时由 call_later(delay, callback) 提供，线程模式和 asyncio 模式
+    分别使用定时器线程和事件循环，保证回调运行在订阅者要求的线程上。
+    """
+
+    def __init__(
+        self,
+        rooms: RoomRegistry,
+        call_later: Callable[[float, Callable[[], None]], Any],
+        interval: float = DEFAULT_WATCH_INTERVAL,
+    ):
+        self.rooms = rooms
+        self.interval = interval
+        self._call_later = call_later
+        # 订阅者快照 [(前缀, 订阅者)]，只在 _lock 内整体替换
+        self._watchers: Tuple[Tuple[str, Any], ...] = ()
+        # 保证快照先于任何变化到达，以及每个订阅者收到的变化有序
+        self._lock = threading.Lock()
+        # 待推送的房间ID，只保护这个集合，加入、离开时持有时间极短
+        self._dirty: Set[str] = set()
+        self._flush_scheduled = False
+        self._dirty_lock = threading.Lock()
+
+    @property
+    def watcher_count(self) -> int:
+        return len(self._watchers)
+
+    def subscribe(self, watcher: Any, name_prefix: str = "") -> int:
+        """订阅房间变化，先发送一次完整快照
+
+        Returns:
+            快照中的房间数
+        """
+        with self._lock:
+            rooms = self.rooms.with_prefix(name_prefix)
+            update = chat_pb2.RoomsUpdate(
+                snapshot=True, rooms=[room_info(room) for room in rooms]
+            )
+            watcher.send_message(encode_server_message(update))
+            self._watchers += ((name_prefix, watcher),)
+        return len(rooms)
+
+    def unsubscribe(self, watcher: Any):
+        """取消订阅"""
+        with self._lock:
+            self._watchers = tuple(
+                entry for entry in self._watchers if entry[1] is not watcher
+            )
+
+    def mark(self, room_id: str):
+        """记录房间的新建、删除或人数变化，在合并窗口结束后推送"""
+        if not self._watchers:
+            # 没有订阅者时无需记录，之后的订阅者会拿到完整快照
+            return
+        with self._dirty_lock:
+            self._dirty.add(room_id)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._call_later(self.interval, self.flush)
+
+    def flush(self):
+        """推送合并窗口内发生变化的房间"""
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+            self._flush_scheduled = False
+        if not dirty:
+            return
+        changed = sorted(dirty)
+        with self._lock:
+            frames: Dict[str, bytes] = {}
+            for name_prefix, watcher in self._watchers:
+                frame = frames.get(name_prefix)
+                if frame is None:
+                    frame = frames[name_prefix] = self._encode_delta(
+                        changed, name_prefix
+                    )
+                if frame:
+                    watcher.send_message(frame)
+
+    def _encode_delta(self, changed: List[str], name_prefix: str) -> bytes:
+        """编码符合前缀的房间变化，没有变化时返回空字节"""
+        update = chat_pb2.RoomsUpdate()
+        for room_id in changed:
+            if not room_id.startswith(name_prefix):
+                continue
+            room = self.rooms.get(room_id)
+            if room is None:
+                update.removed_room_ids.append(room_id)
+            else:
+                update.rooms.append(room_info(room))
+        if not update.rooms and not update.removed_room_ids:
+            return b""
+        return encode_server_message(update)
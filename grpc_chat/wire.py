@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+gRPC 服务注册与消息编码
+
+Chat 流的响应序列化器允许直接发送预编码的 ServerMessage 字节：
+一次广播只编码一次，所有接收者共享同一个不可变的 bytes 对象，
+gRPC 在发送时不再逐个连接重复序列化。
+"""
+
+from typing import List, Union
+
+import grpc
+
+# 这里IDE可能会因为对chat_pb2的import报错，忽略即可
+import chat_pb2  # type: ignore
+
+SERVICE_NAME = "chat.ChatService"
+
+# protobuf 长度分隔字段的 wire type
+_WIRE_TYPE_LEN = 2
+
+
+def _field_tag(message_type, field_name: str) -> bytes:
+    number = message_type.DESCRIPTOR.fields_by_name[field_name].number
+    return encode_varint((number << 3) | _WIRE_TYPE_LEN)
+
+
+def encode_varint(value: int) -> bytes:
+    """按 protobuf varint 格式编码非负整数"""
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+_BATCH_TAG = _field_tag(chat_pb2.ServerMessage, "batch")
+_EVENTS_TAG = _field_tag(chat_pb2.ServerMessageBatch, "events")
+
+
+def encode_server_message(message) -> bytes:
+    """将 ServerMessage 编码为字节，用于一次编码、多次发送"""
+    return message.SerializeToString()
+
+
+def encode_chat_message(
+    room_id: str, sender: str, text: str, timestamp: int, sequence: int
+) -> bytes:
+    """编码一条房间聊天消息"""
+    broadcast = chat_pb2.BroadcastMessage(
+        sender_name=sender, text=text, timestamp=timestamp, sequence=sequence
+    )
+    return encode_server_message(
+        chat_pb2.ServerMessage(broadcast=broadcast, room_id=room_id)
+    )
+
+
+def encode_user_joined(room_id: str, user_name: str, current_count: int) -> bytes:
+    """编码用户加入通知"""
+    notification = chat_pb2.UserJoinedNotification(
+        user_name=user_name, current_count=current_count
+    )
+    return encode_server_message(
+        chat_pb2.ServerMessage(user_joined=notification, room_id=room_id)
+    )
+
+
+def encode_user_left(room_id: str, user_name: str, current_count: int) -> bytes:
+    """编码用户离开通知"""
+    notification = chat_pb2.UserLeftNotification(
+        user_name=user_name, current_count=current_count
+    )
+    return encode_server_message(
+        chat_pb2.ServerMessage(user_left=notification, room_id=room_id)
+    )
+
+
+def encode_batch(payloads: List[bytes]) -> bytes:
+    """将多个预编码的 ServerMessage 拼接为一个 batch 帧
+
+    直接在字节层面拼接，不需要解码再重新编码。只有一个事件时原样返回，
+    不额外包一层。
+    """
+    if len(payloads) == 1:
+        return payloads[0]
+    body = b"".join(
+        _EVENTS_TAG + encode_varint(len(payload)) + payload for payload in payloads
+    )
+    return _BATCH_TAG + encode_varint(len(body)) + body
+
+
+def serialize_server_message(message: Union[bytes, "chat_pb2.ServerMessage"]) -> bytes:
+    """流式响应的序列化器：已编码的字节直接透传"""
+    if isinstance(message, bytes):
+        return message
+    return message.SerializeToString()
+
+
+def add_chat_service_to_server(servicer, server):
+    """将聊天服务注册到服务器
+
+    与生成代码中的 add_ChatServiceServicer_to_server 等价，
+    区别在于 Chat 和 WatchRooms 流使用 serialize_server_message 作为响应序列化器。
+    同时适用于 grpc.server 和 grpc.aio.server。
+    """
+    rpc_method_handlers = {
+        "ListRooms": grpc.unary_unary_rpc_method_handler(
+            servicer.ListRooms,
+            request_deserializer=chat_pb2.ListRoomsRequest.FromString,
+            response_serializer=chat_pb2.ListRoomsResponse.SerializeToString,
+        ),
+        "Chat": grpc.stream_stream_rpc_method_handler(
+            servicer.Chat,
+            request_deserializer=chat_pb2.ClientMessage.FromString,
+            response_serializer=serialize_server_message,
+        ),
+        "WatchRooms": grpc.unary_stream_rpc_method_handler(
+            servicer.WatchRooms,
+            request_deserializer=chat_pb2.WatchRoomsRequest.FromString,
+            response_serializer=serialize_server_message,
+        ),
+        "CheckUsername": grpc.unary_unary_rpc_method_handler(
+            servicer.CheckUsername,
+            request_deserializer=chat_pb2.CheckUsernameRequest.FromString,
+            response_serializer=chat_pb2.CheckUsernameResponse.SerializeToString,
+        ),
+        "CreateRoom": grpc.unary_unary_rpc_method_handler(
+            servicer.CreateRoom,
+            request_deserializer=chat_pb2.CreateRoomRequest.FromString,
+            response_serializer=chat_pb2.CreateRoomResponse.SerializeToString,
+        ),
+        "DeleteRoom": grpc.unary_unary_rpc_method_handler(
+            servicer.DeleteRoom,
+            request_deserializer=chat_pb2.DeleteRoomRequest.FromString,
+            response_serializer=chat_pb2.DeleteRoomResponse.SerializeToString,
+        ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+        SERVICE_NAME, rpc_method_handlers
+    )
+    server.add_generic_rpc_handlers((generic_handler,))
+    # 较新版本的 grpcio 支持预注册方法，可省去每次调用的方法查找
+    if hasattr(server, "add_registered_method_handlers"):
+        server.add_registered_method_handlers(SERVICE_NAME, rpc_method_handlers)
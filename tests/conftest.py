@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""测试共用的夹具：在本进程中启动线程模式的聊天服务器"""
+
+from concurrent import futures
+
+import grpc
+import pytest
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+from grpc_chat.server import ChatServer
+from grpc_chat.wire import add_chat_service_to_server
+
+
+@pytest.fixture
+def start_server():
+    """返回 start(**server_options) -> (ChatServer, 连接地址)，测试结束时关闭"""
+    started = []
+
+    def start(**server_options):
+        service = ChatServer(**server_options)
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=32))
+        add_chat_service_to_server(service, server)
+        port = server.add_insecure_port("localhost:0")
+        server.start()
+        started.append((server, service))
+        return service, f"localhost:{port}"
+
+    yield start
+    for server, service in started:
+        server.stop(0).wait()
+        service.close()
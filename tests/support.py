@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""测试共用的辅助类"""
+
+import queue
+import threading
+from typing import Optional
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+import chat_pb2  # type: ignore
+from grpc_chat.sdk import ChatHandlers
+
+TIMEOUT = 5.0
+
+
+class Inbox(ChatHandlers):
+    """把同步会话的事件放进队列，按类型等待"""
+
+    def __init__(self):
+        self.events: "queue.Queue" = queue.Queue()
+        self.closed = threading.Event()
+        self.error: Optional[Exception] = None
+
+    def on_room_event(self, room_id, event):
+        self.events.put((room_id, event))
+
+    def on_closed(self, error):
+        self.error = error
+        self.closed.set()
+
+    def next(self, kind, timeout: float = TIMEOUT):
+        """等待下一个 kind 类型的事件，跳过其他事件"""
+        while True:
+            _, event = self.events.get(timeout=timeout)
+            if isinstance(event, kind):
+                return event
+
+    def next_message(self, timeout: float = TIMEOUT):
+        return self.next(chat_pb2.BroadcastMessage, timeout)
+
+    def drain(self) -> list:
+        """取出已到达的全部事件"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait()[1])
+            except queue.Empty:
+                return events
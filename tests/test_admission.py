@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""聊天流的准入控制与优雅关闭"""
+
+import grpc
+import pytest
+
+import chat_pb2  # type: ignore
+from grpc_chat.admission import (
+    REJECT_JOIN_RATE,
+    REJECT_QUEUE_BYTES,
+    REJECT_STREAMS,
+    RETRY_PUSHBACK_KEY,
+    AdmissionControl,
+)
+from grpc_chat.sdk import ChatClient
+from support import TIMEOUT, Inbox
+
+
+def test_stream_limit_is_released():
+    admission = AdmissionControl(max_streams=2)
+    assert admission.admit(lambda: 0) == ("", 0.0)
+    assert admission.admit(lambda: 0) == ("", 0.0)
+    assert admission.admit(lambda: 0)[0] == REJECT_STREAMS
+
+    admission.release()
+    assert admission.admit(lambda: 0) == ("", 0.0)
+    assert admission.streams == 2
+
+
+def test_join_rate_suggests_wait():
+    now = [0.0]
+    admission = AdmissionControl(join_rate=2, join_burst=1, clock=lambda: now[0])
+    assert admission.admit(lambda: 0) == ("", 0.0)
+    reason, retry_after = admission.admit(lambda: 0)
+    assert (reason, retry_after) == (REJECT_JOIN_RATE, pytest.approx(0.5))
+
+    now[0] = 0.5
+    assert admission.admit(lambda: 0) == ("", 0.0)
+
+
+def test_queue_bytes_and_watchers():
+    admission = AdmissionControl(max_queue_bytes=100, max_watchers=1)
+    assert admission.admit(lambda: 101)[0] == REJECT_QUEUE_BYTES
+    # 被拒绝的流不计数
+    assert admission.streams == 0
+    assert admission.admit_watcher()
+    assert not admission.admit_watcher()
+    admission.release_watcher()
+    assert admission.admit_watcher()
+    with pytest.raises(ValueError):
+        AdmissionControl(max_streams=-1)
+
+
+def test_rejected_stream_carries_retry_pushback(start_server):
+    _, target = start_server(max_streams=1)
+    with ChatClient(target) as client:
+        client.join("alice", "general", Inbox(), timeout=TIMEOUT)
+        with pytest.raises(grpc.RpcError) as raised:
+            client.join("bob", "general", Inbox(), timeout=TIMEOUT)
+
+        assert raised.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+        metadata = dict(raised.value.trailing_metadata())
+        assert metadata[RETRY_PUSHBACK_KEY] == "1000"
+
+
+def test_drain_notifies_streams_and_rejects_new_ones(start_server):
+    server, target = start_server(drain_reconnect_spread=2.0)
+    with ChatClient(target) as client:
+        inbox = Inbox()
+        session = client.join("alice", "general", inbox, timeout=TIMEOUT)
+        server.drain()
+
+        draining = inbox.next(chat_pb2.ServerDraining)
+        assert 0 <= draining.reconnect_after_ms <= 2000
+        assert inbox.closed.wait(TIMEOUT)
+        assert inbox.error.code() == grpc.StatusCode.UNAVAILABLE
+        assert session.reconnect_after == draining.reconnect_after_ms / 1000
+
+        with pytest.raises(grpc.RpcError) as raised:
+            client.join("bob", "general", Inbox(), timeout=TIMEOUT)
+        assert raised.value.code() == grpc.StatusCode.UNAVAILABLE
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""发送队列中的消息合并为 ServerMessageBatch 帧"""
+
+import queue
+import threading
+import time
+
+import grpc
+
+import chat_pb2  # type: ignore
+import chat_pb2_grpc  # type: ignore
+from grpc_chat.sdk import ChatClient, iter_events
+from grpc_chat.server import StreamHandler
+from grpc_chat.wire import encode_batch, encode_chat_message
+from support import TIMEOUT, Inbox
+
+
+def _payload(text, sequence):
+    return encode_chat_message("general", "alice", text, 0, sequence)
+
+
+def test_encode_batch_round_trip():
+    payloads = [_payload(f"m{i}", i) for i in range(1, 4)]
+    frame = chat_pb2.ServerMessage.FromString(encode_batch(payloads))
+
+    assert [event.broadcast.text for event in frame.batch.events] == [
+        "m1",
+        "m2",
+        "m3",
+    ]
+    # 只有一个事件时不包一层
+    assert encode_batch(payloads[:1]) == payloads[0]
+
+
+def test_batches_split_at_max_bytes():
+    handler = StreamHandler("bob", "general")
+    payloads = [_payload(f"m{i}", i) for i in range(1, 6)]
+    for payload in payloads:
+        handler.send_message(payload)
+    handler.stop()
+
+    size = len(payloads[0])
+    batches = list(handler.get_batches(max_delay=0.0, max_bytes=size * 3))
+    assert batches == [payloads[:3], payloads[3:]]
+
+
+def test_batch_waits_for_late_messages():
+    handler = StreamHandler("bob", "general")
+    handler.send_message(b"first")
+    timer = threading.Timer(0.05, handler.send_message, (b"second",))
+    timer.start()
+
+    batches = handler.get_batches(max_delay=1.0, max_bytes=len(b"firstsecond"))
+    assert next(batches) == [b"first", b"second"]
+    timer.join()
+
+
+def test_stream_receives_batch_frames(start_server):
+    _, target = start_server(batch_delay=0.2)
+    with grpc.insecure_channel(target) as channel, ChatClient(target) as client:
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        requests: "queue.Queue" = queue.Queue()
+        join = chat_pb2.JoinRequest(
+            user_name="bob", room_id="general", accept_batches=True
+        )
+        requests.put(chat_pb2.ClientMessage(join_request=join))
+        responses = stub.Chat(iter(requests.get, None))
+        assert next(responses).join_response.success
+
+        alice = client.join("alice", "general", Inbox(), timeout=TIMEOUT)
+        for i in range(3):
+            alice.send(f"m{i}")
+
+        texts, frames = [], []
+        deadline = time.monotonic() + TIMEOUT
+        while len(texts) < 3 and time.monotonic() < deadline:
+            frame = next(responses)
+            frames.append(frame)
+            texts.extend(
+                event.text
+                for event in iter_events(frame)
+                if isinstance(event, chat_pb2.BroadcastMessage)
+            )
+        assert texts == ["m0", "m1", "m2"]
+        assert any(frame.HasField("batch") for frame in frames)
+        alice.leave()
+        requests.put(None)
+        responses.cancel()
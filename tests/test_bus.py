@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""房间总线：权威方的状态与事件顺序，以及多进程模式下跨工作进程的聊天"""
+
+import os
+import shutil
+import socket
+import tempfile
+
+import pytest
+
+import chat_pb2  # type: ignore
+from grpc_chat import bus
+from grpc_chat.bus import (
+    BUS_CLAIM_USER,
+    BUS_DELIVER,
+    BUS_JOIN,
+    BUS_LEAVE,
+    BUS_PUBLISH,
+    BUS_REPLY,
+    BUS_ROOM_STATE,
+    REASON_FULL,
+    BusConnection,
+    BusHub,
+    RoomAuthority,
+    decode_frame,
+    decode_frames,
+    encode_frame,
+)
+from grpc_chat.sdk import ChatClient
+from support import TIMEOUT, Inbox
+
+
+class _Conn(BusConnection):
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(decode_frame(frame))
+
+    def take(self, kind):
+        """取出已收到的 kind 类型的帧"""
+        taken = [fields for k, fields in self.frames if k == kind]
+        self.frames = [(k, fields) for k, fields in self.frames if k != kind]
+        return taken
+
+
+def _join(authority, conn, user_name, room_id="general", replay_since=-1):
+    authority.handle(conn, BUS_JOIN, ["1", room_id, user_name, "0", str(replay_since)])
+    return conn.take(BUS_REPLY)[-1]
+
+
+def test_frame_round_trip():
+    frames = encode_frame(BUS_PUBLISH, "房间", "alice", "你好", 7) + encode_frame(
+        BUS_LEAVE, "general", "bob"
+    )
+    assert list(decode_frames(frames)) == [
+        (BUS_PUBLISH, ["房间".encode(), b"alice", "你好".encode(), b"7"]),
+        (BUS_LEAVE, [b"general", b"bob"]),
+    ]
+
+
+def test_messages_go_only_to_connections_with_members():
+    authority = RoomAuthority({"general": 10, "tech": 10})
+    a, b = _Conn(), _Conn()
+    authority.connect(a)
+    authority.connect(b)
+    # 连接时收到所有房间的状态
+    assert len(a.take(BUS_ROOM_STATE)) == 2
+
+    assert _join(authority, a, "alice")[:3] == [b"1", b"1", b"1"]
+    # 人数变化发给所有连接方
+    assert b.take(BUS_ROOM_STATE)[-1] == [b"general", b"10", b"1", b"0"]
+
+    authority.handle(a, BUS_PUBLISH, ["general", "alice", "hi", "0"])
+    room_id, sequence, payload, _ = a.take(BUS_DELIVER)[-1]
+    assert (room_id, sequence) == (b"general", b"1")
+    assert chat_pb2.ServerMessage.FromString(payload).broadcast.text == "hi"
+    assert b.take(BUS_DELIVER) == []
+
+
+def test_join_replays_history_and_rejects_full_room():
+    authority = RoomAuthority({"general": 2}, history_size=2)
+    conn = _Conn()
+    authority.connect(conn)
+    _join(authority, conn, "alice")
+    for text in ("one", "two", "three"):
+        authority.handle(conn, BUS_PUBLISH, ["general", "alice", text, "0"])
+
+    reply = _join(authority, conn, "bob", replay_since=1)
+    replay = [chat_pb2.ServerMessage.FromString(p).broadcast.text for p in reply[3:]]
+    assert replay == ["two", "three"]
+    assert _join(authority, conn, "carol")[:3] == [b"1", b"0", REASON_FULL.encode()]
+
+
+def test_disconnect_releases_users_and_members():
+    authority = RoomAuthority({"general": 10})
+    a, b = _Conn(), _Conn()
+    authority.connect(a)
+    authority.connect(b)
+    authority.handle(a, BUS_CLAIM_USER, ["1", "alice"])
+    assert a.take(BUS_REPLY)[-1][:2] == [b"1", b"1"]
+    _join(authority, a, "alice")
+    _join(authority, b, "bob")
+    b.frames.clear()
+
+    authority.disconnect(a)
+    left = chat_pb2.ServerMessage.FromString(b.take(BUS_DELIVER)[-1][2])
+    assert left.user_left.user_name == "alice"
+    # 用户名随连接方一起释放
+    authority.handle(b, BUS_CLAIM_USER, ["2", "alice"])
+    assert b.take(BUS_REPLY)[-1][:2] == [b"2", b"1"]
+
+
+def test_worker_that_stops_reading_is_disconnected(monkeypatch):
+    monkeypatch.setattr(bus, "SEND_QUEUE_SIZE", 2)
+    hub_side, worker_side = socket.socketpair()
+    conn = bus._SocketConnection(hub_side)
+    frame = encode_frame(BUS_DELIVER, "general", 1, b"x" * (1 << 20), "")
+
+    # 发送线程阻塞在 sendall 时 send 仍立即返回，队列满后关闭套接字
+    for _ in range(5):
+        conn.send(frame)
+    assert conn.writer.overflowed
+    worker_side.settimeout(TIMEOUT)
+    while worker_side.recv(1 << 20):
+        pass
+    worker_side.close()
+    hub_side.close()
+
+
+@pytest.fixture
+def bus_path():
+    # Unix 域套接字路径长度有限，不使用 tmp_path
+    directory = tempfile.mkdtemp(prefix="chat-bus-")
+    path = os.path.join(directory, "bus.sock")
+    hub = BusHub(path, {"general": 10})
+    hub.start()
+    yield path
+    hub.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_workers_share_rooms_and_user_names(start_server, bus_path):
+    _, target_a = start_server(bus_path=bus_path)
+    _, target_b = start_server(bus_path=bus_path)
+    with ChatClient(target_a) as client_a, ChatClient(target_b) as client_b:
+        assert client_a.check_username("alice").available
+        assert not client_b.check_username("alice").available
+
+        alice_inbox, bob_inbox = Inbox(), Inbox()
+        alice = client_a.join("alice", "general", alice_inbox, timeout=TIMEOUT)
+        client_b.join("bob", "general", bob_inbox, timeout=TIMEOUT)
+        assert alice_inbox.next(chat_pb2.UserJoinedNotification).user_name == "bob"
+
+        alice.send("across workers")
+        message = bob_inbox.next_message()
+        assert (message.sender_name, message.sequence) == ("alice", 1)
+
+        alice.leave()
+        assert bob_inbox.next(chat_pb2.UserLeftNotification).user_name == "alice"
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""客户端本地消息缓存：按服务器和房间读写、清除与按大小淘汰"""
+
+import queue
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+import chat_pb2  # type: ignore
+from grpc_chat.cache import MessageCache
+from grpc_chat.client import GuiChatHandlers
+
+SERVER = "localhost:50051"
+
+
+def _message(sequence, text=None):
+    return chat_pb2.BroadcastMessage(
+        sender_name="alice", text=text or f"m{sequence}", sequence=sequence
+    )
+
+
+def _reopen(cache, **options):
+    """close 会写完队列中的消息，重新打开后可以读到"""
+    cache.close()
+    return MessageCache(cache.path, **options)
+
+
+def test_recent_is_per_server_and_room(tmp_path):
+    cache = MessageCache(str(tmp_path / "cache" / "messages.sqlite3"))
+    for sequence in (3, 1, 2, 4):
+        cache.add(SERVER, "general", _message(sequence))
+    cache.add(SERVER, "general", _message(2, "duplicate"))
+    cache.add(SERVER, "general", _message(0, "notice"))
+    cache.add(SERVER, "tech", _message(1, "tech"))
+    cache.add("other:50051", "general", _message(9))
+    cache = _reopen(cache)
+
+    recent = cache.recent(SERVER, "general", 3)
+    # 按序号升序；重复序号保留先写入的；序号为 0 的消息不缓存
+    assert [(m.sequence, m.text) for m in recent] == [(2, "m2"), (3, "m3"), (4, "m4")]
+    assert [m.text for m in cache.recent(SERVER, "tech", 10)] == ["tech"]
+    assert cache.recent(SERVER, "random", 10) == []
+    cache.close()
+
+
+def test_forget_room(tmp_path):
+    cache = MessageCache(str(tmp_path / "messages.sqlite3"))
+    cache.add(SERVER, "general", _message(1))
+    cache.add(SERVER, "tech", _message(1))
+    cache.forget_room(SERVER, "general")
+    cache = _reopen(cache)
+
+    assert cache.recent(SERVER, "general", 10) == []
+    assert len(cache.recent(SERVER, "tech", 10)) == 1
+    cache.close()
+
+
+def test_oldest_messages_are_evicted(tmp_path):
+    size = len(_message(1, "x" * 100).SerializeToString())
+    cache = MessageCache(str(tmp_path / "messages.sqlite3"), max_bytes=size * 10)
+    for sequence in range(1, 21):
+        cache.add(SERVER, "general", _message(sequence, "x" * 100))
+    cache = _reopen(cache, max_bytes=size * 10)
+
+    # 超过上限后淘汰到上限的 90% 以下，保留最新的
+    sequences = [m.sequence for m in cache.recent(SERVER, "general", 100)]
+    assert 0 < len(sequences) <= 9
+    assert sequences[-1] == 20
+    assert sequences == list(range(21 - len(sequences), 21))
+    cache.close()
+
+
+def test_gap_after_cached_messages_is_reported():
+    gui_queue: "queue.Queue" = queue.Queue()
+    handlers = GuiChatHandlers(gui_queue, replay_since=5)
+    handlers.on_message(_message(9))
+    handlers.on_message(_message(12))
+
+    # 只有缓存之后的第一条消息用来判断缺口
+    assert [gui_queue.get_nowait()[0] for _ in range(3)] == [
+        "gap",
+        "message",
+        "message",
+    ]
+    handlers = GuiChatHandlers(gui_queue, replay_since=5)
+    handlers.on_message(_message(6))
+    assert gui_queue.get_nowait()[0] == "message"
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""通过真实的 gRPC 连接加入房间并收发消息"""
+
+import queue
+
+import grpc
+
+import chat_pb2  # type: ignore
+import chat_pb2_grpc  # type: ignore
+from grpc_chat.sdk import ChatClient
+from support import TIMEOUT, Inbox
+
+
+def test_raw_stream_join(start_server):
+    _, target = start_server()
+    with grpc.insecure_channel(target) as channel:
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        requests: "queue.Queue" = queue.Queue()
+        join = chat_pb2.JoinRequest(user_name="raw", room_id="general")
+        requests.put(chat_pb2.ClientMessage(join_request=join))
+        responses = stub.Chat(iter(requests.get, None))
+
+        first = next(responses)
+        assert first.join_response.success
+        assert first.join_response.resume_token == ""
+        requests.put(None)
+        responses.cancel()
+
+
+def test_sdk_join_and_broadcast(start_server):
+    _, target = start_server()
+    with ChatClient(target) as client:
+        alice_inbox, bob_inbox = Inbox(), Inbox()
+        alice = client.join("alice", "general", alice_inbox, timeout=TIMEOUT)
+        bob = client.join("bob", "general", bob_inbox, timeout=TIMEOUT)
+        assert "general" in alice.welcome
+
+        alice.send("hello")
+        message = bob_inbox.next_message()
+        assert (message.sender_name, message.text) == ("alice", "hello")
+        assert alice_inbox.next_message().sequence == message.sequence
+
+        bob.leave()
+        alice.leave()
+        assert bob_inbox.closed.wait(TIMEOUT)
+        assert bob_inbox.error is None
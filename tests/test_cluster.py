@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""集群模式：一致性哈希环的分配，以及两个节点之间的聊天"""
+
+import socket
+import time
+
+import chat_pb2  # type: ignore
+from grpc_chat.cluster import HashRing
+from grpc_chat.sdk import ChatClient
+from support import TIMEOUT, Inbox
+
+ROOMS = [f"room-{i}" for i in range(2000)]
+
+
+def test_ring_owner_is_stable_and_balanced():
+    ring = HashRing(["a", "b", "c"])
+    owners = [ring.owner(room_id) for room_id in ROOMS]
+
+    # 与节点的给出顺序无关
+    assert owners == [HashRing(["c", "a", "b"]).owner(r) for r in ROOMS]
+    for node in ("a", "b", "c"):
+        assert 0.2 < owners.count(node) / len(ROOMS) < 0.45
+
+
+def test_adding_node_moves_only_its_share():
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+    moved = [r for r in ROOMS if before.owner(r) != after.owner(r)]
+
+    # 只有分给新节点的房间换了拥有者，约占 1/4
+    assert all(after.owner(r) == "d" for r in moved)
+    assert 0.15 < len(moved) / len(ROOMS) < 0.35
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def test_two_nodes_share_rooms_and_user_names(start_server):
+    nodes = {name: f"localhost:{_free_port()}" for name in ("n1", "n2")}
+    server_a, target_a = start_server(cluster_node="n1", cluster_nodes=nodes)
+    server_b, target_b = start_server(cluster_node="n2", cluster_nodes=nodes)
+    # 等两个节点互相连上、哈希环包含双方
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        if all(len(s.bus.ring.nodes) == 2 for s in (server_a, server_b)):
+            break
+        time.sleep(0.05)
+    assert server_a.bus.ring.nodes == ("n1", "n2")
+
+    with ChatClient(target_a) as client_a, ChatClient(target_b) as client_b:
+        alice_inbox, bob_inbox = Inbox(), Inbox()
+        alice = client_a.join("alice", "general", alice_inbox, timeout=TIMEOUT)
+        assert not client_b.check_username("alice").available
+        client_b.join("bob", "general", bob_inbox, timeout=TIMEOUT)
+        assert alice_inbox.next(chat_pb2.UserJoinedNotification).user_name == "bob"
+
+        alice.send("across nodes")
+        message = bob_inbox.next_message()
+        assert (message.sender_name, message.text) == ("alice", "across nodes")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""哈希时间轮的到期，包括停顿超过一整圈的情况"""
+
+from grpc_chat.leases import TimerWheel
+
+
+def test_advance_expires_due_keys():
+    wheel = TimerWheel(1.0, 4, now=0.0)
+    wheel.schedule("a", 1.5)
+    wheel.schedule("b", 3.0)
+
+    assert wheel.advance(1.0) == []
+    assert wheel.advance(2.0) == ["a"]
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(3.0) == ["b"]
+    assert len(wheel) == 0
+
+
+def test_stall_longer_than_a_turn():
+    wheel = TimerWheel(1.0, 4, now=0.0)
+    for key, deadline in (("a", 1.0), ("b", 2.0), ("c", 3.0), ("d", 4.0)):
+        wheel.schedule(key, deadline)
+    # 与 a 同槽但晚两圈
+    wheel.schedule("late", 9.0)
+
+    # 停顿 10 个刻度，超过 4 个槽的一整圈
+    assert sorted(wheel.advance(10.0)) == ["a", "b", "c", "d", "late"]
+    assert len(wheel) == 0
+    assert wheel.advance(20.0) == []
+
+
+def test_stall_keeps_keys_not_yet_due():
+    wheel = TimerWheel(1.0, 4, now=0.0)
+    wheel.schedule("soon", 2.0)
+    wheel.schedule("later", 14.0)
+
+    assert wheel.advance(9.0) == ["soon"]
+    assert len(wheel) == 1
+    assert wheel.advance(13.0) == []
+    assert wheel.advance(14.0) == ["later"]
+
+
+def test_reschedule_and_cancel():
+    wheel = TimerWheel(1.0, 4, now=0.0)
+    wheel.schedule("a", 1.0)
+    wheel.schedule("a", 3.0)
+    wheel.schedule("b", 1.0)
+
+    assert wheel.cancel("b")
+    assert not wheel.cancel("b")
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(3.0) == ["a"]
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""发送队列满时的三种溢出策略"""
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+import chat_pb2  # type: ignore
+from grpc_chat.server import (
+    OVERFLOW_DISCONNECT,
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_DROP_OLDEST,
+    StreamHandler,
+)
+
+
+def _handler(policy):
+    return StreamHandler("alice", "general", max_queue_size=3, overflow_policy=policy)
+
+
+def _fill(handler, count):
+    for i in range(count):
+        handler.send_message(b"m%d" % i)
+
+
+def test_drop_oldest_keeps_newest():
+    handler = _handler(OVERFLOW_DROP_OLDEST)
+    _fill(handler, 5)
+
+    assert list(handler.message_queue) == [b"m2", b"m3", b"m4"]
+    assert handler.dropped_count == 2
+    assert handler.queued_bytes == 6
+
+
+def test_drop_newest_inserts_gap_marker():
+    handler = _handler(OVERFLOW_DROP_NEWEST)
+    _fill(handler, 5)
+    assert list(handler.message_queue) == [b"m0", b"m1", b"m2"]
+    assert handler.dropped_count == 2
+
+    messages = handler.get_messages()
+    assert [next(messages), next(messages)] == [b"m0", b"m1"]
+    handler.send_message(b"m5")
+
+    assert handler.message_queue[0] == b"m2"
+    marker = chat_pb2.ServerMessage.FromString(handler.message_queue[1])
+    assert marker.messages_dropped.count == 2
+    assert handler.message_queue[2] == b"m5"
+    assert handler.queued_bytes == sum(len(m) for m in handler.message_queue)
+
+
+def test_disconnect_stops_slow_stream():
+    handler = _handler(OVERFLOW_DISCONNECT)
+    _fill(handler, 4)
+
+    assert handler.overflowed
+    assert not handler.active
+    # 被断开时不再发送队列中剩余的消息
+    assert list(handler.get_messages()) == []
+    handler.send_message(b"late")
+    assert handler.dropped_count == 1
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""房间列表分页：页码标记的编码、与排序方式不符的标记以及逐页遍历"""
+
+import grpc
+import pytest
+
+import grpc_chat  # noqa: F401  确保生成的 chat_pb2 可以被导入
+import chat_pb2  # type: ignore
+from grpc_chat.rooms import RoomRegistry
+from grpc_chat.server import ChatServer, _decode_page_token, _encode_page_token
+
+
+class _Context:
+    def __init__(self):
+        self.code = None
+        self.details = ""
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        self.details = details
+
+
+@pytest.fixture
+def server():
+    server = ChatServer(heartbeat_interval=0)
+    yield server
+    server.close()
+
+
+@pytest.mark.parametrize("by_participants", [False, True])
+def test_token_round_trip(by_participants):
+    cursor = "40" if by_participants else "房间/42"
+    token = _encode_page_token(cursor, by_participants)
+
+    assert _decode_page_token(token, by_participants) == cursor
+    assert _decode_page_token("", by_participants) == ""
+
+
+def test_token_for_other_sort_is_rejected():
+    with pytest.raises(ValueError):
+        _decode_page_token(_encode_page_token("tech", False), True)
+    with pytest.raises(ValueError):
+        _decode_page_token(_encode_page_token("20", True), False)
+
+
+@pytest.mark.parametrize("token", ["abc", "__4=", "cDphYmM="])
+def test_malformed_token_is_rejected(token):
+    # 依次为：base64 填充错误、不是 UTF-8、按人数排序但偏移量不是数字
+    with pytest.raises(ValueError):
+        _decode_page_token(token, True)
+
+
+def test_page_by_name_walks_every_room():
+    rooms = RoomRegistry()
+    ids = [f"room{i:02d}" for i in range(7)]
+    for room_id in reversed(ids):
+        rooms.create(room_id)
+    rooms.create("other")
+
+    seen, after = [], ""
+    while True:
+        page, has_more = rooms.page_by_name("room", after, 3)
+        seen.extend(room.room_id for room in page)
+        if not has_more:
+            break
+        after = page[-1].room_id
+    assert seen == ids
+
+
+def test_list_rooms_pages_with_tokens(server):
+    for i in range(5):
+        server.rooms.create(f"extra{i}")
+    request = chat_pb2.ListRoomsRequest(name_prefix="extra", page_size=2)
+
+    seen = []
+    while True:
+        response = server.ListRooms(request, _Context())
+        seen.extend(room.room_id for room in response.rooms)
+        assert response.total_count == 5
+        if not response.next_page_token:
+            break
+        request.page_token = response.next_page_token
+    assert seen == [f"extra{i}" for i in range(5)]
+
+
+def test_list_rooms_sorted_by_participants(server):
+    for room_id, count in (("a", 1), ("b", 3), ("c", 2)):
+        room, _ = server.rooms.create(f"busy-{room_id}")
+        room.global_count = count
+    request = chat_pb2.ListRoomsRequest(
+        name_prefix="busy-",
+        page_size=2,
+        sort_by=chat_pb2.ROOM_SORT_BY_PARTICIPANTS,
+    )
+
+    first = server.ListRooms(request, _Context())
+    request.page_token = first.next_page_token
+    second = server.ListRooms(request, _Context())
+    assert [room.room_id for room in first.rooms] == ["busy-b", "busy-c"]
+    assert [room.room_id for room in second.rooms] == ["busy-a"]
+    assert not second.next_page_token
+
+
+def test_list_rooms_rejects_token_for_other_sort(server):
+    request = chat_pb2.ListRoomsRequest(page_size=1)
+    token = server.ListRooms(request, _Context()).next_page_token
+    assert token
+
+    context = _Context()
+    request = chat_pb2.ListRoomsRequest(
+        page_size=1, page_token=token, sort_by=chat_pb2.ROOM_SORT_BY_PARTICIPANTS
+    )
+    response = server.ListRooms(request, context)
+    assert context.code == grpc.StatusCode.INVALID_ARGUMENT
+    assert not response.rooms
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""令牌桶的透支与补充"""
+
+import pytest
+
+from grpc_chat.ratelimit import SCOPE_ROOM, SCOPE_USER, RateLimiter, TokenBucket
+
+
+def test_bucket_refills_up_to_burst():
+    bucket = TokenBucket(rate=2.0, burst=3.0, now=0.0)
+    bucket.tokens = 0.0
+
+    assert bucket.wait_time(0.0) == pytest.approx(0.5)
+    assert bucket.wait_time(0.25) == pytest.approx(0.25)
+    assert bucket.wait_time(0.5) == 0.0
+    assert bucket.wait_time(100.0) == 0.0
+    assert bucket.tokens == 3.0
+
+
+def test_bucket_overdraft_delays_refill():
+    bucket = TokenBucket(rate=1.0, burst=1.0, now=0.0)
+    bucket.tokens -= 1
+    # 透支两个令牌后要先还清欠账
+    bucket.tokens -= 2
+
+    assert bucket.wait_time(0.0) == pytest.approx(3.0)
+    assert bucket.wait_time(2.0) == pytest.approx(1.0)
+    assert bucket.wait_time(3.0) == 0.0
+
+
+def test_bucket_ignores_clock_going_backwards():
+    bucket = TokenBucket(rate=1.0, burst=1.0, now=10.0)
+    bucket.tokens = 0.0
+
+    assert bucket.wait_time(5.0) == pytest.approx(1.0)
+    assert bucket.updated == 10.0
+
+
+def test_limiter_overdraws_within_max_wait():
+    now = [0.0]
+    limiter = RateLimiter(user_rate=1.0, user_burst=1.0, clock=lambda: now[0])
+
+    assert limiter.acquire("alice", "general") == (0.0, "")
+    # 等待不超过 max_wait 时取走令牌（透支），调用方等待后再转发
+    assert limiter.acquire("alice", "general", max_wait=1.0) == (1.0, SCOPE_USER)
+    # 超过 max_wait 时不取令牌
+    assert limiter.acquire("alice", "general", max_wait=1.0) == (2.0, SCOPE_USER)
+    assert limiter.acquire("alice", "general") == (2.0, SCOPE_USER)
+    # 其他用户不受影响
+    assert limiter.acquire("bob", "general") == (0.0, "")
+
+    now[0] = 2.0
+    assert limiter.acquire("alice", "general") == (0.0, "")
+
+
+def test_limiter_reports_tightest_scope():
+    now = [0.0]
+    limiter = RateLimiter(
+        user_rate=10.0, room_rate=1.0, room_burst=1.0, clock=lambda: now[0]
+    )
+
+    assert limiter.acquire("alice", "general") == (0.0, "")
+    wait, scope = limiter.acquire("bob", "general")
+    assert scope == SCOPE_ROOM
+    assert wait == pytest.approx(1.0)
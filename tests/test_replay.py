@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""加入时回放房间历史：最近 N 条、指定序号之后，以及从持久化日志补足"""
+
+from grpc_chat.sdk import ChatClient
+from support import TIMEOUT, Inbox
+
+
+def _publish(client, count):
+    inbox = Inbox()
+    alice = client.join("alice", "general", inbox, timeout=TIMEOUT)
+    for i in range(1, count + 1):
+        alice.send(f"m{i}")
+    # 自己也会收到，收齐后历史中一定已有这些消息
+    for _ in range(count):
+        inbox.next_message()
+    return alice
+
+
+def _replayed(inbox, count):
+    return [(m.sequence, m.text) for m in (inbox.next_message() for _ in range(count))]
+
+
+def test_replay_last(start_server):
+    _, target = start_server(history_size=3)
+    with ChatClient(target) as client:
+        _publish(client, 5)
+        inbox = Inbox()
+        session = client.join("bob", "general", inbox, replay_last=2, timeout=TIMEOUT)
+
+        assert _replayed(inbox, 2) == [(4, "m4"), (5, "m5")]
+        assert session.last_sequence == 5
+
+
+def test_replay_since_is_limited_to_memory_history(start_server):
+    _, target = start_server(history_size=3)
+    with ChatClient(target) as client:
+        alice = _publish(client, 5)
+        inbox = Inbox()
+        client.join("bob", "general", inbox, replay_since=1, timeout=TIMEOUT)
+
+        assert _replayed(inbox, 3) == [(3, "m3"), (4, "m4"), (5, "m5")]
+        # 回放之后是实时消息，不重复也不遗漏
+        alice.send("live")
+        assert _replayed(inbox, 1) == [(6, "live")]
+
+
+def test_replay_since_reads_older_messages_from_log(start_server, tmp_path):
+    _, target = start_server(history_size=2, data_dir=str(tmp_path))
+    with ChatClient(target) as client:
+        _publish(client, 5)
+        inbox = Inbox()
+        client.join("bob", "general", inbox, replay_since=1, timeout=TIMEOUT)
+
+        assert [text for _, text in _replayed(inbox, 4)] == ["m2", "m3", "m4", "m5"]
+
+
+def test_sequences_continue_after_restart(start_server, tmp_path):
+    server, target = start_server(history_size=2, data_dir=str(tmp_path))
+    with ChatClient(target) as client:
+        _publish(client, 3).leave()
+    server.close()
+
+    _, target = start_server(history_size=2, data_dir=str(tmp_path))
+    with ChatClient(target) as client:
+        inbox = Inbox()
+        session = client.join("bob", "general", inbox, replay_last=5, timeout=TIMEOUT)
+
+        assert _replayed(inbox, 3) == [(1, "m1"), (2, "m2"), (3, "m3")]
+        session.send("after restart")
+        assert _replayed(inbox, 1) == [(4, "after restart")]
+
+
+def test_recreated_room_does_not_restore_old_log(start_server, tmp_path):
+    _, target = start_server(data_dir=str(tmp_path))
+    with ChatClient(target) as client:
+        client.create_room("temp")
+        alice = client.join("alice", "temp", Inbox(), timeout=TIMEOUT)
+        alice.send("old")
+        alice.leave()
+        assert alice.wait_closed(TIMEOUT)
+        assert client.delete_room("temp").success
+
+        client.create_room("temp")
+        session = client.join("bob", "temp", Inbox(), replay_last=5, timeout=TIMEOUT)
+        assert session.last_sequence == 0
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""断开后保留会话：只对声明 resumable 的客户端生效"""
+
+import chat_pb2  # type: ignore
+from grpc_chat.sdk import ChatClient
+from support import TIMEOUT, Inbox
+
+
+def test_close_without_resumable_leaves_at_once(start_server):
+    _, target = start_server(resume_grace=30)
+    with ChatClient(target) as client:
+        watcher = Inbox()
+        client.join("alice", "general", watcher, timeout=TIMEOUT)
+        bob = client.join("bob", "general", Inbox(), timeout=TIMEOUT)
+        assert bob.resume_token == ""
+
+        bob.close()
+        left = watcher.next(chat_pb2.UserLeftNotification)
+        assert left.user_name == "bob"
+        assert client.check_username("bob").available
+
+
+def test_resume_replays_missed_messages(start_server):
+    _, target = start_server(resume_grace=30)
+    with ChatClient(target) as client:
+        watcher = Inbox()
+        alice = client.join("alice", "general", watcher, timeout=TIMEOUT)
+        bob_inbox = Inbox()
+        bob = client.join("bob", "general", bob_inbox, timeout=TIMEOUT, resumable=True)
+        assert bob.resume_token
+
+        # 模拟网络中断：不发送 LeaveRequest 直接取消
+        bob.close()
+        assert bob_inbox.closed.wait(TIMEOUT)
+        alice.send("while away")
+        watcher.next_message()
+        assert not client.check_username("bob").available
+
+        resumed = client.resume(bob, timeout=TIMEOUT)
+        assert resumed.resumed
+        assert resumed.resumable
+        assert bob_inbox.next_message().text == "while away"
+        # 保留期间不广播离开和重新加入
+        assert not any(
+            isinstance(
+                event,
+                (chat_pb2.UserLeftNotification, chat_pb2.UserJoinedNotification),
+            )
+            for event in watcher.drain()
+        )
+        resumed.leave()
+
+
+def test_parked_session_expires(start_server):
+    _, target = start_server(resume_grace=0.3)
+    with ChatClient(target) as client:
+        watcher = Inbox()
+        client.join("alice", "general", watcher, timeout=TIMEOUT)
+        bob = client.join("bob", "general", Inbox(), timeout=TIMEOUT, resumable=True)
+
+        bob.close()
+        left = watcher.next(chat_pb2.UserLeftNotification)
+        assert left.user_name == "bob"
+
+        again = client.resume(bob, timeout=TIMEOUT)
+        assert not again.resumed
+        again.leave()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""客户端库：事件展开、多房间会话、断线重连和异步接口"""
+
+import asyncio
+
+import pytest
+
+import chat_pb2  # type: ignore
+from grpc_chat.sdk import (
+    AsyncChatClient,
+    ChatClient,
+    JoinError,
+    iter_events,
+    iter_room_events,
+)
+from grpc_chat.wire import encode_batch, encode_chat_message
+from support import TIMEOUT, Inbox
+
+
+def test_iter_room_events_expands_batches():
+    batch = chat_pb2.ServerMessage.FromString(
+        encode_batch(
+            [
+                encode_chat_message("tech", "alice", "hi", 0, 1),
+                chat_pb2.ServerMessage(
+                    heartbeat=chat_pb2.Heartbeat()
+                ).SerializeToString(),
+                chat_pb2.ServerMessage(
+                    messages_dropped=chat_pb2.MessagesDropped(count=2)
+                ).SerializeToString(),
+            ]
+        )
+    )
+
+    events = list(iter_room_events(batch, "general"))
+    # 心跳不作为事件；没有标记房间的事件归入默认房间
+    assert [(room_id, type(event)) for room_id, event in events] == [
+        ("tech", chat_pb2.BroadcastMessage),
+        ("general", chat_pb2.MessagesDropped),
+    ]
+    assert [type(event) for event in iter_events(batch)] == [
+        chat_pb2.BroadcastMessage,
+        chat_pb2.MessagesDropped,
+    ]
+
+
+def test_join_rejected(start_server):
+    _, target = start_server()
+    with ChatClient(target) as client:
+        with pytest.raises(JoinError):
+            client.join("alice", "no-such-room", Inbox(), timeout=TIMEOUT)
+
+
+def test_one_stream_joins_several_rooms(start_server):
+    _, target = start_server()
+    with ChatClient(target) as client:
+        inbox = Inbox()
+        alice = client.join("alice", "general", inbox, timeout=TIMEOUT)
+        alice.join_room("tech", timeout=TIMEOUT)
+        assert alice.rooms == ["general", "tech"]
+        with pytest.raises(JoinError):
+            alice.join_room("no-such-room", timeout=TIMEOUT)
+
+        alice.send("in tech", room_id="tech")
+        alice.send("in general")
+        received = []
+        while len(received) < 2:
+            room_id, event = inbox.events.get(timeout=TIMEOUT)
+            if isinstance(event, chat_pb2.BroadcastMessage):
+                received.append((room_id, event.text))
+        assert received == [("tech", "in tech"), ("general", "in general")]
+        assert alice.sequences == {"general": 1, "tech": 1}
+
+
+def test_reconnect_resumes_session(start_server):
+    _, target = start_server(resume_grace=30)
+    with ChatClient(target) as client:
+        alice = client.join("alice", "general", Inbox(), timeout=TIMEOUT)
+        bob_inbox = Inbox()
+        bob = client.join("bob", "general", bob_inbox, timeout=TIMEOUT, resumable=True)
+        bob.close()
+        assert bob_inbox.closed.wait(TIMEOUT)
+        alice.send("while away")
+
+        resumed = client.reconnect(bob, timeout=TIMEOUT)
+        assert resumed.resumed
+        assert bob_inbox.next_message().text == "while away"
+        assert resumed.last_sequence == 1
+
+
+def test_async_client(start_server):
+    _, target = start_server()
+
+    async def chat():
+        async with AsyncChatClient(target) as client:
+            assert (await client.check_username("bot")).available
+            session = await client.join("bot", "general", timeout=TIMEOUT)
+            with ChatClient(target) as sync_client:
+                alice = sync_client.join("alice", "general", Inbox(), timeout=TIMEOUT)
+                events = session.__aiter__()
+                joined = await asyncio.wait_for(events.__anext__(), TIMEOUT)
+                assert joined.user_name == "alice"
+
+                alice.send("ping")
+                message = await asyncio.wait_for(events.__anext__(), TIMEOUT)
+                assert (message.sender_name, message.text) == ("alice", "ping")
+                await session.send("pong")
+                while True:
+                    message = await asyncio.wait_for(events.__anext__(), TIMEOUT)
+                    if isinstance(message, chat_pb2.BroadcastMessage):
+                        break
+                assert (message.sender_name, message.sequence) == ("bot", 2)
+                alice.leave()
+            # leave 要等剩余的事件被读出后才返回
+            leaving = asyncio.ensure_future(session.leave())
+            async for _ in events:
+                pass
+            await asyncio.wait_for(leaving, TIMEOUT)
+
+    asyncio.run(chat())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""持久化消息日志的恢复：截断末尾不完整的记录和 CRC 校验失败的记录"""
+
+import glob
+import os
+
+from grpc_chat.storage import _HEADER, FSYNC_ALWAYS, MessageLog
+
+ROOM = "general"
+
+
+def _write(data_dir, payloads, first=1):
+    message_log = MessageLog(data_dir, fsync_policy=FSYNC_ALWAYS)
+    for i, payload in enumerate(payloads):
+        message_log.append(ROOM, first + i, payload)
+    message_log.close()
+
+
+def _segment(data_dir):
+    (path,) = glob.glob(os.path.join(data_dir, ROOM, "*.log"))
+    return path
+
+
+def test_reopen_restores_records(tmp_path):
+    payloads = [b"one", b"two", b"three"]
+    _write(str(tmp_path), payloads)
+
+    message_log = MessageLog(str(tmp_path))
+    try:
+        assert message_log.last_sequence(ROOM) == 3
+        assert message_log.read(ROOM, 1, 3) == payloads
+        assert message_log.read_last(ROOM, 2) == payloads[1:]
+    finally:
+        message_log.close()
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    _write(str(tmp_path), [b"one", b"two"])
+    path = _segment(str(tmp_path))
+    intact = os.path.getsize(path)
+    # 写到一半时崩溃：只有头部和部分负载
+    with open(path, "ab") as f:
+        f.write(b"\x00\x00\x00\x10" + b"\x00" * 8)
+
+    message_log = MessageLog(str(tmp_path), fsync_policy=FSYNC_ALWAYS)
+    try:
+        assert os.path.getsize(path) == intact
+        assert message_log.last_sequence(ROOM) == 2
+        # 截断后从原位置继续追加
+        message_log.append(ROOM, 3, b"three")
+        assert message_log.read(ROOM, 1, 3) == [b"one", b"two", b"three"]
+    finally:
+        message_log.close()
+
+    message_log = MessageLog(str(tmp_path))
+    try:
+        assert message_log.read(ROOM, 1, 3) == [b"one", b"two", b"three"]
+    finally:
+        message_log.close()
+
+
+def test_crc_mismatch_drops_tail(tmp_path):
+    _write(str(tmp_path), [b"one", b"two", b"three"])
+    path = _segment(str(tmp_path))
+    size = os.path.getsize(path)
+    # 损坏最后一条记录的负载
+    with open(path, "r+b") as f:
+        f.seek(size - 1)
+        f.write(b"X")
+
+    message_log = MessageLog(str(tmp_path))
+    try:
+        assert message_log.last_sequence(ROOM) == 2
+        assert message_log.read(ROOM, 1, 3, timeout=0) == [b"one", b"two"]
+        assert os.path.getsize(path) == size - _HEADER.size - len(b"three")
+    finally:
+        message_log.close()
+
+
+def test_corrupt_sealed_segment_keeps_later_segments(tmp_path):
+    message_log = MessageLog(str(tmp_path), segment_bytes=1)
+    for sequence, payload in enumerate([b"one", b"two", b"three"], 1):
+        message_log.append(ROOM, sequence, payload)
+    message_log.close()
+    first, second, last = sorted(glob.glob(os.path.join(str(tmp_path), ROOM, "*")))
+    with open(second, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"X")
+
+    message_log = MessageLog(str(tmp_path))
+    try:
+        # 封存的段不截断，只是不再读取损坏的记录
+        assert os.path.getsize(second) == _HEADER.size + len(b"two")
+        assert message_log.read(ROOM, 1, 3, timeout=0) == [b"one", b"three"]
+    finally:
+        message_log.close()
+
+
+def test_delete_room_removes_log(tmp_path):
+    message_log = MessageLog(str(tmp_path))
+    try:
+        message_log.append(ROOM, 1, b"one")
+        message_log.append("tech", 1, b"other")
+        message_log.delete_room(ROOM)
+        assert not os.path.exists(os.path.join(str(tmp_path), ROOM))
+        assert message_log.last_sequence(ROOM) == 0
+        # 同名的新房间从空日志开始
+        message_log.append(ROOM, 1, b"new")
+    finally:
+        message_log.close()
+
+    message_log = MessageLog(str(tmp_path))
+    try:
+        assert message_log.read(ROOM, 1, 1) == [b"new"]
+        assert message_log.read("tech", 1, 1) == [b"other"]
+    finally:
+        message_log.close()
+
+
+def test_full_queue_drops_after_timeout(tmp_path):
+    message_log = MessageLog(str(tmp_path), max_pending=2, append_timeout=0.01)
+    room_log = message_log._room(ROOM)
+    try:
+        # 写线程阻塞在登记索引上，队列很快写满
+        with room_log._lock:
+            for sequence in range(1, 11):
+                message_log.append(ROOM, sequence, b"x")
+    finally:
+        message_log.close()
+    dropped = message_log.dropped
+    assert dropped > 0
+
+    message_log = MessageLog(str(tmp_path))
+    try:
+        assert len(message_log.read(ROOM, 1, 10, timeout=0)) == 10 - dropped
+    finally:
+        message_log.close()
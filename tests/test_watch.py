@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""房间列表订阅：先发快照，之后按合并窗口推送变化"""
+
+import queue
+
+import chat_pb2  # type: ignore
+from grpc_chat.rooms import RoomRegistry
+from grpc_chat.sdk import ChatClient
+from grpc_chat.watch import RoomWatchHub
+from support import TIMEOUT, Inbox
+
+
+class _Watcher:
+    def __init__(self):
+        self.updates = []
+
+    def send_message(self, frame):
+        self.updates.append(chat_pb2.RoomsUpdate.FromString(frame))
+
+
+def _hub():
+    rooms = RoomRegistry()
+    for room_id in ("lobby-a", "lobby-b", "other"):
+        rooms.create(room_id)
+    scheduled = []
+    hub = RoomWatchHub(rooms, lambda delay, callback: scheduled.append(callback))
+    return rooms, hub, scheduled
+
+
+def test_snapshot_then_coalesced_delta():
+    rooms, hub, scheduled = _hub()
+    watcher = _Watcher()
+    assert hub.subscribe(watcher, "lobby-") == 2
+    assert watcher.updates[0].snapshot
+
+    # 同一窗口内多次变化只安排一次推送，每个房间只出现一次
+    hub.mark("lobby-a")
+    hub.mark("lobby-a")
+    rooms.create("lobby-c")
+    hub.mark("lobby-c")
+    hub.mark("other")
+    assert len(scheduled) == 1
+    scheduled.pop()()
+
+    delta = watcher.updates[1]
+    assert not delta.snapshot
+    assert [room.room_id for room in delta.rooms] == ["lobby-a", "lobby-c"]
+
+
+def test_deleted_room_is_reported_as_removed():
+    rooms, hub, scheduled = _hub()
+    watcher = _Watcher()
+    hub.subscribe(watcher)
+    rooms.delete("lobby-b")
+    hub.mark("lobby-b")
+    scheduled.pop()()
+
+    assert list(watcher.updates[1].removed_room_ids) == ["lobby-b"]
+
+
+def test_changes_outside_prefix_are_not_sent():
+    _, hub, scheduled = _hub()
+    watcher = _Watcher()
+    hub.subscribe(watcher, "lobby-")
+    hub.mark("other")
+    scheduled.pop()()
+
+    assert len(watcher.updates) == 1
+
+
+def test_watch_rooms_stream(start_server):
+    _, target = start_server(watch_interval=0.05)
+    with ChatClient(target) as client:
+        updates: "queue.Queue" = queue.Queue()
+        watch = client.watch_rooms(updates.put, name_prefix="team-")
+        assert list(updates.get(timeout=TIMEOUT).rooms) == []
+
+        client.create_room("team-red", max_capacity=5)
+        created = updates.get(timeout=TIMEOUT)
+        assert [(r.room_id, r.max_capacity) for r in created.rooms] == [("team-red", 5)]
+
+        session = client.join("alice", "team-red", Inbox(), timeout=TIMEOUT)
+        joined = updates.get(timeout=TIMEOUT)
+        assert joined.rooms[0].participant_count == 1
+
+        session.leave()
+        assert updates.get(timeout=TIMEOUT).rooms[0].participant_count == 0
+        assert client.delete_room("team-red").success
+        assert list(updates.get(timeout=TIMEOUT).removed_room_ids) == ["team-red"]
+        watch.cancel()